@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""Benchmark the cached EntityFinder matchers against the original span enumeration"""
+import random
+import timeit
+
+from hu_entity.entity_finder import EntityFinder, span_enumeration_matches
+
+VOCABULARY = ["i", "want", "a", "cake", "and", "then", "some", "more", "please",
+              "with", "the", "of", "to", "carrot", "red", "wine", "diet", "coke"]
+
+
+def setup_finder(entity_count, values_per_entity, merged_index=False):
+    rng = random.Random(1)
+    entities = {}
+    for entity_index in range(entity_count):
+        values = []
+        for _ in range(values_per_entity):
+            length = rng.randint(1, 3)
+            values.append(" ".join(rng.choice(VOCABULARY) for _ in range(length)))
+        entities["entity{}".format(entity_index)] = values
+    finder = EntityFinder(merged_index)
+    finder.setup_cached_entity_values(entities)
+    return finder
+
+
+def make_message(word_count):
+    rng = random.Random(2)
+    return " ".join(rng.choice(VOCABULARY) for _ in range(word_count))
+
+
+def main():
+    print("{:>8} {:>9} {:>14} {:>14} {:>14} {:>9}".format(
+        "words", "entities", "spans (ms)", "walk (ms)", "merged (ms)", "speed-up"))
+    for entity_count in (10, 100, 1000):
+        finder = setup_finder(entity_count, 50)
+        merged_finder = setup_finder(entity_count, 50, merged_index=True)
+        for word_count in (10, 50, 200):
+            message = make_message(word_count)
+            number = max(1, 2000 // (word_count * entity_count))
+            spans = min(timeit.repeat(
+                lambda: span_enumeration_matches(finder, message),
+                number=number, repeat=3)) / number
+            walk = min(timeit.repeat(
+                lambda: finder.find_entity_values(message),
+                number=number, repeat=3)) / number
+            merged = min(timeit.repeat(
+                lambda: merged_finder.find_entity_values(message),
+                number=number, repeat=3)) / number
+            print("{:>8} {:>9} {:>14.3f} {:>14.3f} {:>14.3f} {:>8.1f}x".format(
+                word_count, entity_count, spans * 1000, walk * 1000, merged * 1000,
+                spans / merged))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+Benchmark the entity trie backends: insert throughput, the time to add 100 values at
+a time to a built trie, as populates do, lookup latency and memory at 10k, 100k and 1M
+values. datrie, the previous backend, is included as a baseline when installed. Each
+measurement runs in a fresh process. Memory is given three ways: the growth of the
+resident memory, which includes allocator slack; the memory traced by tracemalloc,
+which only sees Python allocations, so not the C++ memory of marisa and datrie; and
+the size of the structure where it can be measured: the serialized size for marisa,
+the list and its strings for the sorted array.
+"""
+import concurrent.futures
+import gc
+import os
+import random
+import sys
+import string
+import timeit
+import tracemalloc
+
+from hu_entity.entity_finder import SortedArrayEntityTrie, MarisaEntityTrie
+
+SIZES = [10000, 100000, 1000000]
+LOOKUPS = 100000
+ADDS = 50
+ADD_SIZE = 100
+
+
+def resident_bytes():
+    with open("/proc/self/statm") as file_handle:
+        return int(file_handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def make_words(count):
+    rng = random.Random(count)
+    # values are lower case, ascii so that datrie can hold them too
+    return ["".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 12)))
+            + " " + str(n) for n in range(count)]
+
+
+def build_datrie(words):
+    import datrie
+    trie = datrie.Trie(string.printable)
+    for word in words:
+        trie[word] = True
+    return trie
+
+
+def structure_bytes(entity_trie):
+    if isinstance(entity_trie, MarisaEntityTrie):
+        return len(entity_trie.trie.tobytes())
+    if isinstance(entity_trie, SortedArrayEntityTrie):
+        return sys.getsizeof(entity_trie.words) + sum(
+            sys.getsizeof(word) for word in entity_trie.words)
+    return None
+
+
+def add_words(entity_trie, words):
+    if hasattr(entity_trie, "add_words"):
+        entity_trie.add_words(words)
+    else:
+        for word in words:
+            entity_trie[word] = True
+
+
+BACKENDS = {
+    "datrie": build_datrie,
+    "sorted array": SortedArrayEntityTrie,
+    "marisa": MarisaEntityTrie,
+}
+
+
+def measure(backend, count):
+    # only the words kept by the backend count towards its memory
+    before = resident_bytes()
+    start = timeit.default_timer()
+    entity_trie = BACKENDS[backend](make_words(count))
+    build = timeit.default_timer() - start
+    gc.collect()
+    memory = resident_bytes() - before
+
+    words = make_words(count)
+    rng = random.Random(0)
+    probes = [rng.choice(words) if n % 2 else "missing {}".format(n) for n in range(LOOKUPS)]
+
+    def lookups():
+        for probe in probes:
+            probe in entity_trie
+
+    lookup = min(timeit.repeat(lookups, number=1, repeat=3)) / LOOKUPS
+
+    added_words = ["added {}".format(n) for n in range(ADDS * ADD_SIZE)]
+    start = timeit.default_timer()
+    for index in range(0, len(added_words), ADD_SIZE):
+        add_words(entity_trie, added_words[index:index + ADD_SIZE])
+    add = (timeit.default_timer() - start) / ADDS
+    return count / build, add, lookup, memory, structure_bytes(entity_trie)
+
+
+def measure_traced(backend, count):
+    tracemalloc.start()
+    entity_trie = BACKENDS[backend](make_words(count))
+    traced = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del entity_trie
+    return traced
+
+
+def main():
+    print("{:>14} {:>9} {:>12} {:>13} {:>12} {:>9} {:>12} {:>9}".format(
+        "backend", "values", "inserts/s", "add 100 (ms)", "lookup (us)", "rss (MB)",
+        "traced (MB)", "size (MB)"))
+    for count in SIZES:
+        for backend in BACKENDS:
+            try:
+                with concurrent.futures.ProcessPoolExecutor(1) as executor:
+                    throughput, add, lookup, memory, size = executor.submit(
+                        measure, backend, count).result()
+                with concurrent.futures.ProcessPoolExecutor(1) as executor:
+                    traced = executor.submit(measure_traced, backend, count).result()
+            except ImportError:
+                continue
+            size_text = "-" if size is None else "{:.1f}".format(size / 1e6)
+            print("{:>14} {:>9} {:>12.0f} {:>13.3f} {:>12.3f} {:>9.1f} {:>12.1f} {:>9}".format(
+                backend, count, throughput, add * 1000, lookup * 1e6, memory / 1e6,
+                traced / 1e6, size_text))
+
+
+if __name__ == "__main__":
+    main()
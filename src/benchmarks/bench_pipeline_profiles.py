@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+Benchmark the time of a single text through the full spaCy pipeline, as /ner and
+/tokenize used to run it, against the components of each call's pipeline profile.
+Needs the spaCy models installed, see initialize_spacy_model.py.
+"""
+import argparse
+import random
+import timeit
+
+from hu_entity.spacy_wrapper import SpacyWrapper, PIPELINE_PROFILES
+
+WORDS = ["i", "want", "to", "fly", "from", "London", "to", "Paris", "tomorrow", "at",
+         "9am", "with", "Fred", "Bloggs", "and", "book", "a", "table", "for", "2"]
+
+
+def make_texts(word_count, count=50):
+    rng = random.Random(word_count)
+    return [" ".join(rng.choice(WORDS) for _ in range(word_count)) for _ in range(count)]
+
+
+def per_text(function, texts, repeat=3):
+    return min(timeit.repeat(lambda: [function(text) for text in texts],
+                             number=1, repeat=repeat)) / len(texts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--minimal", action="store_true", help="use the minimal model")
+    parser.add_argument("--language", default="en")
+    args = parser.parse_args()
+
+    wrapper = SpacyWrapper(args.minimal, args.language)
+    wrapper.initialize()
+    print("pipeline:", ", ".join(wrapper.nlp.pipe_names))
+    print("{:>22} {:>6} {:>10} {:>12} {:>8}".format(
+        "profile", "words", "full (ms)", "profile (ms)", "saved"))
+    for word_count in (5, 20, 80):
+        texts = make_texts(word_count)
+        # warm up
+        [wrapper.nlp(text) for text in texts]
+        full = per_text(wrapper.nlp, texts)
+        for profile in PIPELINE_PROFILES:
+            trimmed = per_text(lambda text: wrapper.parse(text, profile), texts)
+            print("{:>22} {:>6} {:>10.3f} {:>12.3f} {:>7.0%}".format(
+                profile, word_count, full * 1000, trimmed * 1000, 1 - trimmed / full))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Benchmark the peak memory of loading one large entity into an EntityFinder, through
+the JSON body of /v2/populate_entities and through the NDJSON lines read by
+/v2/populate_entities/stream. Peaks are traced with tracemalloc, which only sees
+memory allocated by Python (marisa-trie builds outside it). The request body itself
+is not counted: the JSON handler holds it whole, and decodes a copy of it, while the
+stream handler only ever holds a chunk of it. Times are taken in a separate run, as
+tracing slows allocations down. Each measurement runs in a fresh process.
+"""
+import concurrent.futures
+import json
+import random
+import string
+import timeit
+import tracemalloc
+
+from hu_entity.entity_finder import EntityFinder, EntityBulkLoader
+
+SIZES = [100000, 1000000]
+
+
+def make_values(count):
+    rng = random.Random(count)
+    return ["".join(rng.choice(string.ascii_letters) for _ in range(rng.randint(4, 12)))
+            + " " + str(n) for n in range(count)]
+
+
+def load_json(count, trace):
+    body = json.dumps({"entities": {"Gazetteer": make_values(count)}}).encode()
+    if trace:
+        tracemalloc.start()
+    start = timeit.default_timer()
+    # as request.json() does
+    entities = json.loads(body.decode())
+    EntityFinder().setup_cached_entity_values(entities["entities"])
+    return timeit.default_timer() - start
+
+
+def load_stream(count, trace):
+    lines = [json.dumps({"entity": "Gazetteer", "value": value}).encode()
+             for value in make_values(count)]
+    if trace:
+        tracemalloc.start()
+    start = timeit.default_timer()
+    loader = EntityBulkLoader(EntityFinder())
+    # the lines are already allocated, as chunks of the body would be
+    for line in lines:
+        loader.add_line(line)
+    loader.finish()
+    return timeit.default_timer() - start
+
+
+def measure(name, count, trace):
+    duration = LOADERS[name](count, trace)
+    return tracemalloc.get_traced_memory()[1] if trace else duration
+
+
+LOADERS = {
+    "json body": load_json,
+    "ndjson stream": load_stream,
+}
+
+
+def main():
+    print("{:>14} {:>9} {:>10} {:>14}".format("endpoint", "values", "time (s)", "peak (MB)"))
+    for count in SIZES:
+        for name in LOADERS:
+            with concurrent.futures.ProcessPoolExecutor(1) as executor:
+                duration = executor.submit(measure, name, count, False).result()
+            with concurrent.futures.ProcessPoolExecutor(1) as executor:
+                peak = executor.submit(measure, name, count, True).result()
+            print("{:>14} {:>9} {:>10.2f} {:>14.1f}".format(name, count, duration, peak / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Benchmark the /ner throughput of the server with ERS_SERVER_PROCESSES at 1, 2, 4 and
+8 worker processes. Each setting starts the server, waits for it to answer, then
+keeps a fixed number of requests in flight for a fixed time. Every request has a
+different text, so that the result cache never answers. Needs the spaCy models
+installed, see initialize_spacy_model.py, and as many cores as worker processes.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hu_entity",
+                      "server.py")
+
+TEXTS = ["I want to fly from London to Paris on Friday {}",
+         "Book a table for {} people at Luigi's in Manchester",
+         "What is the weather like in Madrid {} days from now",
+         "Remind Sherlock Holmes to call Microsoft at {} o'clock"]
+
+
+async def wait_until_up(session, url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(url + "/health") as resp:
+                if resp.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError("Server did not start")
+
+
+async def load(url, concurrency, duration):
+    latencies = []
+    counter = iter(range(10 ** 9))
+    end_time = time.monotonic() + duration
+
+    async def client(session):
+        while time.monotonic() < end_time:
+            number = next(counter)
+            text = TEXTS[number % len(TEXTS)].format(number)
+            start = time.monotonic()
+            async with session.get(url + "/ner", params={"q": text}) as resp:
+                await resp.read()
+                assert resp.status == 200
+            latencies.append(time.monotonic() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await wait_until_up(session, url, 600)
+        # warm up
+        for text in TEXTS:
+            async with session.get(url + "/ner", params={"q": text}) as resp:
+                await resp.read()
+        start = time.monotonic()
+        await asyncio.gather(*[client(session) for _ in range(concurrency)])
+        elapsed = time.monotonic() - start
+    latencies.sort()
+    return (len(latencies) / elapsed, latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.99)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=9195)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+    url = "http://127.0.0.1:{}".format(args.port)
+
+    print("{:>9} {:>10} {:>10} {:>10}".format("processes", "req/s", "p50 (ms)", "p99 (ms)"))
+    for processes in args.processes:
+        env = dict(os.environ, ERS_SERVER_PROCESSES=str(processes), ERS_MINIMAL_SERVER="1")
+        server = subprocess.Popen([sys.executable, SERVER, "--port={}".format(args.port)],
+                                  env=env, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL)
+        try:
+            throughput, p50, p99 = asyncio.get_event_loop().run_until_complete(
+                load(url, args.concurrency, args.duration))
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        print("{:>9} {:>10.1f} {:>10.1f} {:>10.1f}".format(processes, throughput,
+                                                           p50 * 1000, p99 * 1000))
+
+
+if __name__ == "__main__":
+    main()
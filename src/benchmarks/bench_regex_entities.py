@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Benchmark the combined regex entity scan against a fullmatch per regex entity"""
+import random
+import re
+import string
+import timeit
+
+from hu_entity.regex_matcher import MultiRegexMatcher
+
+
+def setup_regex_entities(count):
+    rng = random.Random(count)
+    regex_entities = {}
+    for n in range(count):
+        letter = rng.choice(string.ascii_uppercase)
+        regex_entities["regex{}".format(n)] = re.compile(
+            "[{}]\\d{{{}}}$".format(letter, rng.randint(2, 5)))
+    return regex_entities
+
+
+def loop_matches(regex_entities, words):
+    """The original scan, one fullmatch per regex entity per word"""
+    matches = []
+    for word in words:
+        for entity_name, compiled in regex_entities.items():
+            if compiled.fullmatch(word):
+                matches.append((word, entity_name))
+    return matches
+
+
+def combined_matches(matcher, words):
+    matches = []
+    for word in words:
+        for entity_name in matcher.fullmatches(word):
+            matches.append((word, entity_name))
+    return matches
+
+
+def main():
+    rng = random.Random(0)
+    words = ["alarm", "number", "please", "set", "the", "for", "tomorrow"] * 7 + ["A212", "Q7781"]
+    rng.shuffle(words)
+    print("{:>8} {:>12} {:>14} {:>9}".format("regexes", "loop (us)", "combined (us)", "speed-up"))
+    for count in (1, 10, 100):
+        regex_entities = setup_regex_entities(count)
+        matcher = MultiRegexMatcher(regex_entities)
+        assert loop_matches(regex_entities, words) == combined_matches(matcher, words)
+        loop = min(timeit.repeat(lambda: loop_matches(regex_entities, words),
+                                 number=100, repeat=5)) / 100
+        combined = min(timeit.repeat(lambda: combined_matches(matcher, words),
+                                     number=100, repeat=5)) / 100
+        print("{:>8} {:>12.1f} {:>14.1f} {:>8.1f}x".format(
+            count, loop * 1e6, combined * 1e6, loop / combined))
+
+
+if __name__ == "__main__":
+    main()
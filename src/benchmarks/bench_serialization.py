@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Benchmark serialising responses across response sizes: /ner entities with the old
+dumps_custom, whose encoder calls default() once per NamedEntity, against converting
+them to dicts in bulk and dumping them with each installed JSON backend; and the
+defaultdict matches of /v2/entity_check with each backend. Times include the
+conversion and the encoding to UTF-8 bytes that the response needs.
+"""
+import argparse
+import timeit
+from collections import defaultdict
+
+from hu_entity.named_entity import NamedEntity, dumps_custom
+from hu_entity.serialization import (available_backends, get_dumps, entities_to_dicts,
+                                     matches_to_dict)
+
+CATEGORIES = ["GPE", "PERSON", "ORG", "DATE", "CARDINAL", "custom_entity"]
+
+
+def make_entities(size):
+    return [NamedEntity("entity value {}".format(number), CATEGORIES[number % len(CATEGORIES)],
+                        number * 20, number * 20 + 14) for number in range(size)]
+
+
+def make_matches(size):
+    matches = defaultdict(list)
+    for number in range(size):
+        matches["matched words {}".format(number // 2)].append("entity{}".format(number % 7))
+    return matches
+
+
+def time_call(function, repeat):
+    number = max(1, 20000 // repeat)
+    best = min(timeit.repeat(function, number=number, repeat=5))
+    return best / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 1000, 10000])
+    args = parser.parse_args()
+    backends = available_backends()
+
+    print("/ner, microseconds per response")
+    print("{:>8} {:>14}".format("entities", "dumps_custom") +
+          "".join(" {:>10}".format(backend) for backend in backends))
+    for size in args.sizes:
+        entities = make_entities(size)
+        row = [time_call(lambda: dumps_custom(entities).encode('utf-8'), size)]
+        for backend in backends:
+            dumps = get_dumps(backend)
+            row.append(time_call(lambda: dumps(entities_to_dicts(entities)), size))
+        print("{:>8} {:>14.1f}".format(size, row[0] * 1e6) +
+              "".join(" {:>10.1f}".format(duration * 1e6) for duration in row[1:]))
+
+    print("\n/v2/entity_check, microseconds per response")
+    print("{:>8}".format("matches") + "".join(" {:>10}".format(backend) for backend in backends))
+    for size in args.sizes:
+        matches = make_matches(size)
+        data = {'conversation': "a conversation", 'entities': matches}
+        row = []
+        for backend in backends:
+            dumps = get_dumps(backend)
+            row.append(time_call(lambda: dumps(dict(data, entities=matches_to_dict(matches))),
+                                 size))
+        print("{:>8}".format(size) + "".join(" {:>10.1f}".format(duration * 1e6)
+                                             for duration in row))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Benchmark the startup cost of the stopword lists: importing nltk and sklearn to build
+them, as spacy_wrapper used to, against reading the lists precomputed by
+initialize_spacy_model.py. Each measurement runs in a fresh process and reports the
+wall time and the growth of the resident memory, after the interpreter has started.
+Needs nltk, its stopwords corpus and sklearn installed, and the lists generated.
+"""
+import concurrent.futures
+import os
+import timeit
+
+from hu_entity.stopwords import NLTK_STOPWORD_LISTS, SKLEARN_ENGLISH, load_stopwords
+
+
+def resident_bytes():
+    # not hu_entity.model_registry.resident_bytes, which would import spaCy
+    with open("/proc/self/statm") as file_handle:
+        return int(file_handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def build_with_nltk_and_sklearn():
+    from nltk.corpus import stopwords
+    from sklearn.feature_extraction.stop_words import ENGLISH_STOP_WORDS
+    lists = [set(stopwords.words(name)) for name in NLTK_STOPWORD_LISTS]
+    return lists + [set(ENGLISH_STOP_WORDS)]
+
+
+def read_precomputed():
+    return [load_stopwords(name) for name in NLTK_STOPWORD_LISTS + [SKLEARN_ENGLISH]]
+
+
+def read_precomputed_english():
+    # what an English only server reads
+    return [load_stopwords("english"), load_stopwords(SKLEARN_ENGLISH)]
+
+
+LOADERS = {
+    "nltk and sklearn": build_with_nltk_and_sklearn,
+    "precomputed, all": read_precomputed,
+    "precomputed, en": read_precomputed_english,
+}
+
+
+def measure(name):
+    before = resident_bytes()
+    start = timeit.default_timer()
+    LOADERS[name]()
+    return timeit.default_timer() - start, resident_bytes() - before
+
+
+def main():
+    print("{:>18} {:>10} {:>12}".format("stopwords", "time (ms)", "memory (MB)"))
+    for name in LOADERS:
+        with concurrent.futures.ProcessPoolExecutor(1) as executor:
+            duration, memory = executor.submit(measure, name).result()
+        print("{:>18} {:>10.1f} {:>12.1f}".format(name, duration * 1000, memory / 1e6))
+
+
+if __name__ == "__main__":
+    main()
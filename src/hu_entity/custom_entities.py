@@ -0,0 +1,104 @@
+"""Matches custom entity phrases in docs and merges them with the model's entities"""
+import bisect
+import logging
+
+from spacy.matcher import Matcher, PhraseMatcher
+from spacy.tokens import Doc
+
+# Phrases with at least this many words are matched with a token Matcher, as the
+# PhraseMatcher of spaCy 2.0 refuses them
+PHRASE_MAX_LENGTH = 16
+
+
+def _get_logger():
+    logger = logging.getLogger('hu_entity.custom_entities')
+    return logger
+
+
+def select_candidates(matches):
+    """
+    Of overlapping matches (label, start, end) keep the longest, and the first of
+    those as long. Returns the kept matches sorted by start.
+    """
+    taken = set()
+    candidates = []
+    # longest first, then by start
+    for label, start, end in sorted(matches, key=lambda match: (match[1] - match[2], match[1])):
+        span = range(start, end)
+        if any(index in taken for index in span):
+            continue
+        taken.update(span)
+        candidates.append((label, start, end))
+    candidates.sort(key=lambda candidate: candidate[1])
+    return candidates
+
+
+def merge_entities(ents, candidates):
+    """
+    The entities of a doc once the candidates (label, start, end), sorted and not
+    overlapping each other, are merged into its entities ents, which are sorted.
+    A model entity overlapping a candidate wins if it is longer, at the same length
+    the candidate wins. One pass over both lists.
+    """
+    ent_ends = [ent.end for ent in ents]
+    replaced = set()
+    added = []
+    for label, start, end in candidates:
+        index = bisect.bisect_right(ent_ends, start)
+        overlapping = []
+        while index < len(ents) and ents[index].start < end:
+            overlapping.append(index)
+            index += 1
+        if any(ents[index].end - ents[index].start > end - start for index in overlapping):
+            continue
+        replaced.update(overlapping)
+        added.append((label, label, start, end))
+    return [ent for index, ent in enumerate(ents) if index not in replaced] + added
+
+
+class CustomEntityMatcher:
+    """
+    Matches the phrases of custom entities, case insensitively and word by word, in
+    docs, and sets the matches as entities labelled with their key. Phrases are
+    compiled in bulk into a PhraseMatcher, with no Python callback per phrase; all
+    the matches of a doc are collected, then merged with the model's entities and
+    set with a single assignment to doc.ents.
+    """
+
+    def __init__(self, vocab):
+        self.logger = _get_logger()
+        self.vocab = vocab
+        self.phrase_matcher = PhraseMatcher(vocab, max_length=PHRASE_MAX_LENGTH)
+        self.long_phrase_matcher = Matcher(vocab)
+        self.phrases = 0
+
+    def add(self, key, phrases):
+        """Add phrases, matched as entities labelled key"""
+        short_docs = []
+        for phrase in phrases:
+            words = phrase.lower().split()
+            if not words:
+                continue
+            if len(words) < PHRASE_MAX_LENGTH:
+                short_docs.append(Doc(self.vocab, words=words))
+            else:
+                self.long_phrase_matcher.add(key, None, [{'LOWER': word} for word in words])
+            self.phrases += 1
+        if short_docs:
+            self.phrase_matcher.add(key, None, *short_docs)
+        self.logger.info("Added %d phrases for %s, %d in all", len(short_docs), key,
+                         self.phrases)
+
+    def __len__(self):
+        return self.phrases
+
+    def __call__(self, doc):
+        if self.phrases == 0:
+            return doc
+        # the PhraseMatcher of spaCy 2.0 only matches the exact text
+        lower_doc = Doc(self.vocab, words=[token.lower_ for token in doc])
+        matches = self.phrase_matcher(lower_doc) + self.long_phrase_matcher(doc)
+        if matches:
+            candidates = select_candidates(matches)
+            doc.ents = merge_entities(list(doc.ents), candidates)
+        return doc
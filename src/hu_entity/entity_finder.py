@@ -1,64 +1,446 @@
-import datrie
+import bisect
+import marisa_trie
+import json
+import os
+import re
 import string
 import logging
+import urllib.parse
 from collections import defaultdict
 
+from hu_entity.metrics import STAGE_SECONDS
+from hu_entity.regex_matcher import MultiRegexMatcher
+
+# Lists the snapshotted entity names, in the order they were added
+SNAPSHOT_MANIFEST = "entities.json"
+
+# Maps the cached regex entity names to their patterns
+REGEX_SNAPSHOT = "regex_entities.json"
+
+# Lists the regex entities disabled for going over the time budget
+DISABLED_REGEX_SNAPSHOT = "disabled_regex_entities.json"
+
+# Entities with more values than this are held in a marisa-trie
+SORTED_ARRAY_MAX_SIZE = 1000
+
+# Values added to a snapshotted marisa-trie since it was last saved whole, one JSON
+# string per line, in a file named after the trie's
+SNAPSHOT_DELTA_SUFFIX = ".delta"
+
 
 def _get_logger():
     logger = logging.getLogger('hu_entity.entity_finder')
     return logger
 
 
-class EntityFinder:
+class SortedArrayEntityTrie:
+    """
+    Entity trie backend for small entities, a sorted list of values searched with
+    bisect. Cheap to add to, but each addition re-sorts the whole list.
+    """
+
+    def __init__(self, words=()):
+        self.words = sorted(set(words))
+
+    def __contains__(self, word):
+        index = bisect.bisect_left(self.words, word)
+        return index < len(self.words) and self.words[index] == word
+
+    def __len__(self):
+        return len(self.words)
+
+    def has_keys_with_prefix(self, prefix):
+        index = bisect.bisect_left(self.words, prefix)
+        return index < len(self.words) and self.words[index].startswith(prefix)
+
+    def keys(self):
+        return list(self.words)
+
+    def add_words(self, words):
+        self.words = sorted(set(self.words).union(words))
+
+
+class MarisaEntityTrie:
+    """
+    Entity trie backend for large entities, a compact marisa-trie built in bulk.
+    The trie is immutable, so values added later go to a small SortedArrayEntityTrie
+    overlay, merged into a new trie once it holds more than an eighth of the trie's
+    values: adding values one populate at a time costs a rebuild now and then rather
+    than one per populate. It can be saved to and memory mapped from a snapshot file,
+    so that processes mapping the same file share its pages; the overlay is appended
+    to a delta file beside it, until it is merged.
+    """
+
+    def __init__(self, words=(), trie=None):
+        self.trie = trie if trie is not None else marisa_trie.Trie(words)
+        self.overlay = SortedArrayEntityTrie()
+        # the snapshot holding the trie, and the overlay values it doesn't hold yet
+        self.snapshot_path = None
+        self.unsaved_words = []
+
+    @classmethod
+    def mmap(cls, path):
+        entity_trie = cls(trie=marisa_trie.Trie().mmap(path))
+        entity_trie.snapshot_path = path
+        if os.path.exists(path + SNAPSHOT_DELTA_SUFFIX):
+            with open(path + SNAPSHOT_DELTA_SUFFIX, encoding="utf8") as file_handle:
+                words = [json.loads(line) for line in file_handle]
+            # a save stopped before removing the delta leaves words the trie holds
+            entity_trie.overlay.add_words(word for word in words
+                                          if word not in entity_trie.trie)
+        return entity_trie
+
+    def save(self, path):
+        """Save to path, only appending the values added since a save to the same path"""
+        if path == self.snapshot_path:
+            if self.unsaved_words:
+                with open(path + SNAPSHOT_DELTA_SUFFIX, "a", encoding="utf8") as file_handle:
+                    file_handle.write("".join(json.dumps(word) + "\n"
+                                              for word in self.unsaved_words))
+                self.unsaved_words = []
+            return
+        self.merge_overlay()
+        temp_path = path + ".tmp"
+        self.trie.save(temp_path)
+        # replace atomically, processes mapping the old file keep their pages
+        os.replace(temp_path, path)
+        if os.path.exists(path + SNAPSHOT_DELTA_SUFFIX):
+            os.remove(path + SNAPSHOT_DELTA_SUFFIX)
+        self.snapshot_path = path
+
+    def merge_overlay(self):
+        if len(self.overlay) > 0:
+            self.trie = marisa_trie.Trie(self.trie.keys() + self.overlay.keys())
+            self.overlay = SortedArrayEntityTrie()
+            # the snapshot no longer matches the trie
+            self.snapshot_path = None
+            self.unsaved_words = []
+
+    def __contains__(self, word):
+        return word in self.trie or word in self.overlay
+
+    def __len__(self):
+        return len(self.trie) + len(self.overlay)
+
+    def has_keys_with_prefix(self, prefix):
+        return (next(self.trie.iterkeys(prefix), None) is not None
+                or self.overlay.has_keys_with_prefix(prefix))
+
+    def keys(self):
+        return self.trie.keys() + self.overlay.keys()
+
+    def add_words(self, words):
+        new_words = [word for word in set(words)
+                     if word not in self.trie and word not in self.overlay]
+        if not new_words:
+            return
+        self.overlay.add_words(new_words)
+        self.unsaved_words.extend(new_words)
+        if len(self.overlay) > max(SORTED_ARRAY_MAX_SIZE, len(self.trie) // 8):
+            self.merge_overlay()
+
+
+def compile_regex_entities(regex_entities):
+    """
+    Compile a mapping of entity names to regexes, raising ValueError if it is not a
+    mapping or any regex fails to compile
+    """
+    if not isinstance(regex_entities, dict):
+        raise ValueError("Regex entities must map entity names to regexes")
+    try:
+        return {entity_name: re.compile(entity_regex)
+                for entity_name, entity_regex in regex_entities.items()}
+    except (re.error, TypeError) as exc:
+        raise ValueError("Invalid regex: {}".format(exc))
+
+
+def add_entity_words(entity_trie, words):
+    """
+    Add words to an entity trie, creating it if entity_trie is None, and return the
+    trie to use from now on. Entities start as a SortedArrayEntityTrie and move to a
+    MarisaEntityTrie once they hold more than SORTED_ARRAY_MAX_SIZE values.
+    """
+    if entity_trie is None:
+        entity_trie = SortedArrayEntityTrie()
+    if (isinstance(entity_trie, SortedArrayEntityTrie)
+            and len(entity_trie) + len(words) > SORTED_ARRAY_MAX_SIZE):
+        return MarisaEntityTrie(entity_trie.keys() + list(words))
+    entity_trie.add_words(words)
+    return entity_trie
+
+
+class MergedEntityIndex:
+    """
+    An index of the values of every cached entity, where each value maps to the list
+    of entity names that contain it. Names are kept in the order the entities were
+    first added, matching the iteration order of EntityFinder.dentity_tries.
+    Alongside, word_prefix_counts counts the values starting with each run of whole
+    words followed by a space, which is all the trie walk needs to know to stop.
+    """
 
     def __init__(self):
+        self.entity_names = {}
+        self.word_prefix_counts = defaultdict(int)
+        self.entity_order = {}
+        self.next_order = 0
+
+    def word_prefixes(self, word):
+        index = word.find(" ")
+        while index != -1:
+            yield word[:index + 1]
+            index = word.find(" ", index + 1)
+
+    def add_entity_values(self, entity_name, words):
+        if entity_name not in self.entity_order:
+            self.entity_order[entity_name] = self.next_order
+            self.next_order += 1
+        for word in words:
+            entity_names = self.entity_names.get(word)
+            if entity_names is None:
+                self.entity_names[word] = [entity_name]
+                for prefix in self.word_prefixes(word):
+                    self.word_prefix_counts[prefix] += 1
+            elif entity_name not in entity_names:
+                entity_names.append(entity_name)
+                entity_names.sort(key=self.entity_order.get)
+
+    def delete_entity_values(self, entity_name, words):
+        for word in words:
+            entity_names = self.entity_names.get(word)
+            if entity_names is None or entity_name not in entity_names:
+                continue
+            entity_names.remove(entity_name)
+            if not entity_names:
+                del self.entity_names[word]
+                for prefix in self.word_prefixes(word):
+                    self.word_prefix_counts[prefix] -= 1
+                    if self.word_prefix_counts[prefix] == 0:
+                        del self.word_prefix_counts[prefix]
+        self.entity_order.pop(entity_name, None)
+
+    def get(self, word):
+        return self.entity_names.get(word)
+
+    def has_keys_with_word_prefix(self, prefix):
+        """Only valid for a prefix of whole words followed by a space"""
+        return prefix in self.word_prefix_counts
+
+    def __len__(self):
+        return len(self.entity_names)
+
+
+class EntityFinder:
+
+    def __init__(self, merged_index=False, snapshot_dir=None, regex_time_budget=None):
         self.logger = _get_logger()
         self.dentity_tries = {}
         self.punctuation = string.punctuation
+        # Regexes are compiled once here, rather than on every check
         self.regex_entities = {}
+        self.regex_matcher = MultiRegexMatcher({}, regex_time_budget)
+        # None until built when use_merged_index is set, see build_merged_index
+        self.use_merged_index = merged_index
+        self.merged_index = MergedEntityIndex() if merged_index else None
+        # Optional directory where each entity trie is saved as a marisa-trie snapshot
+        self.snapshot_dir = snapshot_dir
+        # the entity names last written to, or read from, the snapshot manifest
+        self.manifest_entity_names = None
+        # the disabled regex entities last written to, or read from, the snapshot
+        self.snapshot_disabled_entities = []
+
+    def normalise_value(self, word):
+        return word.lower().strip(self.punctuation)
 
     def setup_cached_entity_values(self, entities):
         self.logger.info("Caching value entities")
         for entity_name, entity_values in entities.items():
-            # This can be done more concisely, expanded for clarity
-            updated_words = []
-            for word in entity_values:
-                lower = word.lower()
-                temp_word = lower.strip(self.punctuation)
-                updated_words.append(temp_word)
+            updated_words = [self.normalise_value(word) for word in entity_values]
+            self.add_entity_values(entity_name, updated_words)
+        if self.snapshot_dir is not None:
+            self.save_snapshot_manifest()
 
-            if(entity_name in self.dentity_tries):
-                for word in updated_words:
-                    self.dentity_tries[entity_name][word] = True
-            else:
-                # its a new trie
-                self.dentity_tries[entity_name] = datrie.Trie(string.printable)
-                for word in updated_words:
-                    self.dentity_tries[entity_name][word] = True
-
-            self.logger.info("updated " + entity_name + " trie, now contains "
-                             + str(len(self.dentity_tries[entity_name])))
-            self.logger.info("currently have " + str(len(self.dentity_tries)) + " entities")
+    def add_entity_values(self, entity_name, updated_words):
+        """
+        Add values already normalised with normalise_value to an entity. With a
+        snapshot_dir, call save_snapshot_manifest once done adding entities.
+        """
+        self.dentity_tries[entity_name] = add_entity_words(
+            self.dentity_tries.get(entity_name), updated_words)
+
+        if self.merged_index is not None:
+            self.merged_index.add_entity_values(entity_name, updated_words)
+        if self.snapshot_dir is not None:
+            self.save_snapshot(entity_name)
+
+        self.logger.info("updated %s trie, now contains %d", entity_name,
+                         len(self.dentity_tries[entity_name]))
+        self.logger.info("currently have %d entities", len(self.dentity_tries))
 
     def delete_cached_entity_values(self, entities):
         self.logger.info("Clearing value entities")
         for entity_name, entity_values in entities.items():
             if(entity_name in self.dentity_tries):
+                if self.merged_index is not None:
+                    self.merged_index.delete_entity_values(
+                        entity_name, self.dentity_tries[entity_name].keys())
                 del self.dentity_tries[entity_name]
+                if self.snapshot_dir is not None:
+                    self.delete_snapshot(entity_name)
+
+            self.logger.info("currently have %d entities", len(self.dentity_tries))
+        if self.snapshot_dir is not None:
+            self.save_snapshot_manifest()
+
+    def setup_cached_regex_entities(self, regex_entities):
+        """
+        regex_entities maps entity names to regexes, or to patterns compiled with
+        compile_regex_entities. Returns False, caching none of them, if any regex
+        fails to compile
+        """
+        self.logger.info("Caching regex entities")
+        try:
+            compiled_entities = compile_regex_entities(regex_entities)
+        except ValueError:
+            self.logger.warning("Invalid regex in setup_cached_regex_entities")
+            return False
+
+        self.regex_entities.update(compiled_entities)
+        self.regex_matcher.update(compiled_entities)
+        if self.snapshot_dir is not None:
+            self.save_regex_snapshot()
+        self.logger.info("currently have %d regex entities", len(self.regex_entities))
+        return True
+
+    def delete_cached_regex_entities(self, regex_entities):
+        """regex_entities can be a list of names, or a mapping with names as keys"""
+        self.logger.info("Clearing regex entities")
+        entity_names = [entity_name for entity_name in regex_entities
+                        if entity_name in self.regex_entities]
+        for entity_name in entity_names:
+            del self.regex_entities[entity_name]
+        self.regex_matcher.remove(entity_names)
+        if self.snapshot_dir is not None:
+            self.save_regex_snapshot()
+        self.logger.info("currently have %d regex entities", len(self.regex_entities))
+
+    def snapshot_path(self, entity_name):
+        file_name = urllib.parse.quote(entity_name, safe='') + ".marisa"
+        return os.path.join(self.snapshot_dir, file_name)
+
+    def save_snapshot(self, entity_name):
+        entity_trie = self.dentity_tries[entity_name]
+        if not isinstance(entity_trie, MarisaEntityTrie):
+            entity_trie = MarisaEntityTrie(entity_trie.keys())
+        entity_trie.save(self.snapshot_path(entity_name))
 
-            self.logger.info("currently have " + str(len(self.dentity_tries)) + " entities")
+    def delete_snapshot(self, entity_name):
+        path = self.snapshot_path(entity_name)
+        for file_path in [path, path + SNAPSHOT_DELTA_SUFFIX]:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def save_snapshot_manifest(self):
+        """Write the entity names, unless they are those the manifest already lists"""
+        entity_names = list(self.dentity_tries.keys())
+        if entity_names == self.manifest_entity_names:
+            return
+        path = os.path.join(self.snapshot_dir, SNAPSHOT_MANIFEST)
+        with open(path + ".tmp", "w") as file_handle:
+            json.dump(entity_names, file_handle)
+        os.replace(path + ".tmp", path)
+        self.manifest_entity_names = entity_names
+
+    def save_regex_snapshot(self):
+        path = os.path.join(self.snapshot_dir, REGEX_SNAPSHOT)
+        regex_patterns = {entity_name: compiled.pattern
+                          for entity_name, compiled in self.regex_entities.items()}
+        with open(path + ".tmp", "w") as file_handle:
+            json.dump(regex_patterns, file_handle)
+        os.replace(path + ".tmp", path)
+        self.save_disabled_regex_snapshot()
+        # The manifest marks the directory as holding a snapshot
+        if not os.path.exists(os.path.join(self.snapshot_dir, SNAPSHOT_MANIFEST)):
+            self.manifest_entity_names = None
+        self.save_snapshot_manifest()
+
+    def save_disabled_regex_snapshot(self):
+        disabled_entities = list(self.regex_matcher.disabled_entities)
+        path = os.path.join(self.snapshot_dir, DISABLED_REGEX_SNAPSHOT)
+        with open(path + ".tmp", "w") as file_handle:
+            json.dump(disabled_entities, file_handle)
+        os.replace(path + ".tmp", path)
+        self.snapshot_disabled_entities = disabled_entities
+
+    def load_snapshots(self):
+        """
+        Memory map the entity tries saved by an earlier process. A merged index is
+        built on the first check rather than here, as it reads every value.
+        """
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        manifest_path = os.path.join(self.snapshot_dir, SNAPSHOT_MANIFEST)
+        if not os.path.exists(manifest_path):
+            return
+        with open(manifest_path) as file_handle:
+            entity_names = json.load(file_handle)
+        self.manifest_entity_names = entity_names
+        for entity_name in entity_names:
+            path = self.snapshot_path(entity_name)
+            if not os.path.exists(path):
+                self.logger.warning("Snapshot missing for entity %s", entity_name)
+                continue
+            self.dentity_tries[entity_name] = MarisaEntityTrie.mmap(path)
+        if self.use_merged_index:
+            self.merged_index = None
+        self.logger.info("loaded %d entities from snapshots", len(self.dentity_tries))
+
+        regex_path = os.path.join(self.snapshot_dir, REGEX_SNAPSHOT)
+        if os.path.exists(regex_path):
+            with open(regex_path) as file_handle:
+                regex_patterns = json.load(file_handle)
+            compiled_entities = {entity_name: re.compile(entity_regex)
+                                 for entity_name, entity_regex in regex_patterns.items()}
+            self.regex_entities.update(compiled_entities)
+            self.regex_matcher.update(compiled_entities)
+            disabled_path = os.path.join(self.snapshot_dir, DISABLED_REGEX_SNAPSHOT)
+            if os.path.exists(disabled_path):
+                with open(disabled_path) as file_handle:
+                    self.regex_matcher.disable(json.load(file_handle))
+                self.snapshot_disabled_entities = list(self.regex_matcher.disabled_entities)
+            self.logger.info("loaded %d regex entities from snapshots",
+                             len(self.regex_entities))
+
+    def stats(self):
+        """Sizes of the cached entities, approximate_size counts value and regex characters"""
+        return {
+            'entities': len(self.dentity_tries),
+            'values': sum(len(entity_trie) for entity_trie in self.dentity_tries.values()),
+            'regex_entities': len(self.regex_entities),
+            'disabled_regex_entities': list(self.regex_matcher.disabled_entities),
+            'approximate_size': sum(len(word)
+                                    for entity_trie in self.dentity_tries.values()
+                                    for word in entity_trie.keys())
+            + sum(len(compiled.pattern) for compiled in self.regex_entities.values())
+        }
 
     def find_entity_values(self, conversation):
-        # Construct the list of values to match against
-        words_to_find_list = self.split_message(conversation)
+        # Walk the conversation word by word rather than enumerating every span
+        conversation_words = conversation.split()
         candidate_matches_list = defaultdict(list)
+        candidate_matches_regex = defaultdict(list)
 
         entity_matches = defaultdict(list)
         words_matched = set()
 
         # Examine value type entities
-        candidate_matches_list, words_matched = \
-            self.match_value_entities(candidate_matches_list, words_matched, words_to_find_list)
+        with STAGE_SECONDS.time("match_value_entities"):
+            candidate_matches_list, words_matched = self.match_value_entities(
+                candidate_matches_list, words_matched, conversation_words)
+
+        # Examine regex type entities, words already matched by a list entity are skipped
+        if len(self.regex_matcher) > 0:
+            with STAGE_SECONDS.time("match_regex_entities"):
+                candidate_matches_regex, words_matched = self.match_regex_entities(
+                    candidate_matches_regex, words_matched, conversation_words)
 
         # Ensure only the longest match is counted for list type entities
         for entity_name, candidate_words in candidate_matches_list.items():
@@ -68,20 +450,103 @@ class EntityFinder:
                     longest_word = candidate_word
             entity_matches[longest_word].append(entity_name)
 
+        # Include regex type entities
+        for entity_name, candidate_words in candidate_matches_regex.items():
+            for candidate_word in candidate_words:
+                entity_matches[candidate_word].append(entity_name)
+
         return entity_matches
 
-    def match_value_entities(self, candidate_matches_list, words_matched, words_to_find_list):
-        for word in words_to_find_list:
+    def match_regex_entities(self, candidate_matches_regex, words_matched, conversation_words):
+        for word in conversation_words:
             compare_word_original = word.strip(self.punctuation)
-            compare_word = compare_word_original.lower()
             if word not in words_matched:
-                match_found = False
-                for entity_name, entity_trie in self.dentity_tries.items():
-                    if compare_word in entity_trie:
-                        candidate_matches_list[entity_name].append(compare_word_original)
-                        match_found = True
-                if match_found:
+                matched_entities = self.regex_matcher.fullmatches(compare_word_original)
+                for entity_name in matched_entities:
+                    candidate_matches_regex[entity_name].append(compare_word_original)
+                if matched_entities:
                     words_matched.add(compare_word_original)
+        if (self.snapshot_dir is not None
+                and self.regex_matcher.disabled_entities != self.snapshot_disabled_entities):
+            # so that reloading the snapshot doesn't enable slow regexes again
+            try:
+                self.save_disabled_regex_snapshot()
+            except OSError:
+                self.logger.warning("Could not save the disabled regex entities")
+        return candidate_matches_regex, words_matched
+
+    def match_value_entities(self, candidate_matches_list, words_matched, conversation_words):
+        """
+        Single pass trie walk over the conversation. For each starting word the span
+        is extended one word at a time, and only the tries that still have keys with
+        the current prefix are kept, so a start position is abandoned as soon as no
+        entity value can match. Spans are visited in the same order as split_message.
+        """
+        if self.use_merged_index:
+            return self.match_merged_index(candidate_matches_list, words_matched,
+                                           conversation_words)
+
+        for start in range(0, len(conversation_words)):
+            live_tries = list(self.dentity_tries.items())
+            word = ""
+            for end in range(start, len(conversation_words)):
+                if end == start:
+                    word = conversation_words[start]
+                else:
+                    word = word + " " + conversation_words[end]
+                compare_word_original = word.strip(self.punctuation)
+                compare_word = compare_word_original.lower()
+                if word not in words_matched:
+                    match_found = False
+                    for entity_name, entity_trie in live_tries:
+                        if compare_word in entity_trie:
+                            candidate_matches_list[entity_name].append(compare_word_original)
+                            match_found = True
+                    if match_found:
+                        words_matched.add(compare_word_original)
+
+                # Any longer span starts with this one plus a space
+                prefix = word.lstrip(self.punctuation).lower() + " "
+                live_tries = [(entity_name, entity_trie)
+                              for entity_name, entity_trie in live_tries
+                              if entity_trie.has_keys_with_prefix(prefix)]
+                if not live_tries:
+                    break
+        return candidate_matches_list, words_matched
+
+    def build_merged_index(self):
+        merged_index = MergedEntityIndex()
+        for entity_name, entity_trie in self.dentity_tries.items():
+            merged_index.add_entity_values(entity_name, entity_trie.keys())
+        self.merged_index = merged_index
+        self.logger.info("built merged index of %d values", len(merged_index))
+
+    def match_merged_index(self, candidate_matches_list, words_matched, conversation_words):
+        """
+        Same walk as match_value_entities, but a single lookup in the merged index
+        yields every entity containing the span, whatever the number of entities.
+        """
+        if self.merged_index is None:
+            self.build_merged_index()
+        index = self.merged_index
+        for start in range(0, len(conversation_words)):
+            word = ""
+            for end in range(start, len(conversation_words)):
+                if end == start:
+                    word = conversation_words[start]
+                else:
+                    word = word + " " + conversation_words[end]
+                compare_word_original = word.strip(self.punctuation)
+                if word not in words_matched:
+                    entity_names = index.get(compare_word_original.lower())
+                    if entity_names:
+                        for entity_name in entity_names:
+                            candidate_matches_list[entity_name].append(compare_word_original)
+                        words_matched.add(compare_word_original)
+
+                prefix = word.lstrip(self.punctuation).lower() + " "
+                if not index.has_keys_with_word_prefix(prefix):
+                    break
         return candidate_matches_list, words_matched
 
     def split_message(self, conversation):
@@ -94,3 +559,75 @@ class EntityFinder:
                 search_words.append(" ".join(conversation_words[start:end + 1]))
 
         return search_words
+
+
+def span_enumeration_matches(finder, conversation):
+    """
+    The matcher find_entity_values replaced, probing every trie of finder for every
+    word of the conversation. Kept as the reference the tests and benchmarks compare
+    the trie walk against.
+    """
+    candidate_matches_list = defaultdict(list)
+    words_matched = set()
+    for word in finder.split_message(conversation):
+        compare_word_original = word.strip(finder.punctuation)
+        compare_word = compare_word_original.lower()
+        if word not in words_matched:
+            match_found = False
+            for entity_name, entity_trie in finder.dentity_tries.items():
+                if compare_word in entity_trie:
+                    candidate_matches_list[entity_name].append(compare_word_original)
+                    match_found = True
+            if match_found:
+                words_matched.add(compare_word_original)
+
+    entity_matches = defaultdict(list)
+    for entity_name, candidate_words in candidate_matches_list.items():
+        longest_word = candidate_words[0]
+        for candidate_word in candidate_words:
+            if len(candidate_word) > len(longest_word):
+                longest_word = candidate_word
+        entity_matches[longest_word].append(entity_name)
+    return entity_matches
+
+
+class EntityBulkLoader:
+    """
+    Loads entity values into an EntityFinder from newline delimited JSON, one
+    {"entity": name, "value": value} object per line. Values are normalised as each
+    line arrives, so only the normalised strings are held, and each entity's trie is
+    built once, in bulk, by finish.
+    """
+
+    def __init__(self, finder):
+        self.finder = finder
+        self.entity_values = defaultdict(list)
+        self.lines = 0
+        self.values = 0
+
+    def add_line(self, line):
+        """Raises ValueError if the line is not an entity value, blank lines are skipped"""
+        self.lines += 1
+        if not line.strip():
+            return
+        try:
+            item = json.loads(line)
+            entity_name = item["entity"]
+            value = item["value"]
+        except (ValueError, KeyError, TypeError):
+            raise ValueError("Invalid entity value on line {}".format(self.lines))
+        if not isinstance(entity_name, str) or not isinstance(value, str):
+            raise ValueError("Invalid entity value on line {}".format(self.lines))
+        self.entity_values[entity_name].append(self.finder.normalise_value(value))
+        self.values += 1
+
+    def finish(self):
+        """Build the tries, returns the number of entities and values loaded"""
+        entities = len(self.entity_values)
+        while self.entity_values:
+            # Drop each value list as soon as its trie is built
+            entity_name = next(iter(self.entity_values))
+            self.finder.add_entity_values(entity_name, self.entity_values.pop(entity_name))
+        if self.finder.snapshot_dir is not None:
+            self.finder.save_snapshot_manifest()
+        return {'entities': entities, 'values': self.values}
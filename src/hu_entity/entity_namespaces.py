@@ -0,0 +1,261 @@
+"""Keeps a separate cached EntityFinder for each namespace (bot) of the v2 API"""
+import contextlib
+import fcntl
+import logging
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+
+from hu_entity.entity_finder import EntityFinder, SNAPSHOT_MANIFEST
+
+# Namespace used by requests that do not supply one
+DEFAULT_NAMESPACE = "default"
+
+# The store version of the last change to a namespace's snapshot, in its directory
+VERSION_FILE = "version"
+
+# Lock file of a shared store, in the snapshot directory. Quoted namespace names
+# never contain a bare %, so it can't clash with one
+STORE_LOCK = "%lock"
+
+# Counts the changes to every namespace of a shared store, in the snapshot directory,
+# so a namespace deleted and created again never gets a version it had before
+STORE_VERSION = "%version"
+STORE_FILES = (STORE_LOCK, STORE_VERSION, STORE_VERSION + ".tmp")
+
+
+def _get_logger():
+    logger = logging.getLogger('hu_entity.entity_namespaces')
+    return logger
+
+
+class EntityNamespaces:
+    """
+    Maps each namespace to its own EntityFinder, so a check only scans the tries of
+    that namespace. When idle_timeout is set, namespaces unused for that many seconds
+    are dropped from memory. With a snapshot_dir, each namespace snapshots to its own
+    sub directory and is loaded back lazily on first use, so eviction loses nothing.
+    regex_time_budget is passed on to each finder's regex matcher.
+
+    With shared set, the snapshots are the store shared by several server processes.
+    Changes are made in writing blocks, one process at a time, on a finder freshly
+    mapped from the snapshots, and give the namespace the next version of the store.
+    Each process checks the version when it uses a namespace, and maps the snapshots
+    again when another process has changed them; entity tries are only ever memory
+    mapped, so the processes share their pages. Merged indexes are still built by each
+    process, on the first check of the namespace. Writing blocks, deletes and loads
+    wait for the store lock, so a server runs them outside its event loop, see
+    current_finder.
+    """
+
+    def __init__(self, merged_index=False, snapshot_dir=None, idle_timeout=None,
+                 regex_time_budget=None, shared=False):
+        self.logger = _get_logger()
+        if shared and snapshot_dir is None:
+            raise ValueError("A shared entity store needs a snapshot directory")
+        self.merged_index = merged_index
+        self.snapshot_dir = snapshot_dir
+        self.idle_timeout = idle_timeout
+        self.regex_time_budget = regex_time_budget
+        self.shared = shared
+        self.finders = {}
+        self.last_used = {}
+        # the version of each namespace when its finder was loaded, for a shared store
+        self.versions = {}
+        # whether the current thread holds the store lock
+        self.lock_state = threading.local()
+        self.last_eviction = time.monotonic()
+
+    def namespace_snapshot_dir(self, namespace):
+        """
+        The sub directory of namespace, its quoted name. A leading dot is quoted too,
+        so that no name is read as . or .. Raises ValueError for a name that would
+        still not be a sub directory of snapshot_dir.
+        """
+        if self.snapshot_dir is None:
+            return None
+        if not isinstance(namespace, str) or not namespace:
+            raise ValueError("Invalid namespace {!r}".format(namespace))
+        name = urllib.parse.quote(namespace, safe='')
+        if name.startswith("."):
+            name = "%2E" + name[1:]
+        namespace_dir = os.path.join(self.snapshot_dir, name)
+        if (os.path.dirname(os.path.realpath(namespace_dir))
+                != os.path.realpath(self.snapshot_dir)):
+            raise ValueError("Namespace {!r} is outside the snapshots".format(namespace))
+        return namespace_dir
+
+    def has_snapshot(self, namespace):
+        namespace_dir = self.namespace_snapshot_dir(namespace)
+        return (namespace_dir is not None
+                and os.path.exists(os.path.join(namespace_dir, SNAPSHOT_MANIFEST)))
+
+    def read_version(self, namespace):
+        """The version of the namespace's snapshot, None if it has none"""
+        try:
+            with open(os.path.join(self.namespace_snapshot_dir(namespace),
+                                   VERSION_FILE)) as file_handle:
+                return int(file_handle.read())
+        except (OSError, ValueError):
+            return None
+
+    def write_version(self, path, version):
+        with open(path + ".tmp", "w") as file_handle:
+            file_handle.write(str(version))
+        os.replace(path + ".tmp", path)
+
+    def bump_version(self, namespace):
+        """Give namespace the next version of the store, holding its lock"""
+        store_path = os.path.join(self.snapshot_dir, STORE_VERSION)
+        try:
+            with open(store_path) as file_handle:
+                version = int(file_handle.read()) + 1
+        except (OSError, ValueError):
+            version = 1
+        self.write_version(store_path, version)
+        self.write_version(os.path.join(self.namespace_snapshot_dir(namespace), VERSION_FILE),
+                           version)
+
+    @contextlib.contextmanager
+    def store_lock(self, operation):
+        """Holds the lock of a shared store, fcntl.LOCK_SH to read or LOCK_EX to change it"""
+        if not self.shared or getattr(self.lock_state, 'held', False):
+            yield
+            return
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        with open(os.path.join(self.snapshot_dir, STORE_LOCK), "a") as lock_file:
+            fcntl.flock(lock_file, operation)
+            self.lock_state.held = True
+            try:
+                yield
+            finally:
+                self.lock_state.held = False
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def drop_finder(self, namespace):
+        self.finders.pop(namespace, None)
+        self.last_used.pop(namespace, None)
+        self.versions.pop(namespace, None)
+
+    def current_finder(self, namespace):
+        """
+        The finder for namespace if it is loaded and, with a shared store, no other
+        process has changed it since. It takes no lock and loads no snapshot, so it
+        never blocks; None means get_finder has to be called.
+        """
+        self.evict_idle()
+        finder = self.finders.get(namespace)
+        if finder is not None and self.shared:
+            version = self.read_version(namespace)
+            if version != self.versions.get(namespace):
+                self.logger.info("Namespace %s changed by another process", namespace)
+                self.drop_finder(namespace)
+                finder = None
+        if finder is not None:
+            self.last_used[namespace] = time.monotonic()
+        return finder
+
+    def get_finder(self, namespace, create=False):
+        """
+        The finder for namespace, loading it from its snapshot if needed.
+        Returns None for an unknown namespace unless create is set.
+        """
+        finder = self.current_finder(namespace)
+        if finder is None:
+            finder, version = self.load_finder(namespace, create)
+            if finder is None:
+                return None
+            self.finders[namespace] = finder
+            self.versions[namespace] = version
+            self.last_used[namespace] = time.monotonic()
+        return finder
+
+    def load_finder(self, namespace, create):
+        """
+        A new finder for namespace, loaded from its snapshot, and the snapshot's
+        version, without keeping it; (None, None) for an unknown namespace unless
+        create is set
+        """
+        if not create and not self.has_snapshot(namespace):
+            return None, None
+        finder = EntityFinder(self.merged_index, self.namespace_snapshot_dir(namespace),
+                              self.regex_time_budget)
+        version = None
+        if finder.snapshot_dir is not None:
+            with self.store_lock(fcntl.LOCK_SH):
+                version = self.read_version(namespace)
+                finder.load_snapshots()
+        return finder, version
+
+    @contextlib.contextmanager
+    def writing(self, namespace, create=True):
+        """
+        The finder of namespace, to change within the block, None if it doesn't exist
+        and create is not set. With a shared store, the finder holds every change made
+        by the other processes, which wait for the block to end.
+        """
+        if not self.shared:
+            yield self.get_finder(namespace, create)
+            return
+        with self.store_lock(fcntl.LOCK_EX):
+            # changes a finder of its own, never served: the requests meanwhile use the
+            # finder loaded before, until the new version makes them map it again
+            finder, _ = self.load_finder(namespace, create)
+            try:
+                yield finder
+            finally:
+                if finder is not None:
+                    self.bump_version(namespace)
+                    # mapped again on next use, rather than keeping the tries built here
+                    self.drop_finder(namespace)
+
+    def snapshot_namespaces(self):
+        if self.snapshot_dir is None or not os.path.isdir(self.snapshot_dir):
+            return []
+        return [urllib.parse.unquote(name) for name in os.listdir(self.snapshot_dir)
+                if name not in STORE_FILES]
+
+    def load_snapshots(self):
+        """Load every namespace that has a snapshot, rather than on first use"""
+        for namespace in self.snapshot_namespaces():
+            if self.has_snapshot(namespace):
+                self.get_finder(namespace)
+
+    def delete_namespace(self, namespace):
+        self.drop_finder(namespace)
+        namespace_dir = self.namespace_snapshot_dir(namespace)
+        if namespace_dir is not None:
+            with self.store_lock(fcntl.LOCK_EX):
+                shutil.rmtree(namespace_dir, ignore_errors=True)
+
+    def reset(self):
+        """Delete every namespace, including those only held in snapshots"""
+        namespaces = set(self.finders.keys())
+        namespaces.update(self.snapshot_namespaces())
+        for namespace in namespaces:
+            self.delete_namespace(namespace)
+
+    def evict_idle(self):
+        if self.idle_timeout is None:
+            return
+        now = time.monotonic()
+        # Checking every namespace on every request is wasteful, so only check
+        # a few times per idle period
+        if now - self.last_eviction < self.idle_timeout / 4:
+            return
+        self.last_eviction = now
+        for namespace, last_used in list(self.last_used.items()):
+            if now - last_used > self.idle_timeout:
+                self.logger.info("Evicting idle namespace %s", namespace)
+                self.drop_finder(namespace)
+
+    def stats(self):
+        now = time.monotonic()
+        data = {}
+        for namespace, finder in list(self.finders.items()):
+            namespace_stats = finder.stats()
+            namespace_stats['idle_seconds'] = now - self.last_used.get(namespace, now)
+            data[namespace] = namespace_stats
+        return data
@@ -5,6 +5,9 @@ import sre_constants
 import logging
 from collections import defaultdict
 
+from hu_entity.log_utils import Truncated
+from hu_entity.regex_matcher import MultiRegexMatcher
+
 
 def _get_logger():
     logger = logging.getLogger('hu_entity.entity_finder')
@@ -18,9 +21,13 @@ class LegacyEntityFinder:
         self.entity_tries = {}
         self.punctuation = string.punctuation
         self.regex_entities = {}
+        self.regex_matcher = MultiRegexMatcher({})
+        # Rough measure of the memory held, in characters of values and regexes
+        self.approximate_size = 0
 
     def setup_entity_values(self, entities):
-        self.logger.info("Setting up value entities'%s'", entities)
+        self.logger.info("Setting up %d value entities", len(entities))
+        self.logger.debug("Value entities '%s'", Truncated(entities))
         for entity_name, entity_values in entities.items():
             # This can be done more concisely, expanded for clarity
             updated_words = []
@@ -30,15 +37,18 @@ class LegacyEntityFinder:
                 updated_words.append(temp_word)
 
             self.entity_tries[entity_name] = marisa_trie.Trie(updated_words)
+            self.approximate_size += sum(len(word) for word in updated_words)
 
     def setup_regex_entities(self, regex_entities):
-        self.logger.info("Setting up regex entities '%s'", regex_entities)
+        self.logger.info("Setting up %d regex entities", len(regex_entities))
+        self.logger.debug("Regex entities '%s'", Truncated(regex_entities))
         regex_good = True
         try:
             for entity_name, entity_regex in regex_entities.items():
                 self.logger.debug("Compiling regex entity '%s'", entity_regex)
                 compiled = re.compile(entity_regex)
                 self.regex_entities[entity_name] = compiled
+                self.approximate_size += len(entity_regex)
         except re.error:
             self.logger.warn("Caught re.error in setup_regex_entities")
             regex_good = False
@@ -48,6 +58,7 @@ class LegacyEntityFinder:
         except Exception:
             self.logger.warn("Caught Exception in setup_regex_entities")
             regex_good = False
+        self.regex_matcher = MultiRegexMatcher(self.regex_entities)
         return regex_good
 
     def find_entity_values(self, conversation):
@@ -87,12 +98,10 @@ class LegacyEntityFinder:
         for word in words_to_find_regex:
             compare_word_original = word.strip(self.punctuation)
             if word not in words_matched:
-                match_found = False
-                for entity_name, compiled in self.regex_entities.items():
-                    if compiled.fullmatch(compare_word_original):
-                        candidate_matches_regex[entity_name].append(compare_word_original)
-                        match_found = True
-                if match_found:
+                matched_entities = self.regex_matcher.fullmatches(compare_word_original)
+                for entity_name in matched_entities:
+                    candidate_matches_regex[entity_name].append(compare_word_original)
+                if matched_entities:
                     words_matched.add(compare_word_original)
         return candidate_matches_regex, words_matched
 
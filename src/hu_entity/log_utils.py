@@ -0,0 +1,95 @@
+"""Helpers keeping logging cheap on the request path"""
+import asyncio
+import logging
+import os
+import random
+import reprlib
+import weakref
+
+from aiohttp import web
+
+# Characters of a payload kept when it is logged
+LOG_PAYLOAD_LIMIT = 200
+
+# A random draw for the task serving each request, which SampleFilter compares with
+# its rate, so that the records of a request are all kept or all dropped
+_request_draws = weakref.WeakKeyDictionary()
+
+# Only the first few items of large payloads are looked at
+PAYLOAD_REPR = reprlib.Repr()
+PAYLOAD_REPR.maxlevel = 3
+PAYLOAD_REPR.maxdict = 10
+PAYLOAD_REPR.maxlist = 10
+PAYLOAD_REPR.maxstring = LOG_PAYLOAD_LIMIT
+PAYLOAD_REPR.maxother = LOG_PAYLOAD_LIMIT
+
+
+class Truncated:
+    """
+    Log argument formatting value to at most limit characters, only when the record
+    is emitted. Containers are formatted with reprlib, so a large entity payload is
+    not walked in full.
+    """
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit=LOG_PAYLOAD_LIMIT):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        if isinstance(self.value, str):
+            text = self.value
+        else:
+            text = PAYLOAD_REPR.repr(self.value)
+        if len(text) > self.limit:
+            return "{}... ({} characters)".format(text[:self.limit], len(text))
+        return text
+
+
+def _current_task():
+    """The asyncio task running, None outside of one or outside of the event loop"""
+    try:
+        if hasattr(asyncio, "current_task"):
+            return asyncio.current_task()
+        # Python 3.6
+        return asyncio.Task.current_task()
+    except RuntimeError:
+        return None
+
+
+@web.middleware
+async def log_sample_middleware(request, handler):
+    """Draw once whether SampleFilter keeps the INFO records of the request"""
+    task = _current_task()
+    if task is not None:
+        _request_draws[task] = random.random()
+    return await handler(request)
+
+
+class SampleFilter(logging.Filter):
+    """
+    Lets through a fraction, rate, of the INFO records, which are mostly logged once
+    or more per request. With log_sample_middleware, the records logged by a
+    request's handler are kept or dropped together; records logged elsewhere, as in
+    worker threads, are sampled one by one. Records of every other level pass. By
+    default the rate is read from ERS_LOG_SAMPLE_RATE, 1 keeps every record.
+    """
+
+    def __init__(self, rate=None):
+        super().__init__()
+        if rate is None:
+            rate_str = os.environ.get("ERS_LOG_SAMPLE_RATE", "")
+            try:
+                rate = float(rate_str)
+            except ValueError:
+                rate = 1.0
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno != logging.INFO or self.rate >= 1.0:
+            return True
+        task = _current_task()
+        draw = _request_draws.get(task) if task is not None else None
+        if draw is None:
+            draw = random.random()
+        return draw < self.rate
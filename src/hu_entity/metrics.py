@@ -0,0 +1,204 @@
+"""Prometheus style metrics, cheap enough to leave on in production"""
+import bisect
+import threading
+import time
+
+from aiohttp import web
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join("{}=\"{}\"".format(name, escape_label_value(value))
+                          for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class ShardedMetric:
+    """
+    A metric updated from several threads without locking. Each thread updates its
+    own shard, a dict from label values to a list of numbers, and the shards are only
+    summed when the metric is rendered. The lock is only taken the first time a
+    thread updates the metric, and when rendering.
+    """
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.local = threading.local()
+        self.shards = []
+        self.shards_lock = threading.Lock()
+
+    def shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.shards_lock:
+                self.shards.append(shard)
+        return shard
+
+    def totals(self):
+        """Label values mapped to the numbers summed over every shard"""
+        with self.shards_lock:
+            shards = list(self.shards)
+        totals = {}
+        for shard in shards:
+            # copying a dict is atomic, its owning thread may be adding to it
+            for label_values, numbers in shard.copy().items():
+                total = totals.get(label_values)
+                if total is None:
+                    totals[label_values] = list(numbers)
+                else:
+                    for index, number in enumerate(numbers):
+                        total[index] += number
+        return totals
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.metric_type)]
+        for label_values, numbers in sorted(self.totals().items()):
+            lines.extend(self.render_sample(label_values, numbers))
+        return lines
+
+
+class Counter(ShardedMetric):
+    metric_type = "counter"
+
+    def inc(self, *label_values):
+        shard = self.shard()
+        numbers = shard.get(label_values)
+        if numbers is None:
+            shard[label_values] = [1]
+        else:
+            numbers[0] += 1
+
+    def render_sample(self, label_values, numbers):
+        return ["{}{} {}".format(self.name, format_labels(self.label_names, label_values),
+                                 format_value(numbers[0]))]
+
+
+class Timer:
+    """Context manager observing the time spent in its block"""
+    __slots__ = ("histogram", "label_values", "start")
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+class Histogram(ShardedMetric):
+    """
+    Counts observations in buckets. The numbers kept for each label values are the
+    count of each bucket (not cumulative), the count above the last bucket, and the sum.
+    """
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        shard = self.shard()
+        numbers = shard.get(label_values)
+        if numbers is None:
+            numbers = shard[label_values] = [0] * (len(self.buckets) + 2)
+        numbers[bisect.bisect_left(self.buckets, value)] += 1
+        numbers[-1] += value
+
+    def time(self, *label_values):
+        return Timer(self, label_values)
+
+    def render_sample(self, label_values, numbers):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), numbers):
+            cumulative += count
+            labels = format_labels(self.label_names, label_values,
+                                   [("le", format_value(bound))])
+            lines.append("{}_bucket{} {}".format(self.name, labels, cumulative))
+        labels = format_labels(self.label_names, label_values)
+        lines.append("{}_sum{} {}".format(self.name, labels, format_value(numbers[-1])))
+        lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+        return lines
+
+
+class Gauge:
+    """Values read when the metrics are rendered, samples are (label values, value)"""
+
+    def __init__(self, name, documentation, label_names=(), samples=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.samples = samples
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} gauge".format(self.name)]
+        for label_values, value in self.samples:
+            lines.append("{}{} {}".format(self.name, format_labels(self.label_names,
+                                                                   label_values),
+                                          format_value(value)))
+        return lines
+
+
+def render(metrics):
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+REQUESTS = Counter("ers_requests_total", "Requests handled, by route and status",
+                   ("route", "status"))
+REQUEST_SECONDS = Histogram("ers_request_duration_seconds", "Request latency, by route",
+                            ("route",))
+# Spent inside a request, only measured in this process (not in ERS_WORKER_MODE=process
+# worker processes)
+STAGE_SECONDS = Histogram("ers_stage_duration_seconds",
+                          "Time spent in each stage of handling requests", ("stage",))
+
+REQUEST_METRICS = [REQUESTS, REQUEST_SECONDS, STAGE_SECONDS]
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as exc:
+        status = exc.status
+        raise
+    finally:
+        # unmatched paths share one label, so that scanners can't add label values
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "unmatched"
+        REQUESTS.inc(route, status)
+        REQUEST_SECONDS.observe(time.perf_counter() - start, route)
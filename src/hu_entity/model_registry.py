@@ -0,0 +1,314 @@
+"""Hosts the spaCy models of several languages in one process"""
+import gc
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from hu_entity.spacy_wrapper import SpacyWrapper
+
+
+def _get_logger():
+    logger = logging.getLogger('hu_entity.model_registry')
+    return logger
+
+
+def load_custom_entities(path):
+    """Custom entities written by ModelRegistry, {} for no path"""
+    if path is None:
+        return {}
+    with open(path, encoding="utf8") as file_handle:
+        return json.load(file_handle)
+
+
+def resident_bytes():
+    """Resident memory of this process, 0 where it can't be read"""
+    try:
+        with open("/proc/self/statm") as file_handle:
+            return int(file_handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+class ModelRegistry:
+    """
+    A SpacyWrapper per language, created and initialized on first use, so one process
+    can serve every language. Each model's size is estimated as the growth of the
+    resident memory while it loads. With a memory_budget (bytes), loading a model
+    unloads the least recently used others until the estimates fit in the budget.
+    get may be called from several worker threads: a model is loaded by the first
+    thread needing it, without holding up calls for other languages.
+    Custom entities, {key: [phrase, ...]}, are kept in a registry of their own, versioned
+    by custom_entities_version, and given to every model loaded now or later, including
+    by a reload. With a custom_entities_dir each version is also written to a file there,
+    named after the process and the version, for process pool workers to read; a file
+    is removed once a newer version is written and the calls holding it, through
+    hold_config, are done. A reload builds the new models beside the ones in
+    use, with build, and swaps them in at once, with swap; calls already holding an old
+    model finish with it.
+    """
+
+    def __init__(self, minimal_ers_mode=False, default_language='en', result_cache=None,
+                 memory_budget=None, preload_languages=(), custom_entities_dir=None):
+        self.logger = _get_logger()
+        self.minimal_ers_mode = minimal_ers_mode
+        self.default_language = default_language
+        self.result_cache = result_cache
+        self.memory_budget = memory_budget
+        self.preload_languages = list(preload_languages)
+        # each key's phrases, in a dict used as an ordered set
+        self.custom_entities = {}
+        self.custom_entities_version = 0
+        self.custom_entities_dir = custom_entities_dir
+        self.custom_entities_path = None
+        # the number of process pool calls in flight that read each custom entities file
+        self.custom_entities_readers = {}
+        # counts the swaps, for the result keys of process mode, whose models are
+        # not held here
+        self.generation = 0
+        self.wrappers = OrderedDict()
+        self.sizes = {}
+        self.lock = threading.Lock()
+        self.load_locks = {}
+
+    def config(self, minimal_ers_mode=None, default_language=None):
+        """What a worker process needs to build an identical registry"""
+        if minimal_ers_mode is None:
+            minimal_ers_mode = self.minimal_ers_mode
+        return (minimal_ers_mode, default_language or self.default_language,
+                self.memory_budget, self.custom_entities_version, self.custom_entities_path)
+
+    def hold_config(self, minimal_ers_mode=None, default_language=None):
+        """The config for a process pool call, whose file is kept until release_config"""
+        with self.lock:
+            config = self.config(minimal_ers_mode, default_language)
+            path = config[4]
+            if path is not None:
+                self.custom_entities_readers[path] = self.custom_entities_readers.get(path, 0) + 1
+        return config
+
+    def release_config(self, config):
+        """After the call given config is done, remove its file if it is no longer current"""
+        path = config[4]
+        if path is None:
+            return
+        with self.lock:
+            readers = self.custom_entities_readers.pop(path) - 1
+            if readers:
+                self.custom_entities_readers[path] = readers
+            elif path != self.custom_entities_path:
+                self.remove_custom_entities_file(path)
+
+    def remove_custom_entities_file(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            self.logger.warning("Could not remove custom entities file %s", path)
+
+    def languages_to_preload(self, default_language=None):
+        default_language = default_language or self.default_language
+        return [default_language] + [language for language in self.preload_languages
+                                     if language != default_language]
+
+    def add_entity(self, entity, key):
+        """Add a custom entity to the loaded models, and to those loaded later"""
+        return self.register_entities({key: [entity]})
+
+    def copy_custom_entities(self):
+        return {key: list(phrases) for key, phrases in self.custom_entities.items()}
+
+    def new_custom_entities_version(self):
+        """After a change to the custom entities, call with the lock held"""
+        self.custom_entities_version += 1
+        if self.result_cache is not None:
+            self.result_cache.clear()
+        if self.custom_entities_dir is not None:
+            # several server processes may share the directory
+            path = os.path.join(self.custom_entities_dir, "custom_entities-{}-{}.json".format(
+                os.getpid(), self.custom_entities_version))
+            with open(path + ".tmp", "w", encoding="utf8") as file_handle:
+                json.dump(self.copy_custom_entities(), file_handle)
+            os.replace(path + ".tmp", path)
+            old_path, self.custom_entities_path = self.custom_entities_path, path
+            # else removed by release_config, once the calls reading it are done
+            if old_path is not None and old_path not in self.custom_entities_readers:
+                self.remove_custom_entities_file(old_path)
+        return self.custom_entities_version
+
+    def register_entities(self, entities):
+        """
+        Add custom entities, {key: [phrase, ...]}, to the loaded models, and to those
+        loaded later. Each model compiles the new phrases of a key at once. Returns
+        the new version of the custom entities.
+        """
+        added = {}
+        with self.lock:
+            for key, phrases in entities.items():
+                known_phrases = self.custom_entities.setdefault(key, {})
+                new_phrases = [phrase for phrase in dict.fromkeys(phrases)
+                               if phrase not in known_phrases]
+                known_phrases.update(dict.fromkeys(new_phrases))
+                if new_phrases:
+                    added[key] = new_phrases
+            version = self.new_custom_entities_version()
+            wrappers = list(self.wrappers.values())
+        for wrapper in wrappers:
+            wrapper.add_entities(added, version)
+        return version
+
+    def unregister_entities(self, entities):
+        """
+        Remove custom entities, {key: [phrase, ...]}, all of a key's phrases when its
+        list is empty. The models rebuild their matcher. Returns the new version.
+        """
+        with self.lock:
+            for key, phrases in entities.items():
+                known_phrases = self.custom_entities.get(key)
+                if known_phrases is None:
+                    continue
+                for phrase in phrases:
+                    known_phrases.pop(phrase, None)
+                if not phrases or not known_phrases:
+                    del self.custom_entities[key]
+            version = self.new_custom_entities_version()
+            custom_entities = self.copy_custom_entities()
+            wrappers = list(self.wrappers.values())
+        for wrapper in wrappers:
+            wrapper.set_custom_entities(custom_entities, version)
+        return version
+
+    def set_custom_entities(self, custom_entities, version):
+        """Replace every custom entity, as a process pool worker does to follow its parent"""
+        with self.lock:
+            self.custom_entities = {key: dict.fromkeys(phrases)
+                                    for key, phrases in custom_entities.items()}
+            self.custom_entities_version = version
+            wrappers = list(self.wrappers.values())
+        for wrapper in wrappers:
+            wrapper.set_custom_entities(custom_entities, version)
+
+    def update_custom_entities(self, wrapper):
+        """Give wrapper the custom entities changed while it loaded, call with the lock held"""
+        if wrapper.custom_entities_version != self.custom_entities_version:
+            wrapper.set_custom_entities(self.copy_custom_entities(),
+                                        self.custom_entities_version)
+
+    def custom_entities_stats(self):
+        with self.lock:
+            return {'version': self.custom_entities_version,
+                    'entities': {key: len(phrases)
+                                 for key, phrases in self.custom_entities.items()}}
+
+    def create_wrapper(self, minimal_ers_mode, language):
+        with self.lock:
+            custom_entities = self.copy_custom_entities()
+            version = self.custom_entities_version
+        wrapper = SpacyWrapper(minimal_ers_mode, language, self.result_cache)
+        wrapper.custom_entities = custom_entities
+        wrapper.custom_entities_version = version
+        wrapper.initialize()
+        return wrapper
+
+    def get(self, language=None):
+        language = language or self.default_language
+        with self.lock:
+            wrapper = self.wrappers.get(language)
+            if wrapper is not None:
+                self.wrappers.move_to_end(language)
+                return wrapper
+            load_lock = self.load_locks.setdefault(language, threading.Lock())
+
+        with load_lock:
+            with self.lock:
+                wrapper = self.wrappers.get(language)
+            if wrapper is None:
+                wrapper = self.load(language)
+        return wrapper
+
+    def load(self, language):
+        self.logger.warning("Loading model for language %s", language)
+        minimal_ers_mode = self.minimal_ers_mode
+        before = resident_bytes()
+        wrapper = self.create_wrapper(minimal_ers_mode, language)
+        size = max(resident_bytes() - before, 0)
+        self.logger.warning("Loaded model for language %s, about %d MB", language,
+                            size // 1000000)
+        evicted = []
+        with self.lock:
+            self.update_custom_entities(wrapper)
+            # a reload while loading makes this model out of date, use it only this once
+            if minimal_ers_mode == self.minimal_ers_mode and language not in self.wrappers:
+                self.wrappers[language] = wrapper
+                self.sizes[language] = size
+                evicted = self.evict(language)
+        if evicted:
+            # spaCy models hold reference cycles
+            gc.collect()
+        return wrapper
+
+    def evict(self, keep_language):
+        """Unload least recently used models over the budget, call with the lock held"""
+        evicted = []
+        if self.memory_budget is None:
+            return evicted
+        for language in list(self.wrappers.keys()):
+            if sum(self.sizes.values()) <= self.memory_budget:
+                break
+            if language == keep_language:
+                continue
+            self.logger.warning("Unloading model for language %s, over the memory budget",
+                                language)
+            del self.wrappers[language]
+            del self.sizes[language]
+            evicted.append(language)
+        return evicted
+
+    def build(self, minimal_ers_mode, default_language):
+        """
+        Load, with the new settings, the default language and every language loaded or
+        preloaded now, without changing the models in use. Returns the new wrappers and
+        their sizes, for swap. The old and new models are in memory together meanwhile.
+        """
+        languages = self.languages_to_preload(default_language)
+        languages += [language for language in self.loaded_languages()
+                      if language not in languages]
+        wrappers = OrderedDict()
+        sizes = {}
+        for language in languages:
+            self.logger.warning("Loading model for language %s, for a reload", language)
+            before = resident_bytes()
+            wrappers[language] = self.create_wrapper(minimal_ers_mode, language)
+            sizes[language] = max(resident_bytes() - before, 0)
+        return wrappers, sizes
+
+    def swap(self, minimal_ers_mode, default_language, wrappers=None, sizes=None):
+        """Replace every model at once, missing languages load on their next call"""
+        with self.lock:
+            for wrapper in (wrappers or {}).values():
+                self.update_custom_entities(wrapper)
+            self.minimal_ers_mode = minimal_ers_mode
+            self.default_language = default_language
+            self.wrappers = OrderedDict(wrappers or {})
+            self.sizes = dict(sizes or {})
+            self.generation += 1
+            self.evict(default_language)
+        if self.result_cache is not None:
+            self.result_cache.clear()
+        gc.collect()
+
+    def reload(self, minimal_ers_mode, default_language):
+        """Load the models with the new settings, then swap them in"""
+        wrappers, sizes = self.build(minimal_ers_mode, default_language)
+        self.swap(minimal_ers_mode, default_language, wrappers, sizes)
+
+    def result_key(self, language, *args):
+        """Cache key for a result, including everything that the result depends on"""
+        language = language or self.default_language
+        wrapper = self.wrappers.get(language)
+        model_version = wrapper.model_version if wrapper is not None else 0
+        return (language, self.minimal_ers_mode, self.generation, model_version,
+                self.custom_entities_version) + args
+
+    def loaded_languages(self):
+        return list(self.wrappers.keys())
@@ -0,0 +1,117 @@
+"""Serves from several forked worker processes sharing the models of their parent"""
+import gc
+import logging
+import os
+import random
+import signal
+import socket
+import time
+
+# A worker exiting sooner than this after starting is replaced after this delay
+RESPAWN_DELAY = 1.0
+
+# Without gc.freeze, the oldest generation's threshold in the workers, the number of
+# middle generation collections between full collections: so many that none runs
+NO_FREEZE_FULL_COLLECTION_THRESHOLD = 2 ** 30
+
+
+def _get_logger():
+    logger = logging.getLogger('hu_entity.prefork')
+    return logger
+
+
+def freeze_heap():
+    """
+    Collect garbage, then move every object allocated so far to a generation the
+    collector no longer visits, so that collections in the workers don't write to,
+    and copy, the memory pages they share with the parent; numpy weight buffers are
+    never touched by the collector. gc.freeze needs Python 3.7. Before that the
+    collected objects are all in the oldest generation, which only full collections
+    visit, so the workers inherit a threshold that stops those: cyclic garbage that
+    outlives two collections in a worker is then only freed by an explicit
+    gc.collect.
+    """
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+    else:
+        threshold0, threshold1, _ = gc.get_threshold()
+        gc.set_threshold(threshold0, threshold1, NO_FREEZE_FULL_COLLECTION_THRESHOLD)
+
+
+def listen(port, host="0.0.0.0", backlog=128):
+    """A listening socket, opened by the parent and accepted on by every worker"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class PreforkServer:
+    """
+    Forks processes workers, each calling run_worker() to serve until it exits, and
+    forks a new one whenever a worker dies. Everything loaded before serve is called
+    is shared copy-on-write by the workers. No thread or event loop may be started
+    before the fork. SIGTERM and SIGINT are passed on to the workers, and serve
+    returns once they have all exited.
+    """
+
+    def __init__(self, processes, run_worker):
+        self.logger = _get_logger()
+        self.processes = processes
+        self.run_worker = run_worker
+        # pid to start time
+        self.children = {}
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                # the workers would otherwise all draw the same numbers
+                random.seed()
+                self.run_worker()
+                exit_code = 0
+            except Exception:
+                self.logger.exception("Worker process %d failed", os.getpid())
+            finally:
+                os._exit(exit_code)
+        self.children[pid] = time.monotonic()
+        return pid
+
+    def stop(self, signum, _frame):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def serve(self):
+        freeze_heap()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.processes):
+            self.spawn()
+        self.logger.warning("Started %d worker processes", self.processes)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            self.logger.warning("Worker process %d exited with status %d, replacing it",
+                                pid, status)
+            if time.monotonic() - started < RESPAWN_DELAY:
+                time.sleep(RESPAWN_DELAY)
+            self.spawn()
+        self.logger.warning("Worker processes stopped")
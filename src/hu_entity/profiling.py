@@ -0,0 +1,161 @@
+"""Opt-in profiling of selected request handlers over a time window"""
+import cProfile
+import enum
+import io
+import logging
+import pstats
+import time
+import tracemalloc
+from collections import Counter
+
+from aiohttp import web
+
+# Lines of report returned for a window
+REPORT_LIMIT = 40
+
+# Frames kept for each traced allocation
+TRACEMALLOC_FRAMES = 10
+
+
+def _get_logger():
+    logger = logging.getLogger('hu_entity.profiling')
+    return logger
+
+
+class ProfileMode(enum.Enum):
+    CPROFILE = "cprofile"
+    TRACEMALLOC = "tracemalloc"
+
+
+class RequestProfiler:
+    """
+    Profiles the requests of the selected handlers (by method name, all of them when
+    none are given) for duration seconds. With CPROFILE a single cProfile.Profile is
+    enabled while any selected request is running on the event loop; spaCy calls run
+    in the worker pool are not seen. With TRACEMALLOC the memory allocated by each
+    selected request is summed by source line, from snapshots taken before and after
+    it; requests running concurrently are attributed each other's allocations.
+    When no window is active the middleware only tests one attribute.
+    """
+
+    def __init__(self):
+        self.logger = _get_logger()
+        self.active = False
+        self.mode = None
+        self.handlers = None
+        self.end_time = None
+        self.requests = 0
+        self.running = 0
+        self.profile = None
+        self.allocations = None
+        self.report = None
+
+    def start(self, mode, handlers=None, duration=60.0):
+        """Start a window, discarding any earlier report"""
+        self.stop()
+        self.mode = mode
+        self.handlers = set(handlers) if handlers else None
+        self.end_time = time.monotonic() + duration
+        self.requests = 0
+        self.running = 0
+        self.report = None
+        if mode == ProfileMode.CPROFILE:
+            self.profile = cProfile.Profile()
+        else:
+            self.allocations = Counter()
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.active = True
+        self.logger.warning("Profiling %s with %s for %ss", handlers or "all handlers",
+                            mode.value, duration)
+
+    def stop(self):
+        """End the window, if there is one, and build its report"""
+        if not self.active:
+            return
+        self.active = False
+        if self.mode == ProfileMode.CPROFILE:
+            if self.running:
+                self.profile.disable()
+            self.report = self.cprofile_report()
+            self.profile = None
+        else:
+            tracemalloc.stop()
+            self.report = self.tracemalloc_report()
+            self.allocations = None
+        self.logger.warning("Profiling stopped after %d requests", self.requests)
+
+    def cprofile_report(self):
+        if self.requests == 0:
+            return "No requests profiled\n"
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats("cumulative").print_stats(REPORT_LIMIT)
+        return stream.getvalue()
+
+    def tracemalloc_report(self):
+        lines = ["Allocated by {} requests, by source line:".format(self.requests)]
+        for frame, size in self.allocations.most_common(REPORT_LIMIT):
+            lines.append("{:>12} B  {}".format(size, frame))
+        return "\n".join(lines) + "\n"
+
+    def status(self):
+        if self.active and time.monotonic() > self.end_time:
+            self.stop()
+        data = {'active': self.active,
+                'mode': self.mode.value if self.mode else None,
+                'handlers': sorted(self.handlers) if self.handlers else None,
+                'requests': self.requests}
+        if self.active:
+            data['seconds_left'] = self.end_time - time.monotonic()
+        else:
+            data['report'] = self.report
+        return data
+
+    def selects(self, handler_name):
+        if time.monotonic() > self.end_time:
+            self.stop()
+            return False
+        return self.handlers is None or handler_name in self.handlers
+
+    async def profile_request(self, request, handler):
+        self.requests += 1
+        if self.mode == ProfileMode.CPROFILE:
+            return await self.cprofile_request(request, handler)
+        return await self.tracemalloc_request(request, handler)
+
+    async def cprofile_request(self, request, handler):
+        profile = self.profile
+        if self.running == 0:
+            profile.enable()
+        self.running += 1
+        try:
+            return await handler(request)
+        finally:
+            # the window may have been stopped, and the profile disabled, meanwhile
+            if profile is self.profile:
+                self.running -= 1
+                if self.running == 0:
+                    profile.disable()
+
+    async def tracemalloc_request(self, request, handler):
+        before = tracemalloc.take_snapshot()
+        try:
+            return await handler(request)
+        finally:
+            if self.active and self.mode == ProfileMode.TRACEMALLOC:
+                after = tracemalloc.take_snapshot()
+                for stat in after.compare_to(before, "lineno"):
+                    if stat.size_diff > 0:
+                        self.allocations[str(stat.traceback[0])] += stat.size_diff
+
+
+def profiling_middleware(profiler):
+    @web.middleware
+    async def middleware(request, handler):
+        if not profiler.active:
+            return await handler(request)
+        route_handler = request.match_info.handler
+        if not profiler.selects(getattr(route_handler, "__name__", None)):
+            return await handler(request)
+        return await profiler.profile_request(request, handler)
+    return middleware
@@ -0,0 +1,151 @@
+"""Matches a word against many regex entities in one pass"""
+import logging
+import re
+import time
+
+# Flags every pattern gets when compiled without inline flags
+DEFAULT_FLAGS = re.compile("").flags
+
+
+def _get_logger():
+    logger = logging.getLogger('hu_entity.regex_matcher')
+    return logger
+
+
+class MultiRegexMatcher:
+    """
+    Finds which regex entities fully match a word. Patterns without capture groups
+    or inline flags are joined into one alternation with a named group per entity,
+    so a word that matches none of them (the usual case) costs a single fullmatch.
+    The alternation reports the first entity that matches, and only the entities
+    after it are then tried on their own. Patterns that can't be joined safely
+    (back references are numbered per pattern, inline flags would apply to every
+    alternative) are always tried on their own.
+
+    With a time_budget (seconds), every fullmatch is timed. A pattern matched on
+    its own that takes longer than that is disabled. When the alternation does, the
+    pattern to blame is not known, and the word is not matched again to find it:
+    the patterns are matched on their own from the next word on, until the slow one
+    is caught and disabled. A pattern with catastrophic backtracking stalls a request
+    or two, rather than every request.
+    """
+
+    def __init__(self, regex_entities, time_budget=None):
+        """regex_entities maps entity names to compiled patterns"""
+        self.logger = _get_logger()
+        self.regex_entities = dict(regex_entities)
+        self.time_budget = time_budget
+        self.disabled_entities = []
+        # set once the alternation went over the time budget
+        self.split = False
+        self.clock = time.perf_counter
+        self.build()
+
+    def build(self):
+        self.entity_names = list(self.regex_entities.keys())
+        self.patterns = list(self.regex_entities.values())
+        self.combined_indexes = []
+        self.separate_indexes = []
+        for index, compiled in enumerate(self.patterns):
+            if compiled.groups == 0 and compiled.flags == DEFAULT_FLAGS and not self.split:
+                self.combined_indexes.append(index)
+            else:
+                self.separate_indexes.append(index)
+
+        # A lone pattern is quicker to match without the named group around it
+        if len(self.combined_indexes) < 2:
+            self.separate_indexes = sorted(self.separate_indexes + self.combined_indexes)
+            self.combined_indexes = []
+
+        self.combined = None
+        if self.combined_indexes:
+            self.combined = re.compile("|".join(
+                "(?P<e{}>{})".format(index, self.patterns[index].pattern)
+                for index in self.combined_indexes))
+
+    def update(self, regex_entities):
+        """Add or replace regex entities, re-enabling any that were disabled"""
+        for entity_name in regex_entities:
+            if entity_name in self.disabled_entities:
+                self.disabled_entities.remove(entity_name)
+        self.regex_entities.update(regex_entities)
+        self.split = False
+        self.build()
+
+    def disable(self, entity_names):
+        """Stop matching regex entities, until they are supplied again with update"""
+        for entity_name in entity_names:
+            if self.regex_entities.pop(entity_name, None) is not None:
+                self.disabled_entities.append(entity_name)
+        self.build()
+
+    def remove(self, entity_names):
+        for entity_name in entity_names:
+            self.regex_entities.pop(entity_name, None)
+            if entity_name in self.disabled_entities:
+                self.disabled_entities.remove(entity_name)
+        self.build()
+
+    def fullmatches(self, word):
+        """Names of the regex entities fully matching word, in entity order"""
+        if self.time_budget is None:
+            return self.match(word)
+        was_split = self.split
+        slow_indexes = []
+        matched_entities = self.match(word, slow_indexes)
+        if slow_indexes:
+            slow_entities = [self.entity_names[index] for index in slow_indexes]
+            for entity_name in slow_entities:
+                self.logger.warning("Regex entity %s took over %ss to match, disabling it",
+                                    entity_name, self.time_budget)
+            if was_split:
+                # found what made the alternation slow, join the others again
+                self.split = False
+            self.disable(slow_entities)
+        elif self.split and not was_split:
+            self.build()
+        return matched_entities
+
+    def timed_fullmatch(self, index, word, slow_indexes):
+        """fullmatch of a pattern, adding index to slow_indexes when over the budget"""
+        if slow_indexes is None:
+            return self.patterns[index].fullmatch(word)
+        start = self.clock()
+        match = self.patterns[index].fullmatch(word)
+        if self.clock() - start > self.time_budget:
+            slow_indexes.append(index)
+        return match
+
+    def combined_fullmatch(self, word, timed):
+        if not timed:
+            return self.combined.fullmatch(word)
+        start = self.clock()
+        match = self.combined.fullmatch(word)
+        if self.clock() - start > self.time_budget:
+            self.logger.warning("Regex entities took over %ss to match, matching them "
+                                "one by one to find the slow one", self.time_budget)
+            self.split = True
+        return match
+
+    def match(self, word, slow_indexes=None):
+        """Names of the entities matching, timing each fullmatch with slow_indexes"""
+        matched_indexes = []
+        if self.combined is not None:
+            match = self.combined_fullmatch(word, slow_indexes is not None)
+            if match is not None:
+                first_index = int(match.lastgroup[1:])
+                matched_indexes.append(first_index)
+                for index in self.combined_indexes:
+                    if index > first_index and self.timed_fullmatch(index, word, slow_indexes):
+                        matched_indexes.append(index)
+            elif not self.separate_indexes:
+                return matched_indexes
+        for index in self.separate_indexes:
+            if self.timed_fullmatch(index, word, slow_indexes):
+                matched_indexes.append(index)
+        if len(matched_indexes) > 1:
+            matched_indexes.sort()
+        return [self.entity_names[index] for index in matched_indexes]
+
+    def __len__(self):
+        return len(self.patterns)
@@ -0,0 +1,80 @@
+"""A bounded LRU cache for request results"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LruCache:
+    """
+    Least recently used cache holding entries up to a total weight of max_size,
+    each optionally expiring ttl seconds after it was added. By default every entry
+    weighs 1, weigh(value) can give larger values a larger share of the cache.
+    get returns None on a miss. The event loop reads and fills it, while models
+    clear it from worker threads when their results change, so every method holds a
+    lock.
+    """
+
+    def __init__(self, max_size=1024, ttl=None, weigh=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.weigh = weigh
+        self.weight = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expiry, weight = entry
+            if expiry is not None and expiry < time.monotonic():
+                del self.entries[key]
+                self.weight -= weight
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        weight = self.weigh(value) if self.weigh else 1
+        if weight > self.max_size:
+            return
+        expiry = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.weight -= old_entry[2]
+            self.entries[key] = (value, expiry, weight)
+            self.weight += weight
+            while self.weight > self.max_size:
+                _, (_, _, evicted_weight) = self.entries.popitem(last=False)
+                self.weight -= evicted_weight
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.weight = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'weight': self.weight,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
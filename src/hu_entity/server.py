@@ -1,11 +1,14 @@
 """The named entity recognizer service"""
 import argparse
+import asyncio
+import json
 import logging
 import logging.config
+import math
 import os
 import pathlib
-
-from memory_profiler import profile
+import tempfile
+import time
 
 import aiohttp
 import traceback
@@ -13,10 +16,22 @@ from aiohttp import web
 
 import yaml
 
-from hu_entity.spacy_wrapper import SpacyWrapper, StopWordSize
-from hu_entity.named_entity import dumps_custom
-from hu_entity.entity_finder import EntityFinder
+from hu_entity.spacy_wrapper import StopWordSize, DEFAULT_BATCH_SIZE, MODEL_LOOKUP
+from hu_entity.named_entity import ENTITY_CATEGORY_MAPPING
+from hu_entity.entity_finder import EntityBulkLoader, EntityFinder, compile_regex_entities
+from hu_entity.entity_namespaces import EntityNamespaces, DEFAULT_NAMESPACE
 from hu_entity.legacy_entity_finder import LegacyEntityFinder
+from hu_entity.log_utils import Truncated, log_sample_middleware
+from hu_entity import metrics
+from hu_entity.metrics import STAGE_SECONDS, Gauge, metrics_middleware
+from hu_entity.model_registry import ModelRegistry
+from hu_entity.prefork import PreforkServer, listen
+from hu_entity.profiling import RequestProfiler, ProfileMode, profiling_middleware
+from hu_entity.result_cache import LruCache
+from hu_entity.serialization import (available_backends, get_dumps, digest,
+                                     entities_to_dicts, entity_batch_to_dicts, matches_to_dict)
+from hu_entity import worker_pool
+from hu_entity.worker_pool import SpacyWorkerPool, WorkerMode, WorkerPoolFull, WorkerPoolTimeout
 
 
 def _get_logger():
@@ -25,26 +40,215 @@ def _get_logger():
 
 
 class EntityRecognizerServer:
-    def __init__(self, minimal_ers_mode=False, language='en'):
+    def __init__(self, minimal_ers_mode=False, language='en', merged_entity_index=False,
+                 worker_mode=WorkerMode.THREAD, workers=2, max_pending=64,
+                 request_timeout=30.0, result_cache_size=1024, result_cache_ttl=None,
+                 finder_cache_chars=10000000, entity_snapshot_dir=None,
+                 namespace_idle_timeout=None, regex_time_budget=0.1, model_memory_budget=None,
+                 preload_languages=(), shared_entity_store=False, json_backend=None,
+                 metrics_namespaces=20, server_processes=1):
         self.logger = _get_logger()
-        self.spacy_wrapper = SpacyWrapper(minimal_ers_mode, language)
-        self.finder = EntityFinder()
+        # serialises every JSON response to bytes
+        self.dumps = get_dumps(json_backend)
+        self.result_cache = LruCache(result_cache_size, result_cache_ttl)
+        # Compiled /findentities finders, bounded by the characters of the values and
+        # regexes they hold, not by their memory, which is several times larger
+        self.finder_cache = LruCache(finder_cache_chars,
+                                     weigh=lambda finder: finder.approximate_size)
+        # process pool workers read the custom entities from files
+        custom_entities_dir = (tempfile.mkdtemp(prefix="ers-custom-entities-")
+                               if worker_mode is WorkerMode.PROCESS else None)
+        self.models = ModelRegistry(minimal_ers_mode, language, self.result_cache,
+                                    model_memory_budget, preload_languages,
+                                    custom_entities_dir)
+        self.namespaces = EntityNamespaces(merged_entity_index, entity_snapshot_dir,
+                                           namespace_idle_timeout, regex_time_budget or None,
+                                           shared_entity_store)
+        self.worker_pool = SpacyWorkerPool(self.models, worker_mode, workers,
+                                           max_pending, request_timeout)
+        self.profiler = RequestProfiler()
+        self.reload_task = None
+        # created on first use, in the event loop serving the requests
+        self.custom_entities_lock = None
+        self.reload_state = {'state': 'idle'}
+        # namespaces given their own gauge samples, the others are summed into one
+        self.metrics_namespaces = metrics_namespaces
+        # with several processes, state changed by one request only reaches one of them
+        self.server_processes = server_processes
 
     def initialize(self):
-        self.spacy_wrapper.initialize()
+        self.worker_pool.initialize()
+
+    def preload(self):
+        """
+        Load the models and the namespace snapshots without starting the worker pool,
+        in a parent process before it forks its workers
+        """
+        for language in self.models.languages_to_preload():
+            self.models.get(language)
+        self.namespaces.load_snapshots()
+
+    def request_language(self, lang):
+        """The language asked for by a request, HTTP 400 if there is no model for it"""
+        if lang is None:
+            return self.models.default_language
+        if not isinstance(lang, str) or lang not in MODEL_LOOKUP:
+            self.logger.warning("Request for unavailable language '%s'", Truncated(lang))
+            raise web.HTTPBadRequest(reason="Language {} is not available".format(lang))
+        return lang
+
+    def request_namespace(self, namespace):
+        """The /v2 namespace named by a request, HTTP 400 if it can't name a namespace"""
+        if namespace is None:
+            return DEFAULT_NAMESPACE
+        if not isinstance(namespace, str) or namespace in ("", ".", ".."):
+            self.logger.warning("Request for invalid namespace '%s'", Truncated(namespace))
+            raise web.HTTPBadRequest(reason="Invalid namespace")
+        return namespace
+
+    async def run_spacy(self, function, *args, language=None):
+        """Run a spaCy call in the worker pool, mapping pool errors to HTTP 503"""
+        try:
+            return await self.worker_pool.run(function, *args, language=language)
+        except WorkerPoolFull:
+            self.logger.warning("Worker pool full, rejecting request")
+            raise web.HTTPServiceUnavailable(reason="Too many requests in progress")
+        except WorkerPoolTimeout:
+            self.logger.warning("Worker pool request timed out")
+            raise web.HTTPServiceUnavailable(reason="Request timed out")
+
+    async def run_spacy_cached(self, key, function, *args, language=None):
+        """run_spacy, returning the cached result for key when there is one"""
+        result = self.result_cache.get(key)
+        if result is None:
+            result = await self.run_spacy(function, *args, language=language)
+            self.result_cache.put(key, result)
+        return result
+
+    async def run_spacy_batch_cached(self, keys, texts, function, *args, language=None):
+        """
+        run_spacy for a batch call taking a list of texts, only sending the texts
+        without a cached result to the worker pool. Returns results in order.
+        """
+        results = [self.result_cache.get(key) for key in keys]
+        missing = [text for text, result in zip(texts, results) if result is None]
+        if missing:
+            computed = iter(await self.run_spacy(function, missing, *args, language=language))
+            for index, result in enumerate(results):
+                if result is None:
+                    results[index] = next(computed)
+                    self.result_cache.put(keys[index], results[index])
+        return results
+
+    async def read_json(self, request):
+        text = await request.text()
+        with STAGE_SECONDS.time("parse_json"):
+            return json.loads(text)
+
+    def json_response(self, data, status=200):
+        with STAGE_SECONDS.time("serialise"):
+            body = self.dumps(data)
+        return web.Response(body=body, status=status, content_type='application/json',
+                            charset='utf-8')
+
+    def check_single_process(self, action):
+        """HTTP 409 for changes that would only reach the one process serving them"""
+        if self.server_processes > 1:
+            self.logger.warning("Refusing to %s in one of %d server processes", action,
+                                self.server_processes)
+            raise web.HTTPConflict(
+                reason="Cannot {} with ERS_SERVER_PROCESSES above 1, restart the server "
+                       "instead".format(action))
 
     async def reload(self, request):
         """
-        allows loading a spacy model with, e.g. a different language
+        allows loading a spacy model with, e.g. a different default language.
+        The models are loaded in the background, requests are served by the old
+        models until then; poll GET /reload for the progress
         """
-        data = await request.json()
+        self.check_single_process("reload")
+        data = await self.read_json(request)
         if 'lang' not in data or 'minimal_ers_mode' not in data:
             raise web.HTTPBadRequest()
         size = data['minimal_ers_mode']
-        lang = data['lang']
-        self.spacy_wrapper.reload_model(minimal_ers_mode=size,
-                                        language=lang)
-        return web.Response()
+        lang = self.request_language(data['lang'])
+        if self.reload_task is not None and not self.reload_task.done():
+            raise web.HTTPConflict(reason="A reload is already in progress")
+        self.reload_state = {'state': 'loading', 'lang': lang, 'minimal_ers_mode': size,
+                             'started': time.time()}
+        self.reload_task = asyncio.ensure_future(self.run_reload(size, lang))
+        return self.json_response(self.reload_status(), status=202)
+
+    async def run_reload(self, size, lang):
+        self.logger.warning("Reloading with language %s, minimal mode %s", lang, size)
+        try:
+            await self.worker_pool.reload(size, lang)
+        except Exception as exc:
+            self.logger.exception("Reload failed, keeping the current models")
+            self.reload_state.update(state='failed', error=str(exc), finished=time.time())
+        else:
+            self.logger.warning("Reload done")
+            self.reload_state.update(state='done', finished=time.time())
+
+    def reload_status(self):
+        status = dict(self.reload_state)
+        status['loaded_languages'] = self.models.loaded_languages()
+        return status
+
+    async def handle_reload_status(self, request):
+        '''
+        state of the last reload: idle, loading, done or failed
+        '''
+        return self.json_response(self.reload_status())
+
+    async def read_custom_entities(self, request):
+        """The custom entities of the body, {key: [phrase, ...]}, HTTP 400 if invalid"""
+        body = await self.read_json(request) if request.can_read_body else {}
+        entities = body.get('entities') if isinstance(body, dict) else None
+        if not isinstance(entities, dict):
+            raise web.HTTPBadRequest(reason="No entities found")
+        for key, phrases in entities.items():
+            if key not in ENTITY_CATEGORY_MAPPING:
+                raise web.HTTPBadRequest(reason="Unknown entity key {}".format(key))
+            if (not isinstance(phrases, list)
+                    or not all(isinstance(phrase, str) for phrase in phrases)):
+                raise web.HTTPBadRequest(reason="Invalid phrases for {}".format(key))
+        return entities
+
+    async def change_custom_entities(self, change, entities):
+        """Apply a change to the custom entities in a thread, one change at a time"""
+        if self.custom_entities_lock is None:
+            self.custom_entities_lock = asyncio.Lock()
+        async with self.custom_entities_lock:
+            # compiling many phrases takes a while
+            await asyncio.get_event_loop().run_in_executor(None, change, entities)
+        return self.json_response(self.models.custom_entities_stats())
+
+    async def register_custom_entities(self, request):
+        '''
+        adds phrases recognised by /ner as entities of a key of ENTITY_CATEGORY_MAPPING,
+        in every language, e.g. {"entities": {"custom_entity": ["Acme Widgets"]}}.
+        They are kept by a /reload
+        '''
+        self.check_single_process("change custom entities")
+        entities = await self.read_custom_entities(request)
+        self.logger.info("Registering custom entities %s", Truncated(entities))
+        return await self.change_custom_entities(self.models.register_entities, entities)
+
+    async def unregister_custom_entities(self, request):
+        '''
+        removes the phrases of custom entities, every phrase of a key given an empty list
+        '''
+        self.check_single_process("change custom entities")
+        entities = await self.read_custom_entities(request)
+        self.logger.info("Unregistering custom entities %s", Truncated(entities))
+        return await self.change_custom_entities(self.models.unregister_entities, entities)
+
+    async def custom_entities_stats(self, request):
+        '''
+        version of the custom entities, and the number of phrases of each key
+        '''
+        return self.json_response(self.models.custom_entities_stats())
 
     async def health(self, request):
         """
@@ -63,10 +267,42 @@ class EntityRecognizerServer:
                 'Invalid NER request, no q query parameter, url was %s', url)
             raise web.HTTPBadRequest()
 
-        self.logger.info("Entity request '%s'", q)
-        entities, _ = self.spacy_wrapper.get_entities(q)
-        self.logger.info("Entities found: '%s'", entities)
-        resp = web.json_response(entities, dumps=dumps_custom)
+        language = self.request_language(url.query.get('lang'))
+        self.logger.info("Entity request '%s'", Truncated(q))
+        key = self.models.result_key(language, 'ner', q)
+        entities = await self.run_spacy_cached(key, worker_pool.get_entities, q,
+                                               language=language)
+        self.logger.debug("Entities found: '%s'", Truncated(entities))
+        resp = self.json_response(entities_to_dicts(entities))
+        return resp
+
+    async def handle_ner_batch(self, request):
+        '''
+        returns a list of recognized entities for each text in the request body
+        '''
+        url = request.url
+        if not request.can_read_body:
+            self.logger.warning(
+                'Invalid NER batch request, no body found, url was %s', url)
+            raise web.HTTPBadRequest
+
+        body = await self.read_json(request)
+        if not isinstance(body, dict):
+            self.logger.warning('Invalid NER batch request, url was %s', url)
+            raise web.HTTPBadRequest()
+        texts = body.get('q')
+        batch_size = body.get('batch_size', DEFAULT_BATCH_SIZE)
+        language = self.request_language(body.get('lang'))
+        if (not isinstance(texts, list) or not all(isinstance(text, str) for text in texts)
+                or not valid_batch_size(batch_size)):
+            self.logger.warning('Invalid NER batch request, url was %s', url)
+            raise web.HTTPBadRequest()
+
+        self.logger.info("Entity batch request for %d texts", len(texts))
+        keys = [self.models.result_key(language, 'ner', q) for q in texts]
+        entities = await self.run_spacy_batch_cached(keys, texts, worker_pool.get_entities_batch,
+                                                     batch_size, language=language)
+        resp = self.json_response(entity_batch_to_dicts(entities))
         return resp
 
     async def handle_tokenize(self, request):
@@ -92,28 +328,75 @@ class EntityRecognizerServer:
                 'Invalid NER request, no q query parameter, url was %s', url)
             raise web.HTTPBadRequest()
 
-        self.logger.info("Tokenize request '%s'", q)
-        tokens = self.spacy_wrapper.tokenize(q, filter_ents, sw_size)
-        self.logger.info("Tokens found: '%s'", tokens)
-        resp = web.json_response(tokens)
+        language = self.request_language(url.query.get('lang'))
+        self.logger.info("Tokenize request '%s'", Truncated(q))
+        key = self.models.result_key(language, 'tokenize', q, filter_ents, sw_size)
+        tokens = await self.run_spacy_cached(key, worker_pool.tokenize, q, filter_ents, sw_size,
+                                             language=language)
+        self.logger.debug("Tokens found: '%s'", Truncated(tokens))
+        resp = self.json_response(tokens)
         return resp
 
-    async def handle_findentities(self, request):
+    async def handle_tokenize_batch(self, request):
         '''
-        the function returns the supplied chat text with the entities identified
+        tokenizes every sample in the request body with shared options, streaming
+        the tokens back as newline delimited JSON, one line per sample in order
         '''
         url = request.url
         if not request.can_read_body:
             self.logger.warning(
-                'Invalid NER findentities request, no body found, url was %s',
-                url)
+                'Invalid tokenize batch request, no body found, url was %s', url)
             raise web.HTTPBadRequest
 
-        body = await request.json()
+        body = await self.read_json(request)
+        if not isinstance(body, dict):
+            self.logger.warning('Invalid tokenize batch request, url was %s', url)
+            raise web.HTTPBadRequest()
+        samples = body.get('q')
+        filter_ents = body.get('filter_ents', False)
+        sw_size_str = body.get('sw_size', StopWordSize.SMALL.name)
+        batch_size = body.get('batch_size', DEFAULT_BATCH_SIZE)
+        if (not isinstance(samples, list) or not all(isinstance(q, str) for q in samples)
+                or not isinstance(filter_ents, bool) or not valid_batch_size(batch_size)
+                or str(sw_size_str).upper() not in StopWordSize.__members__):
+            self.logger.warning('Invalid tokenize batch request, url was %s', url)
+            raise web.HTTPBadRequest()
+        sw_size = StopWordSize[sw_size_str.upper()]
+        language = self.request_language(body.get('lang'))
+        self.logger.info("Tokenize batch request for %d samples", len(samples))
+
+        def tokenize_samples(batch):
+            keys = [self.models.result_key(language, 'tokenize', q, filter_ents, sw_size)
+                    for q in batch]
+            return self.run_spacy_batch_cached(keys, batch, worker_pool.tokenize_batch,
+                                               filter_ents, sw_size, batch_size,
+                                               language=language)
+
+        # Run the first batch before starting the response, so that a full worker
+        # pool can still be reported with a 503 status
+        tokens = await tokenize_samples(samples[:batch_size])
+        resp = web.StreamResponse()
+        resp.content_type = 'application/x-ndjson'
+        await resp.prepare(request)
+        for start in range(batch_size, len(samples) + batch_size, batch_size):
+            await resp.write(b"".join(self.dumps(sample_tokens) + b"\n"
+                                      for sample_tokens in tokens))
+            if start < len(samples):
+                tokens = await tokenize_samples(samples[start:start + batch_size])
+        await resp.write_eof()
+        return resp
 
+    async def cache_stats(self, request):
+        """
+        hit, miss and eviction counters of the /ner and /tokenize result cache
+        and the /findentities compiled finder cache
+        """
+        data = {'result_cache': self.result_cache.stats(),
+                'finder_cache': self.finder_cache.stats()}
+        return self.json_response(data)
+
+    def build_legacy_finder(self, body):
         self.logger.info("Find entity request, populating entities")
-        # Note that this version does not persist entity values,
-        # so use a temporary instance of the finder
         legacy_finder = LegacyEntityFinder()
         regex_good = True
         if 'entities' in body:
@@ -128,15 +411,58 @@ class EntityRecognizerServer:
             raise web.HTTPBadRequest(reason='Invalid regex found')
         else:
             self.logger.info('No regex submitted or regex compiled')
+        return legacy_finder
+
+    async def handle_findentities(self, request):
+        '''
+        the function returns the supplied chat text with the entities identified
+        '''
+        url = request.url
+        if not request.can_read_body:
+            self.logger.warning(
+                'Invalid NER findentities request, no body found, url was %s',
+                url)
+            raise web.HTTPBadRequest
+
+        body = await self.read_json(request)
+
+        # Note that this version does not persist entity values, but bots send the
+        # same entities on every turn, so reuse the finder built for an identical payload.
+        # The key serialises the whole payload, so every request pays for it: with
+        # orjson a few ms for 100000 values, a small part of building the finder
+        finder_key = digest([body.get('entities'), body.get('regex_entities')])
+        legacy_finder = self.finder_cache.get(finder_key)
+        if legacy_finder is None:
+            legacy_finder = self.build_legacy_finder(body)
+            self.finder_cache.put(finder_key, legacy_finder)
+        else:
+            self.logger.info("Find entity request, using cached entities")
 
         self.logger.info("Find entity request, matching entities")
         values = legacy_finder.find_entity_values(body['conversation'])
-        data = {'conversation': body['conversation'], 'entities': values}
-        resp = web.json_response(data)
+        data = {'conversation': body['conversation'], 'entities': matches_to_dict(values)}
+        resp = self.json_response(data)
 
         return resp
 
-    @profile
+    async def in_store_executor(self, function, *args):
+        """
+        Call function, in a thread when the entity store is shared, as it waits for
+        the store lock while another process changes the store, and changes made
+        under the lock hold it for as long as the tries take to build
+        """
+        if not self.namespaces.shared:
+            return function(*args)
+        return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+    def populate_namespace(self, namespace, entities, regex_entities):
+        with self.namespaces.writing(namespace) as finder:
+            if regex_entities is not None:
+                finder.setup_cached_regex_entities(regex_entities)
+            if entities is not None:
+                self.logger.info("List entities found")
+                finder.setup_cached_entity_values(entities)
+
     async def populate_entities(self, request):
         '''
         populates the entity tries
@@ -148,17 +474,69 @@ class EntityRecognizerServer:
                 url)
             raise web.HTTPBadRequest
 
-        body = await request.json()
+        body = await self.read_json(request)
 
-        self.logger.info("Populating entities")
-        if 'entities' in body:
-            self.logger.info("List entities found")
-            self.finder.setup_cached_entity_values(body['entities'])
+        namespace = self.request_namespace(body.get('namespace'))
+        self.logger.info("Populating entities for namespace %s", namespace)
+        # Check the regexes before opening the namespace, so an invalid one leaves it
+        # untouched, or not created
+        regex_entities = None
         if 'regex_entities' in body:
-            self.logger.info("Regex entities supplied but ignored")
+            self.logger.info("Regex entities found")
+            try:
+                regex_entities = compile_regex_entities(body['regex_entities'])
+            except ValueError:
+                self.logger.info('Invalid regex found in populate_entities')
+                raise web.HTTPBadRequest(reason='Invalid regex found')
+        await self.in_store_executor(self.populate_namespace, namespace,
+                                     body.get('entities'), regex_entities)
 
         return web.Response()
 
+    async def populate_entities_stream(self, request):
+        '''
+        bulk loads entity values from a newline delimited JSON body, one
+        {"entity": name, "value": value} per line, reading the body as it arrives.
+        The namespace is given in the query string.
+        '''
+        if not request.can_read_body:
+            self.logger.warning(
+                'Invalid populate_entities_stream request, no body found, url was %s',
+                request.url)
+            raise web.HTTPBadRequest
+
+        namespace = self.request_namespace(request.query.get('namespace'))
+        self.logger.info("Bulk loading entities for namespace %s", namespace)
+        # a finder of no namespace normalises the values, the namespace is only
+        # created by finish_bulk_load, once the whole body is valid
+        loader = EntityBulkLoader(EntityFinder())
+        try:
+            async for line in request.content:
+                loader.add_line(line)
+        except ValueError as exc:
+            self.logger.warning("Bulk load rejected: %s", exc)
+            raise web.HTTPBadRequest(reason=str(exc))
+
+        # the body is read before the namespace is locked
+        data = await self.in_store_executor(self.finish_bulk_load, namespace, loader)
+        self.logger.info("Bulk loaded %d values into %d entities",
+                         data['values'], data['entities'])
+        return self.json_response(data)
+
+    def finish_bulk_load(self, namespace, loader):
+        with self.namespaces.writing(namespace) as finder:
+            loader.finder = finder
+            return loader.finish()
+
+    def delete_namespace_entities(self, namespace, body):
+        with self.namespaces.writing(namespace, create=False) as finder:
+            if 'entities' in body and finder is not None:
+                self.logger.info("List entities found")
+                finder.delete_cached_entity_values(body['entities'])
+            if 'regex_entities' in body and finder is not None:
+                self.logger.info("Regex entities found")
+                finder.delete_cached_regex_entities(body['regex_entities'])
+
     async def delete_entities(self, request):
         '''
         populates the entity tries
@@ -170,14 +548,11 @@ class EntityRecognizerServer:
                 url)
             raise web.HTTPBadRequest
 
-        body = await request.json()
+        body = await self.read_json(request)
 
-        self.logger.info("Populating entities")
-        if 'entities' in body:
-            self.logger.info("List entities found")
-            self.finder.delete_cached_entity_values(body['entities'])
-        if 'regex_entities' in body:
-            self.logger.info("Regex entities supplied but ignored")
+        namespace = self.request_namespace(body.get('namespace'))
+        self.logger.info("Deleting entities for namespace %s", namespace)
+        await self.in_store_executor(self.delete_namespace_entities, namespace, body)
 
         return web.Response()
 
@@ -192,19 +567,124 @@ class EntityRecognizerServer:
                 url)
             raise web.HTTPBadRequest
 
-        body = await request.json()
+        body = await self.read_json(request)
 
-        self.logger.info("entity_check request, matching entities")
-        values = self.finder.find_entity_values(body['conversation'])
-        data = {'conversation': body['conversation'], 'entities': values}
-        resp = web.json_response(data)
+        namespace = self.request_namespace(body.get('namespace'))
+        self.logger.info("entity_check request, matching entities for namespace %s", namespace)
+        finder = self.namespaces.current_finder(namespace)
+        if finder is None:
+            finder = await self.in_store_executor(self.namespaces.get_finder, namespace)
+        if finder is None:
+            values = {}
+        else:
+            values = finder.find_entity_values(body['conversation'])
+        data = {'conversation': body['conversation'], 'entities': matches_to_dict(values)}
+        resp = self.json_response(data)
 
         return resp
 
     async def reset(self, request):
-        self.finder = EntityFinder()
+        '''
+        clears the entities of the namespace in the body, or of every namespace
+        '''
+        body = await self.read_json(request) if request.can_read_body else {}
+        if 'namespace' in body:
+            namespace = self.request_namespace(body['namespace'])
+            self.logger.info("Resetting namespace %s", namespace)
+            await self.in_store_executor(self.namespaces.delete_namespace, namespace)
+        else:
+            self.logger.info("Resetting all namespaces")
+            await self.in_store_executor(self.namespaces.reset)
         return web.Response()
 
+    async def namespace_stats(self, request):
+        '''
+        number and size of the cached entities of each namespace held in memory
+        '''
+        return self.json_response(self.namespaces.stats())
+
+    def namespace_gauge_rows(self):
+        """
+        (namespace, entities, values, regex entities) of the metrics_namespaces
+        namespaces holding the most values, then the others summed with an empty
+        namespace, which no namespace can have, so a server holding many namespaces
+        keeps a bounded number of series
+        """
+        rows = sorted(((namespace, len(finder.dentity_tries),
+                        sum(len(entity_trie) for entity_trie in finder.dentity_tries.values()),
+                        len(finder.regex_entities))
+                       for namespace, finder in list(self.namespaces.finders.items())),
+                      key=lambda row: row[2], reverse=True)
+        if len(rows) <= self.metrics_namespaces:
+            return rows
+        others = rows[self.metrics_namespaces:]
+        return rows[:self.metrics_namespaces] + [
+            ("",) + tuple(sum(row[column] for row in others) for column in (1, 2, 3))]
+
+    def gauges(self):
+        rows = self.namespace_gauge_rows()
+        return [
+            Gauge("ers_namespaces", "Namespaces held in memory", (),
+                  [((), len(self.namespaces.finders))]),
+            Gauge("ers_namespace_entities", "List entities held in memory, by namespace",
+                  ("namespace",), [((row[0],), row[1]) for row in rows]),
+            Gauge("ers_namespace_entity_values", "Values of the list entity tries, by namespace",
+                  ("namespace",), [((row[0],), row[2]) for row in rows]),
+            Gauge("ers_namespace_regex_entities", "Regex entities held in memory, by namespace",
+                  ("namespace",), [((row[0],), row[3]) for row in rows]),
+            Gauge("ers_cache_entries", "Entries held, by cache", ("cache",),
+                  [(("result_cache",), len(self.result_cache)),
+                   (("finder_cache",), len(self.finder_cache))]),
+            Gauge("ers_worker_pool_pending", "spaCy calls queued or running", (),
+                  [((), self.worker_pool.pending)]),
+            Gauge("ers_model_memory_bytes",
+                  "Estimated memory of the models loaded in the server process, by language",
+                  ("language",), [((language,), size)
+                                  for language, size in list(self.models.sizes.items())]),
+        ]
+
+    async def handle_metrics(self, request):
+        '''
+        request counts and latencies, stage timings and entity gauges, in the
+        Prometheus text format
+        '''
+        text = metrics.render(metrics.REQUEST_METRICS + self.gauges())
+        return web.Response(text=text, headers={'Content-Type': metrics.CONTENT_TYPE})
+
+    async def profile_start(self, request):
+        '''
+        starts profiling the requests of the given handlers, e.g.
+        {"mode": "cprofile", "handlers": ["populate_entities"], "duration": 60}
+        '''
+        body = await self.read_json(request) if request.can_read_body else {}
+        try:
+            mode = ProfileMode(body.get('mode', ProfileMode.CPROFILE.value))
+            duration = float(body.get('duration', 60.0))
+        except (ValueError, TypeError):
+            raise web.HTTPBadRequest(reason='Invalid profile mode or duration')
+        # a NaN window would never end
+        if not math.isfinite(duration) or duration <= 0:
+            raise web.HTTPBadRequest(reason='Invalid profile mode or duration')
+        handlers = body.get('handlers')
+        if handlers is not None and (not isinstance(handlers, list) or
+                                     not all(isinstance(name, str) for name in handlers)):
+            raise web.HTTPBadRequest(reason='Invalid profile handlers')
+        self.profiler.start(mode, handlers, duration)
+        return self.json_response(self.profiler.status())
+
+    async def profile_report(self, request):
+        '''
+        the profiling status, with the report once the window has ended
+        '''
+        return self.json_response(self.profiler.status())
+
+    async def profile_stop(self, request):
+        '''
+        ends the profiling window early and returns its report
+        '''
+        self.profiler.stop()
+        return self.json_response(self.profiler.status())
+
 
 @web.middleware
 async def log_error_middleware(request, handler):
@@ -225,16 +705,34 @@ async def log_error_middleware(request, handler):
 def initialize_web_app(web_app, er_server):
     logger = _get_logger()
     logger.warning("Entity Recognizer initializing server.")
+    web_app.middlewares.append(log_sample_middleware)
+    web_app.middlewares.append(metrics_middleware)
     web_app.middlewares.append(log_error_middleware)
+    web_app.middlewares.append(profiling_middleware(er_server.profiler))
     web_app.router.add_route('GET', '/health', er_server.health)
     web_app.router.add_route('GET', '/ner', er_server.handle_ner)
+    web_app.router.add_route('POST', '/ner/batch', er_server.handle_ner_batch)
     web_app.router.add_route('GET', '/tokenize', er_server.handle_tokenize)
+    web_app.router.add_route('POST', '/tokenize/batch', er_server.handle_tokenize_batch)
+    web_app.router.add_route('GET', '/cache_stats', er_server.cache_stats)
+    web_app.router.add_route('GET', '/metrics', er_server.handle_metrics)
     web_app.router.add_route('POST', '/findentities', er_server.handle_findentities)
     web_app.router.add_route('POST', '/reload', er_server.reload)
+    web_app.router.add_route('GET', '/reload', er_server.handle_reload_status)
+    web_app.router.add_route('GET', '/custom_entities', er_server.custom_entities_stats)
+    web_app.router.add_route('POST', '/custom_entities', er_server.register_custom_entities)
+    web_app.router.add_route('POST', '/custom_entities/delete',
+                             er_server.unregister_custom_entities)
     web_app.router.add_route('POST', '/v2/reset', er_server.reset)
     web_app.router.add_route('POST', '/v2/populate_entities', er_server.populate_entities)
+    web_app.router.add_route('POST', '/v2/populate_entities/stream',
+                             er_server.populate_entities_stream)
     web_app.router.add_route('POST', '/v2/delete_entities', er_server.delete_entities)
     web_app.router.add_route('POST', '/v2/entity_check', er_server.entity_check)
+    web_app.router.add_route('GET', '/v2/namespaces', er_server.namespace_stats)
+    web_app.router.add_route('POST', '/admin/profile', er_server.profile_start)
+    web_app.router.add_route('GET', '/admin/profile', er_server.profile_report)
+    web_app.router.add_route('DELETE', '/admin/profile', er_server.profile_stop)
 
 
 LOGGING_CONFIG_TEXT = """
@@ -249,13 +747,15 @@ formatters:
 filters:
     erlogfilter:
         (): hu_entity.server.ErLogFilter
+    erlogsample:
+        (): hu_entity.log_utils.SampleFilter
 handlers:
   console:
     class: logging.StreamHandler
     level: INFO
     stream: ext://sys.stdout
     formatter: json
-    filters: [erlogfilter]
+    filters: [erlogsample, erlogfilter]
 """
 
 
@@ -272,6 +772,37 @@ class ErLogFilter(logging.Filter):
         return True
 
 
+def valid_batch_size(batch_size):
+    # bool is an int, but true is no batch size
+    return isinstance(batch_size, int) and not isinstance(batch_size, bool) and batch_size >= 1
+
+
+def _get_env_number(name, number_type, default):
+    value_str = os.environ.get(name, "")
+    try:
+        return number_type(value_str)
+    except ValueError:
+        if value_str:
+            _get_logger().warning("%s invalid '%s'", name, value_str)
+        return default
+
+
+def _get_env_worker_mode(server_processes):
+    logger = _get_logger()
+    worker_mode_str = os.environ.get("ERS_WORKER_MODE", "thread")
+    try:
+        worker_mode = WorkerMode[worker_mode_str.upper()]
+    except KeyError:
+        logger.warning("ERS_WORKER_MODE invalid '%s'", worker_mode_str)
+        return WorkerMode.THREAD
+    if server_processes > 1 and worker_mode is WorkerMode.PROCESS:
+        # each forked server would start its own pool of spaCy processes
+        logger.warning("ERS_WORKER_MODE process is not supported with ERS_SERVER_PROCESSES "
+                       "above 1, using thread")
+        return WorkerMode.THREAD
+    return worker_mode
+
+
 def main():
     """Main function"""
     logging_config_file = os.environ.get("LOGGING_CONFIG_FILE", None)
@@ -286,7 +817,6 @@ def main():
     print("*** LOGGING CONFIG ***")
     logging.config.dictConfig(logging_config)
 
-    web_app = web.Application()
     env_minimal_server_str = os.environ.get("ERS_MINIMAL_SERVER", "")
     env_language = os.environ.get("ERS_LANGUAGE", "en")
 
@@ -295,22 +825,98 @@ def main():
         env_minimal_server_int = int(env_minimal_server_str)
     except ValueError:
         env_minimal_server_int = 0
-        logger.warning("ERS_MINIMAL_SERVER not set or invalid '{}'".format(
-            env_minimal_server_str))
+        logger.warning("ERS_MINIMAL_SERVER not set or invalid '%s'", env_minimal_server_str)
 
     env_minimal_server = bool(env_minimal_server_int)
-    er_server = EntityRecognizerServer(env_minimal_server,
-                                       language=env_language)
-    er_server.initialize()
 
-    initialize_web_app(web_app, er_server)
+    env_merged_index = bool(_get_env_number("ERS_MERGED_ENTITY_INDEX", int, 0))
+    logger.warning("Using merged entity index: %s", env_merged_index)
+
+    env_model_memory_budget_mb = _get_env_number("ERS_MODEL_MEMORY_BUDGET", float, None)
+    env_model_memory_budget = (None if env_model_memory_budget_mb is None
+                               else int(env_model_memory_budget_mb * 1000000))
+    env_preload_languages = [language.strip() for language in
+                             os.environ.get("ERS_PRELOAD_LANGUAGES", "").split(",")
+                             if language.strip() in MODEL_LOOKUP]
+
+    env_server_processes = _get_env_number("ERS_SERVER_PROCESSES", int, 1)
+    env_worker_mode = _get_env_worker_mode(env_server_processes)
+    env_entity_snapshot_dir = os.environ.get("ERS_ENTITY_SNAPSHOT_DIR") or None
+    if env_server_processes > 1 and env_entity_snapshot_dir is None:
+        # the processes share the /v2 entities through their snapshots
+        env_entity_snapshot_dir = tempfile.mkdtemp(prefix="ers-entities-")
+        logger.warning("ERS_ENTITY_SNAPSHOT_DIR not set, sharing entities in %s",
+                       env_entity_snapshot_dir)
+
+    env_finder_cache_chars = _get_env_number("ERS_FINDER_CACHE_CHARS", int, None)
+    if env_finder_cache_chars is None:
+        # the name it had before, when it looked like a memory size
+        env_finder_cache_chars = _get_env_number("ERS_FINDER_CACHE_SIZE", int, 10000000)
+
+    env_json_backend = os.environ.get("ERS_JSON_BACKEND") or None
+    if env_json_backend not in [None] + available_backends():
+        logger.warning("ERS_JSON_BACKEND invalid or not installed '%s'", env_json_backend)
+        env_json_backend = None
+
+    er_server = EntityRecognizerServer(
+        env_minimal_server,
+        language=env_language,
+        merged_entity_index=env_merged_index,
+        worker_mode=env_worker_mode,
+        workers=_get_env_number("ERS_WORKERS", int, 2),
+        max_pending=_get_env_number("ERS_MAX_PENDING", int, 64),
+        request_timeout=_get_env_number("ERS_REQUEST_TIMEOUT", float, 30.0),
+        result_cache_size=_get_env_number("ERS_RESULT_CACHE_SIZE", int, 1024),
+        result_cache_ttl=_get_env_number("ERS_RESULT_CACHE_TTL", float, None),
+        finder_cache_chars=env_finder_cache_chars,
+        entity_snapshot_dir=env_entity_snapshot_dir,
+        namespace_idle_timeout=_get_env_number("ERS_NAMESPACE_IDLE_TIMEOUT", float, None),
+        regex_time_budget=_get_env_number("ERS_REGEX_TIME_BUDGET", float, 0.1),
+        model_memory_budget=env_model_memory_budget,
+        preload_languages=env_preload_languages,
+        shared_entity_store=env_server_processes > 1,
+        json_backend=env_json_backend,
+        metrics_namespaces=_get_env_number("ERS_METRICS_NAMESPACES", int, 20),
+        server_processes=env_server_processes)
     parser = argparse.ArgumentParser(description="NER server")
     parser.add_argument('--port', type=int, default=9095)
     args = parser.parse_args()
     port = args.port
 
-    logger.warning("Starting entity recognizer API on port %d", port, extra={"port": port})
-    web.run_app(web_app, port=port)
+    if env_server_processes > 1:
+        # the workers share the models loaded here, the pool threads start after the fork
+        er_server.preload()
+        sock = listen(port)
+        logger.warning("Starting entity recognizer API on port %d with %d processes", port,
+                       env_server_processes, extra={"port": port})
+        PreforkServer(env_server_processes,
+                      lambda: run_server(er_server, sock=sock)).serve()
+    else:
+        logger.warning("Starting entity recognizer API on port %d", port, extra={"port": port})
+        run_server(er_server, port=port)
+
+
+def run_server(er_server, port=None, sock=None):
+    """Start the worker pool and serve on port, or on the listening socket sock"""
+    logger = _get_logger()
+    er_server.initialize()
+
+    env_profile_mode_str = os.environ.get("ERS_PROFILE_MODE", "")
+    env_profile_handlers = [name.strip() for name in
+                            os.environ.get("ERS_PROFILE_HANDLERS", "").split(",")
+                            if name.strip()]
+    if env_profile_mode_str:
+        try:
+            env_profile_mode = ProfileMode(env_profile_mode_str.lower())
+            er_server.profiler.start(env_profile_mode, env_profile_handlers,
+                                     _get_env_number("ERS_PROFILE_DURATION", float, 60.0))
+        except ValueError:
+            logger.warning("ERS_PROFILE_MODE invalid '%s'", env_profile_mode_str)
+
+    web_app = web.Application()
+    initialize_web_app(web_app, er_server)
+    web.run_app(web_app, port=port, sock=sock)
+    er_server.worker_pool.shutdown()
 
 
 if __name__ == '__main__':
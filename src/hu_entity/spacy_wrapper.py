@@ -1,19 +1,36 @@
 import logging
 import enum
-from pathlib import Path
-import os
 import string
 
-from nltk.corpus import stopwords
-
 import spacy
-import spacy.matcher
-
-from sklearn.feature_extraction.stop_words import ENGLISH_STOP_WORDS
 
+from hu_entity.custom_entities import CustomEntityMatcher
+from hu_entity.log_utils import Truncated
+from hu_entity.metrics import STAGE_SECONDS
 from hu_entity.named_entity import NamedEntity
-
-DATA_DIR = Path(os.path.dirname(os.path.realpath(__file__)) + '/data')
+from hu_entity.stopwords import SKLEARN_ENGLISH, load_stopwords
+
+# Number of texts handed to nlp.pipe at a time by the batch calls
+DEFAULT_BATCH_SIZE = 64
+
+# The spaCy models of each supported language, the minimal model first
+MODEL_LOOKUP = {
+    "en": ["en_core_web_sm", "en_core_web_md"],
+    "es": ["es_core_news_sm", "es_core_news_md"],
+    "fr": ["fr_core_news_sm", "fr_core_news_md"],
+    "pt": ["pt_core_news_sm"],
+    "it": ["it_core_news_sm"],
+    "nl": ["nl_core_news_sm"]
+}
+
+# The pipeline components each kind of call skips, as their results are not used
+PIPELINE_PROFILES = {
+    # entities only come from ner
+    "ner": ("tagger", "parser"),
+    # the lemmas depend on the tags, the entity types are only looked at by filter_ents
+    "tokenize": ("parser", "ner"),
+    "tokenize_filter_ents": ("parser",),
+}
 
 
 class StopWordSize(enum.Enum):
@@ -32,9 +49,8 @@ def _get_logger():
     return logger
 
 
-def entity_to_string(ent):
-    return "{{'{}', key:{}, ID:{}, at({}:{})}}".format(
-        ent, ent.ent_id, ent.label, ent.start, ent.end)
+def tokenize_profile(filter_ents):
+    return "tokenize_filter_ents" if filter_ents else "tokenize"
 
 
 def is_number_token(token):
@@ -64,10 +80,17 @@ class PlaceholderToken:
 
 
 class SpacyWrapper:
-    def __init__(self, minimal_ers_mode=False, language='en'):
+    def __init__(self, minimal_ers_mode=False, language='en', result_cache=None):
         self.logger = _get_logger()
         self.minimal_ers_mode = minimal_ers_mode
         self.language = language
+        # Optional LruCache of results, keyed by result_key
+        self.result_cache = result_cache
+        self.model_version = 0
+        # each key's custom entity phrases, added again when the model is loaded again
+        self.custom_entities = {}
+        # the ModelRegistry version of the custom entities
+        self.custom_entities_version = 0
         self.tokenizer_stoplist_xlarge = None
         self.tokenizer_stoplist_large = None
         self.tokenizer_stoplist = None
@@ -83,102 +106,81 @@ class SpacyWrapper:
         self.initialize()
 
     def __load_model(self, minimal_ers_mode, language):
-        model_lookup = {
-            "en": ["en_core_web_sm", "en_core_web_md"],
-            "es": ["es_core_news_sm", "es_core_news_md"],
-            "fr": ["fr_core_news_sm", "fr_core_news_md"],
-            "pt": ["pt_core_news_sm"],
-            "it": ["it_core_news_sm"],
-            "nl": ["nl_core_news_sm"]
-        }
-
         try:
-            language_models = model_lookup[language]
+            language_models = MODEL_LOOKUP[language]
         except (KeyError):
             raise SpacyException(
                 "Language {} is not available".format(language))
 
         if minimal_ers_mode:
-            self.logger.warning(
-                "Loading minimal model for {}...".format(language))
+            self.logger.warning("Loading minimal model for %s...", language)
             model = language_models[0]
         else:
             if len(language_models) > 1:
-                self.logger.warning("Loading model in {}...".format(language))
+                self.logger.warning("Loading model in %s...", language)
                 model = language_models[1]
             else:
-                self.logger.warning(
-                    "Loading model in {} (fallback minimal model)...".format(
-                        language))
+                self.logger.warning("Loading model in %s (fallback minimal model)...",
+                                    language)
                 model = language_models[0]
 
-        self.logger.info("Loading Spacy model {}...".format(model))
+        self.logger.info("Loading Spacy model %s...", model)
         return spacy.load(model)
 
-    def on_entity_match(self, matcher, doc, i, matches, entity_id):
-        """ merge phrases before they are added to the NER """
-        match_id, start, end = matches[i]
-        span = doc[start:end]
-        match_text = span.text
-        self.logger.info(
-            "Custom entity candidate match for {'%s', key:%s, ID:%s, at(%s,%s)}",
-            match_text, match_id, entity_id, start, end)
-
-        candidate_entity = (match_id, entity_id, start, end)
-        add_candidate = True
-
-        # scan through existing entities and decide whether we want to keep them
-        new_doc_ents = []
-        for ent in doc.ents:
-            add_this_entity = True
-            ent_start = ent.start
-            ent_end = ent.end
-            if ((ent_start <= start < ent_end)
-                    or (ent_start < end <= ent_end)):
-                # The existing entity wins if it is longer than the candidate
-                # (at same length the candidate wins)
-                if (ent_end - ent_start) > (end - start):
-                    add_candidate = False
-                else:
-                    add_this_entity = False
-                self.logger.info(
-                    "Candidate clashes with existing entity %s, use candidate=%s",
-                    entity_to_string(ent), add_candidate)
-
-            if add_this_entity:
-                new_doc_ents.append(ent)
-
-        if add_candidate:
-            new_doc_ents.append(candidate_entity)
-        doc.ents = new_doc_ents
+    def result_key(self, *args):
+        """Cache key for a result, including everything that the result depends on"""
+        return (self.language, self.minimal_ers_mode, self.model_version) + args
+
+    def invalidate_results(self):
+        """Called whenever the model or the matcher changes"""
+        self.model_version += 1
+        if self.result_cache is not None:
+            self.result_cache.clear()
 
     def add_entity(self, entity, key):
         """ add a custom entity to the NER with key 'key' """
-        custom_id = self.nlp.vocab[key].orth
-        terms = entity.split()
-
-        word_specs = [{'LOWER': term.strip().lower()} for term in terms]
-        self.logger.info("custom_id for {} is {}".format(key, custom_id))
-        self.logger.info("word_specs: {}".format(word_specs))
-        # Changed in v2.0 https://spacy.io/api/matcher#add
-        self.matcher.add(
-            entity,
-            lambda m, d, i, ms: self.on_entity_match(m, d, i, ms, entity_id=custom_id),
-            word_specs)
+        self.add_entities({key: [entity]})
+
+    def add_entities(self, entities, version=None):
+        """Add custom entities, {key: [phrase, ...]}, compiling each key's phrases at once"""
+        for key, phrases in entities.items():
+            known_phrases = self.custom_entities.setdefault(key, [])
+            known = set(known_phrases)
+            new_phrases = [phrase for phrase in dict.fromkeys(phrases) if phrase not in known]
+            known_phrases.extend(new_phrases)
+            self.matcher.add(key, new_phrases)
+        if version is not None:
+            self.custom_entities_version = version
+        self.invalidate_results()
+
+    def set_custom_entities(self, entities, version=None):
+        """Replace every custom entity, with a new matcher swapped in once it is built"""
+        custom_entities = {key: list(phrases) for key, phrases in entities.items()}
+        self.matcher = self.create_matcher(custom_entities)
+        self.custom_entities = custom_entities
+        if version is not None:
+            self.custom_entities_version = version
+        self.invalidate_results()
+
+    def create_matcher(self, custom_entities):
+        matcher = CustomEntityMatcher(self.nlp.vocab)
+        for key, phrases in custom_entities.items():
+            matcher.add(key, phrases)
+        return matcher
 
     def initialize(self):
         # reads the spacy model
         self.nlp = self.__load_model(self.minimal_ers_mode, self.language)
         # initialize the matcher with the model just read
-        self.matcher = spacy.matcher.Matcher(self.nlp.vocab)
+        self.matcher = self.create_matcher(self.custom_entities)
         self.GPE_ID = self.nlp.vocab['GPE'].orth
         self.PERSON_ID = self.nlp.vocab['PERSON'].orth
-        self.logger.warning('Entity ids: GPE={}'.format(self.GPE_ID))
+        self.invalidate_results()
+        self.logger.warning('Entity ids: GPE=%s', self.GPE_ID)
 
         language = self.language
         if language == 'en':
-            # A custom stoplist taken from sklearn.feature_extraction.stop_words import
-            # ENGLISH_STOP_WORDS
+            # A custom stoplist taken from the sklearn ENGLISH_STOP_WORDS
             custom_stoplist = {
                 'much', 'herein', 'thru', 'per', 'somehow', 'throughout',
                 'almost', 'somewhere', 'whereafter', 'nevertheless', 'indeed',
@@ -197,7 +199,7 @@ class SpacyWrapper:
                 'etc', 'whenever', 'even', 'someone', 'whereupon', 'inc',
                 'sometimes', 'ltd', 'cant'
             }
-            nltk_stopwords = set(stopwords.words('english'))
+            nltk_stopwords = load_stopwords('english')
 
             excluded_tokenizer_stopwords = {
                 'why', 'when', 'where', 'why', 'how', 'which', 'what', 'whose',
@@ -205,7 +207,7 @@ class SpacyWrapper:
             }
 
             self.tokenizer_stoplist_xlarge = (nltk_stopwords
-                                              | ENGLISH_STOP_WORDS
+                                              | load_stopwords(SKLEARN_ENGLISH)
                                               | {"n't", "'s", "'m", "ca"})
 
             self.tokenizer_stoplist_large = (
@@ -220,47 +222,68 @@ class SpacyWrapper:
             ]
         elif language == 'es':
             self.tokenizer_stoplist = self.tokenizer_stoplist_large = set()
-            self.tokenizer_stoplist_xlarge = set(stopwords.words('spanish'))
+            self.tokenizer_stoplist_xlarge = set(load_stopwords('spanish'))
 
             self.tokenizer_symbols = [char for char in string.punctuation] + [
                 "-----", "---", "...", "“", "”", '"', "¿"
             ]
         elif language == 'fr':
             self.tokenizer_stoplist = self.tokenizer_stoplist_large =\
-                self.tokenizer_stoplist_xlarge = set(stopwords.words('french'))
+                self.tokenizer_stoplist_xlarge = set(load_stopwords('french'))
 
             self.tokenizer_symbols = [char for char in string.punctuation] + [
                 "-----", "---", "...", "“", "”", '"'
             ]
         elif language == 'it':
             self.tokenizer_stoplist = self.tokenizer_stoplist_large =\
-                self.tokenizer_stoplist_xlarge = set(stopwords.words('italian'))
+                self.tokenizer_stoplist_xlarge = set(load_stopwords('italian'))
 
             self.tokenizer_symbols = [char for char in string.punctuation] + [
                 "-----", "---", "...", "“", "”", '"'
             ]
         elif language == 'pt':
             self.tokenizer_stoplist = self.tokenizer_stoplist_large =\
-                self.tokenizer_stoplist_xlarge = set(stopwords.words('portuguese'))
+                self.tokenizer_stoplist_xlarge = set(load_stopwords('portuguese'))
 
             self.tokenizer_symbols = [char for char in string.punctuation] + [
                 "-----", "---", "...", "“", "”", '"'
             ]
         elif language == 'nl':
             self.tokenizer_stoplist = self.tokenizer_stoplist_large =\
-                self.tokenizer_stoplist_xlarge = set(stopwords.words('dutch'))
+                self.tokenizer_stoplist_xlarge = set(load_stopwords('dutch'))
 
             self.tokenizer_symbols = [char for char in string.punctuation] + [
                 "-----", "---", "...", "“", "”", '"'
             ]
 
+    def parse(self, text, profile):
+        """
+        Run the pipeline components the profile needs on text. Components are skipped
+        per call rather than with nlp.disable_pipes, which changes the pipeline shared
+        by every worker thread
+        """
+        with STAGE_SECONDS.time("nlp"):
+            return self.nlp(text, disable=PIPELINE_PROFILES[profile])
+
+    def parse_batch(self, texts, profile, batch_size=DEFAULT_BATCH_SIZE):
+        return self.nlp.pipe(texts, batch_size=batch_size, disable=PIPELINE_PROFILES[profile])
+
     def get_entities(self, q):
         # gets the 'q' parameter and initiates the NLP component
-        doc = self.nlp(q)
+        doc = self.parse(q, "ner")
+        entity_list = self.doc_entities(doc)
+        return (entity_list, doc)
 
+    def get_entities_batch(self, texts, batch_size=DEFAULT_BATCH_SIZE):
+        """Recognize entities in many texts with nlp.pipe, one list per text, in order"""
+        return [self.doc_entities(doc)
+                for doc in self.parse_batch(texts, "ner", batch_size)]
+
+    def doc_entities(self, doc):
         # instantiate the NER matcher
-        self.matcher(doc)
-        self.logger.info("entities: {}".format(doc.ents))
+        with STAGE_SECONDS.time("matcher"):
+            self.matcher(doc)
+        self.logger.debug("entities: %s", Truncated(doc.ents))
         # list of all recognized entities
         entity_list = []
         for word in doc.ents:
@@ -272,7 +295,7 @@ class SpacyWrapper:
                 self.logger.info("Skipping uncategorized entity %s",
                                  named_entity)
 
-        return (entity_list, doc)
+        return entity_list
 
     def filter_tokens(self, tokens, test_function, fallback_string):
         filtered_tokens = []
@@ -322,14 +345,29 @@ class SpacyWrapper:
         return tokens
 
     def tokenize(self, sample: str, filter_ents: bool, sw_size: StopWordSize):
-        _, tokens = self.get_entities(sample)
+        doc = self.parse(sample, tokenize_profile(filter_ents))
+        return self.doc_tokens(doc, filter_ents, sw_size)
+
+    def tokenize_batch(self, samples, filter_ents: bool, sw_size: StopWordSize,
+                       batch_size=DEFAULT_BATCH_SIZE):
+        """Tokenize many samples with nlp.pipe, yielding the tokens of each in order"""
+        for doc in self.parse_batch(samples, tokenize_profile(filter_ents), batch_size):
+            yield self.doc_tokens(doc, filter_ents, sw_size)
+
+    def doc_tokens(self, doc, filter_ents: bool, sw_size: StopWordSize):
+        tokens = doc
+        # the entities, custom ones included, are only looked at to filter them
         if filter_ents:
-            tokens = self.filter_tokens(tokens, is_number_token, "NUM")
-            self.logger.info("removed numbers: {}".format(tokens))
-            tokens = self.filter_tokens(
-                tokens,
-                lambda token: is_entity_token_type(token, self.PERSON_ID),
-                "PERSON")
-            self.logger.info("removed persons: {}".format(tokens))
-        tokens = self.lemma_and_remove_stopwords(tokens, sw_size)
+            with STAGE_SECONDS.time("matcher"):
+                self.matcher(doc)
+            with STAGE_SECONDS.time("filter_tokens"):
+                tokens = self.filter_tokens(tokens, is_number_token, "NUM")
+                self.logger.debug("removed numbers: %s", Truncated(tokens))
+                tokens = self.filter_tokens(
+                    tokens,
+                    lambda token: is_entity_token_type(token, self.PERSON_ID),
+                    "PERSON")
+                self.logger.debug("removed persons: %s", Truncated(tokens))
+        with STAGE_SECONDS.time("lemma_and_remove_stopwords"):
+            tokens = self.lemma_and_remove_stopwords(tokens, sw_size)
         return tokens
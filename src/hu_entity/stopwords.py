@@ -0,0 +1,40 @@
+"""
+Stopword lists, precomputed from nltk and sklearn by initialize_spacy_model.py, so
+that the server doesn't import either of them
+"""
+import functools
+import os
+from pathlib import Path
+
+DATA_DIR = Path(os.path.dirname(os.path.realpath(__file__)) + '/data')
+STOPWORDS_DIR = DATA_DIR / 'stopwords'
+
+# The nltk stopword corpora used by the supported languages
+NLTK_STOPWORD_LISTS = ["english", "spanish", "french", "italian", "portuguese", "dutch"]
+
+# sklearn.feature_extraction.stop_words.ENGLISH_STOP_WORDS
+SKLEARN_ENGLISH = "sklearn_english"
+
+
+def stopwords_path(name, directory=None):
+    return Path(directory or STOPWORDS_DIR) / (name + ".txt")
+
+
+@functools.lru_cache(maxsize=None)
+def load_stopwords(name):
+    """The stopword list name, read from its file on first use"""
+    path = stopwords_path(name)
+    try:
+        with path.open(encoding="utf8") as file_handle:
+            return frozenset(line.rstrip("\n") for line in file_handle if line.strip())
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            "Stopword list {} not found, run initialize_spacy_model.py to create it".format(path))
+
+
+def write_stopwords(name, words, directory=None):
+    """Write a stopword list, one word per line"""
+    path = stopwords_path(name, directory)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w", encoding="utf8") as file_handle:
+        file_handle.write("".join(word + "\n" for word in sorted(set(words))))
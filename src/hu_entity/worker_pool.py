@@ -0,0 +1,183 @@
+"""Runs spaCy inference off the event loop in a bounded pool of workers"""
+import asyncio
+import concurrent.futures
+import enum
+import logging
+
+from hu_entity.model_registry import ModelRegistry, load_custom_entities
+
+# The models owned by a process pool worker, each loaded on first use
+_process_models = None
+
+
+def _get_logger():
+    logger = logging.getLogger('hu_entity.worker_pool')
+    return logger
+
+
+class WorkerMode(enum.Enum):
+    """How spaCy calls are run"""
+    THREAD = 1
+    PROCESS = 2
+
+
+class WorkerPoolFull(Exception):
+    pass
+
+
+class WorkerPoolTimeout(Exception):
+    pass
+
+
+def get_entities(spacy_wrapper, q):
+    entities, _ = spacy_wrapper.get_entities(q)
+    return entities
+
+
+def get_entities_batch(spacy_wrapper, texts, batch_size):
+    return spacy_wrapper.get_entities_batch(texts, batch_size)
+
+
+def tokenize(spacy_wrapper, q, filter_ents, sw_size):
+    return spacy_wrapper.tokenize(q, filter_ents, sw_size)
+
+
+def tokenize_batch(spacy_wrapper, samples, filter_ents, sw_size, batch_size):
+    return list(spacy_wrapper.tokenize_batch(samples, filter_ents, sw_size, batch_size))
+
+
+def _thread_call(models, language, function, *args):
+    return function(models.get(language), *args)
+
+
+def _process_call(config, language, function, *args):
+    """Entry point in a process pool worker, which holds its own copy of the models"""
+    global _process_models
+    minimal_ers_mode, default_language, memory_budget, version, custom_entities_path = config
+    if _process_models is None or _process_models.config()[:3] != config[:3]:
+        _process_models = ModelRegistry(minimal_ers_mode, default_language,
+                                        memory_budget=memory_budget)
+    # the models already loaded are kept, with their matchers rebuilt
+    if _process_models.custom_entities_version != version:
+        _process_models.set_custom_entities(load_custom_entities(custom_entities_path),
+                                            version)
+    spacy_wrapper = _process_models.get(language)
+    if function is None:
+        return None
+    return function(spacy_wrapper, *args)
+
+
+class SpacyWorkerPool:
+    """
+    Runs SpacyWrapper calls in a thread or process pool so the event loop stays free.
+    models is a ModelRegistry, or anything with a get(language) method returning the
+    wrapper to call. Process pool workers each hold a registry with the same settings.
+    At most max_pending calls may be queued or running, further calls are rejected
+    with WorkerPoolFull, and callers stop waiting after request_timeout seconds.
+    reload builds the new models while the old ones keep serving, then swaps them in.
+    """
+
+    def __init__(self, models, worker_mode=WorkerMode.THREAD, workers=2,
+                 max_pending=64, request_timeout=30.0):
+        self.logger = _get_logger()
+        self.models = models
+        self.worker_mode = worker_mode
+        self.workers = workers
+        self.max_pending = max_pending
+        self.request_timeout = request_timeout
+        self.pending = 0
+        self.executor = None
+
+    def initialize(self):
+        self.logger.warning("Starting %s worker pool with %d workers",
+                            self.worker_mode.name.lower(), self.workers)
+        old_executor = self.executor
+        if self.worker_mode is WorkerMode.PROCESS:
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+        if old_executor is not None:
+            old_executor.shutdown(wait=False)
+        self.preload()
+
+    def preload(self):
+        """Load the models up front rather than on the first request"""
+        if self.worker_mode is WorkerMode.PROCESS:
+            for _ in range(self.workers):
+                for language in self.models.languages_to_preload():
+                    self.submit_process_call(self.executor, language, None)
+        else:
+            for language in self.models.languages_to_preload():
+                self.models.get(language)
+
+    async def reload(self, minimal_ers_mode, default_language):
+        """
+        Load the models with the new settings in the background, then switch to them.
+        In process mode a new pool is started and preloaded, calls go to the old pool
+        until then; calls running in the old pool finish there.
+        """
+        loop = asyncio.get_event_loop()
+        if self.worker_mode is WorkerMode.PROCESS:
+            executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+            try:
+                await asyncio.gather(*[
+                    asyncio.wrap_future(self.submit_process_call(
+                        executor, language, None, minimal_ers_mode=minimal_ers_mode,
+                        default_language=default_language))
+                    for _ in range(self.workers)
+                    for language in self.models.languages_to_preload(default_language)])
+            except Exception:
+                executor.shutdown(wait=False)
+                raise
+            self.models.swap(minimal_ers_mode, default_language)
+            old_executor, self.executor = self.executor, executor
+            old_executor.shutdown(wait=False)
+        else:
+            # not in self.executor, so that requests are still served meanwhile
+            wrappers, sizes = await loop.run_in_executor(
+                None, self.models.build, minimal_ers_mode, default_language)
+            self.models.swap(minimal_ers_mode, default_language, wrappers, sizes)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def submit_process_call(self, executor, language, function, *args, minimal_ers_mode=None,
+                            default_language=None):
+        """Submit a call to a process pool, which may read the custom entities file"""
+        config = self.models.hold_config(minimal_ers_mode, default_language)
+        try:
+            future = executor.submit(_process_call, config, language, function, *args)
+        except Exception:
+            self.models.release_config(config)
+            raise
+        future.add_done_callback(lambda _done: self.models.release_config(config))
+        return future
+
+    def _release(self, _future):
+        self.pending -= 1
+
+    async def run(self, function, *args, language=None):
+        """
+        Run function(spacy_wrapper, *args) in the pool, with the wrapper of language
+        (by default the default language), and return its result
+        """
+        if self.pending >= self.max_pending:
+            raise WorkerPoolFull()
+
+        loop = asyncio.get_event_loop()
+        if self.worker_mode is WorkerMode.PROCESS:
+            future = self.submit_process_call(self.executor, language, function, *args)
+        else:
+            future = self.executor.submit(_thread_call, self.models, language, function, *args)
+        # The slot is only freed once the work has really finished (or been
+        # cancelled while still queued), so timed out calls still count
+        self.pending += 1
+        future.add_done_callback(
+            lambda done: loop.call_soon_threadsafe(self._release, done))
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.request_timeout)
+        except asyncio.TimeoutError:
+            raise WorkerPoolTimeout()
@@ -5,6 +5,8 @@ import sys
 import subprocess
 import nltk
 
+from hu_entity.stopwords import NLTK_STOPWORD_LISTS, SKLEARN_ENGLISH, write_stopwords
+
 
 def pip_install(package):
     subprocess.run(
@@ -52,6 +54,15 @@ def download_model(model, version):
     pip_install(download_url)
 
 
+def write_stopword_lists():
+    # Precomputed, so that the server doesn't import nltk or sklearn
+    from nltk.corpus import stopwords
+    from sklearn.feature_extraction.stop_words import ENGLISH_STOP_WORDS
+    for name in NLTK_STOPWORD_LISTS:
+        write_stopwords(name, stopwords.words(name))
+    write_stopwords(SKLEARN_ENGLISH, ENGLISH_STOP_WORDS)
+
+
 if __name__ == "__main__":
     print("*** Initialize Spacy Model script")
     LANGUAGES = [#('en_core_web_sm', '2.0.0'), 
@@ -82,4 +93,6 @@ if __name__ == "__main__":
     print("***********************************************************")
     print("*** nltk")
     nltk.downloader.download("stopwords")
+    print("*** stopword lists")
+    write_stopword_lists()
     print("*************************DONE******************************")
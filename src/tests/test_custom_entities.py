@@ -0,0 +1,26 @@
+# flake8: noqa
+from collections import namedtuple
+
+from hu_entity.custom_entities import select_candidates, merge_entities
+
+Span = namedtuple("Span", ["label", "start", "end"])
+
+
+def test_select_candidates_longest_wins():
+    matches = [(1, 0, 2), (1, 1, 4), (2, 5, 6), (1, 5, 6), (2, 3, 5)]
+    assert(select_candidates(matches) == [(1, 1, 4), (2, 5, 6)])
+
+
+def test_merge_entities_longer_wins_tie_to_candidate():
+    ents = [Span("GPE", 0, 1), Span("ORG", 3, 6), Span("PERSON", 8, 10)]
+    candidates = [(7, 0, 2), (7, 4, 5), (7, 8, 10)]
+    merged = merge_entities(ents, candidates)
+    # the candidate is longer than GPE, shorter than ORG, as long as PERSON
+    assert(merged == [Span("ORG", 3, 6), (7, 7, 0, 2), (7, 7, 8, 10)])
+
+
+def test_merge_entities_candidate_spanning_entities():
+    ents = [Span("GPE", 1, 2), Span("GPE", 3, 4), Span("DATE", 6, 7)]
+    assert(merge_entities(ents, [(7, 0, 5)]) == [Span("DATE", 6, 7), (7, 7, 0, 5)])
+    assert(merge_entities([], [(7, 0, 5)]) == [(7, 7, 0, 5)])
+    assert(merge_entities(ents, []) == ents)
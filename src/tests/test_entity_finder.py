@@ -1,5 +1,9 @@
+import json
+import os
 
-from hu_entity.entity_finder import EntityFinder
+from hu_entity.entity_finder import EntityFinder, SortedArrayEntityTrie, MarisaEntityTrie, \
+    EntityBulkLoader, SORTED_ARRAY_MAX_SIZE, SNAPSHOT_DELTA_SUFFIX, span_enumeration_matches
+from hu_entity.legacy_entity_finder import LegacyEntityFinder
 
 
 def test_entity_finder_basic():
@@ -112,6 +116,286 @@ def test_entity_finder_split_message():
     assert(len(words) == 6)
 
 
+def test_entity_finder_long_message():
+    finder = EntityFinder()
+    values = setup_data()
+    finder.setup_cached_entity_values(values)
+    message = " ".join(["I want a cake and"] * 50 + ["some red wine, please"])
+    found_matches = finder.find_entity_values(message)
+    assert(len(found_matches) == 1)
+    assert("Drinks" in found_matches["red wine"])
+
+
+def test_entity_finder_matches_span_enumeration():
+    finder = EntityFinder()
+    values = setup_data()
+    values["Phrases"] = ["rich tea, please", "--", "diet coke and", "a", "a cake"]
+    finder.setup_cached_entity_values(values)
+    conversations = ["I want a Carrot cake and then more carrot cake",
+                     "Rich Tea, please -- and a Diet Coke and a beer",
+                     "-- a cake, a CAKE! red red wine? chocolate chocolate",
+                     "", "   ", "?", "Diet Coke and Diet Coke"]
+    for conversation in conversations:
+        found_matches = finder.find_entity_values(conversation)
+        expected_matches = span_enumeration_matches(finder, conversation)
+        assert(list(found_matches.items()) == list(expected_matches.items()))
+
+
+def test_entity_finder_merged_index_matches_per_entity():
+    values = setup_data()
+    values["Phrases"] = ["rich tea, please", "--", "diet coke and", "a", "a cake"]
+    conversations = ["I want a Carrot cake and then more carrot cake",
+                     "Rich Tea, please -- and a Diet Coke and a beer",
+                     "I want a chocolate cake and a chocolate biscuit",
+                     "-- a cake, a CAKE! red red wine? chocolate chocolate"]
+    finder = EntityFinder()
+    finder.setup_cached_entity_values(values)
+    merged_finder = EntityFinder(merged_index=True)
+    merged_finder.setup_cached_entity_values(values)
+    for conversation in conversations:
+        found_matches = merged_finder.find_entity_values(conversation)
+        expected_matches = finder.find_entity_values(conversation)
+        assert(list(found_matches.items()) == list(expected_matches.items()))
+
+
+def test_entity_finder_merged_index_incremental():
+    finder = EntityFinder(merged_index=True)
+    finder.setup_cached_entity_values(setup_data())
+    finder.delete_cached_entity_values({"CakeType": []})
+    found_matches = finder.find_entity_values("I want a chocolate cake")
+    assert(found_matches["chocolate"] == ["Biscuit"])
+
+    finder.setup_cached_entity_values({"CakeType": ["Chocolate"], "Biscuit": ["Shortbread"]})
+    found_matches = finder.find_entity_values("a chocolate cake")
+    assert(found_matches["chocolate"] == ["Biscuit", "CakeType"])
+    found_matches = finder.find_entity_values("some shortbread")
+    assert(found_matches["shortbread"] == ["Biscuit"])
+
+    finder.delete_cached_entity_values({"Biscuit": [], "CakeType": []})
+    assert(len(finder.merged_index) == 9)
+    assert(len(finder.find_entity_values("a chocolate cake or shortbread")) == 0)
+
+
+def test_entity_finder_snapshots_reload(tmpdir):
+    finder = EntityFinder(snapshot_dir=str(tmpdir))
+    finder.setup_cached_entity_values(setup_data())
+    conversation = "I want a chocolate cake, some red wine and a Rich Tea"
+    expected_matches = finder.find_entity_values(conversation)
+
+    reloaded_finder = EntityFinder(snapshot_dir=str(tmpdir))
+    reloaded_finder.load_snapshots()
+    assert(list(reloaded_finder.dentity_tries.keys()) == list(finder.dentity_tries.keys()))
+    found_matches = reloaded_finder.find_entity_values(conversation)
+    assert(list(found_matches.items()) == list(expected_matches.items()))
+
+
+def test_entity_finder_snapshots_update(tmpdir):
+    finder = EntityFinder(snapshot_dir=str(tmpdir))
+    finder.setup_cached_entity_values(setup_data())
+    reloaded_finder = EntityFinder(merged_index=True, snapshot_dir=str(tmpdir))
+    reloaded_finder.load_snapshots()
+    reloaded_finder.setup_cached_entity_values({"CakeType": ["Lemon Drizzle"]})
+    reloaded_finder.delete_cached_entity_values({"Drinks": []})
+    found_matches = reloaded_finder.find_entity_values("Lemon drizzle and carrot with beer")
+    assert(found_matches["Lemon drizzle"] == ["CakeType"])
+    assert(len(found_matches) == 1)
+
+    finder = EntityFinder(snapshot_dir=str(tmpdir))
+    finder.load_snapshots()
+    assert(list(finder.dentity_tries.keys()) == ["CakeSize", "CakeType", "Biscuit"])
+    assert(len(finder.dentity_tries["CakeType"]) == 5)
+
+
+def test_entity_finder_stats():
+    finder = EntityFinder()
+    finder.setup_cached_entity_values({"CakeSize": ["Large", "Tiny"], "Drinks": ["Red Wine"]})
+    stats = finder.stats()
+    assert(stats["entities"] == 2)
+    assert(stats["values"] == 3)
+    assert(stats["approximate_size"] == 17)
+    finder.setup_cached_regex_entities(setup_regex())
+    stats = finder.stats()
+    assert(stats["regex_entities"] == 2)
+    assert(stats["disabled_regex_entities"] == [])
+    assert(stats["approximate_size"] == 33)
+
+
+def test_entity_finder_unicode_values():
+    for merged_index in [False, True]:
+        finder = EntityFinder(merged_index)
+        finder.setup_cached_entity_values({"Postres": ["Crème Brûlée", "Tarta de Santiago"],
+                                           "Bebidas": ["Café", "Té"]})
+        found_matches = finder.find_entity_values("Quiero un café y una crème brûlée?")
+        assert(found_matches["café"] == ["Bebidas"])
+        assert(found_matches["crème brûlée"] == ["Postres"])
+
+
+def test_entity_finder_trie_backend_by_size():
+    finder = EntityFinder()
+    finder.setup_cached_entity_values({"Small": ["one", "two"]})
+    assert(isinstance(finder.dentity_tries["Small"], SortedArrayEntityTrie))
+    large_values = ["value {}".format(n) for n in range(SORTED_ARRAY_MAX_SIZE)]
+    finder.setup_cached_entity_values({"Small": large_values})
+    assert(isinstance(finder.dentity_tries["Small"], MarisaEntityTrie))
+    assert(len(finder.dentity_tries["Small"]) == SORTED_ARRAY_MAX_SIZE + 2)
+    finder.setup_cached_entity_values({"Small": ["three"]})
+    found_matches = finder.find_entity_values("one or three or value 12")
+    assert(found_matches["value 12"] == ["Small"])
+
+
+def test_entity_trie_backends():
+    for entity_trie in [SortedArrayEntityTrie(["red wine", "beer"]),
+                        MarisaEntityTrie(["red wine", "beer"])]:
+        assert("beer" in entity_trie)
+        assert("red" not in entity_trie)
+        assert(entity_trie.has_keys_with_prefix("red "))
+        assert(not entity_trie.has_keys_with_prefix("beer "))
+        entity_trie.add_words(["beer", "cider"])
+        assert(sorted(entity_trie.keys()) == ["beer", "cider", "red wine"])
+        assert(len(entity_trie) == 3)
+
+
+def test_marisa_trie_overlay():
+    words = ["value {}".format(n) for n in range(2 * SORTED_ARRAY_MAX_SIZE)]
+    entity_trie = MarisaEntityTrie(words)
+    trie = entity_trie.trie
+    entity_trie.add_words(["red wine", "value 7"])
+    # added to the overlay, the trie is not rebuilt
+    assert(entity_trie.trie is trie)
+    assert(len(entity_trie.overlay) == 1)
+    assert("red wine" in entity_trie and "value 7" in entity_trie)
+    assert(entity_trie.has_keys_with_prefix("red "))
+    assert(len(entity_trie) == 2 * SORTED_ARRAY_MAX_SIZE + 1)
+    entity_trie.add_words(["extra {}".format(n) for n in range(SORTED_ARRAY_MAX_SIZE)])
+    # merged once the overlay outgrows its share of the trie
+    assert(entity_trie.trie is not trie)
+    assert(len(entity_trie.overlay) == 0)
+    assert(len(entity_trie) == 3 * SORTED_ARRAY_MAX_SIZE + 1)
+    assert("red wine" in entity_trie)
+
+
+def test_entity_finder_snapshots_append_delta(tmpdir, monkeypatch):
+    finder = EntityFinder(snapshot_dir=str(tmpdir))
+    large_values = ["value {}".format(n) for n in range(2 * SORTED_ARRAY_MAX_SIZE)]
+    finder.setup_cached_entity_values({"Large": large_values, "Small": ["one"]})
+    trie_path = finder.snapshot_path("Large")
+    trie_mtime = os.stat(trie_path).st_mtime_ns
+    manifest_writes = []
+    monkeypatch.setattr(json, "dump", lambda *args: manifest_writes.append(args))
+    finder.setup_cached_entity_values({"Large": ["Red Wine", "Beer"], "Small": ["two"]})
+    # the new values are appended, the trie and manifest are left alone
+    assert(os.stat(trie_path).st_mtime_ns == trie_mtime)
+    assert(os.path.exists(trie_path + SNAPSHOT_DELTA_SUFFIX))
+    assert(manifest_writes == [])
+    monkeypatch.undo()
+
+    reloaded_finder = EntityFinder(merged_index=True, snapshot_dir=str(tmpdir))
+    reloaded_finder.load_snapshots()
+    assert(len(reloaded_finder.dentity_tries["Large"]) == 2 * SORTED_ARRAY_MAX_SIZE + 2)
+    # the merged index is built on the first check
+    assert(reloaded_finder.merged_index is None)
+    found_matches = reloaded_finder.find_entity_values("red wine or value 12 and two")
+    assert(found_matches["red wine"] == ["Large"])
+    assert(found_matches["two"] == ["Small"])
+    assert(len(reloaded_finder.merged_index) == 2 * SORTED_ARRAY_MAX_SIZE + 4)
+
+
+def test_entity_finder_regex_entities():
+    finder = EntityFinder()
+    finder.setup_cached_entity_values(setup_data())
+    assert(finder.setup_cached_regex_entities(setup_regex()))
+    legacy_finder = LegacyEntityFinder()
+    legacy_finder.setup_entity_values(setup_data())
+    legacy_finder.setup_regex_entities(setup_regex())
+    for conversation in ["I want a large chocolate cake and a Lemonade",
+                         "Coffee, Cola or Rich Tea?", "nothing here"]:
+        found_matches = finder.find_entity_values(conversation)
+        expected_matches = legacy_finder.find_entity_values(conversation)
+        assert(list(found_matches.items()) == list(expected_matches.items()))
+
+    # List entities win over regex entities for the same word
+    found_matches = finder.find_entity_values("a Large Lemonade")
+    assert(found_matches["Large"] == ["CakeSize"])
+    assert(found_matches["Lemonade"] == ["CakeSizeRegex"])
+
+
+def test_entity_finder_regex_entities_delete():
+    finder = EntityFinder()
+    finder.setup_cached_regex_entities(setup_regex())
+    finder.delete_cached_regex_entities({"CakeSizeRegex": ""})
+    found_matches = finder.find_entity_values("a Lemonade with Cola")
+    assert(list(found_matches.items()) == [("Cola", ["CakeTypeRegex"])])
+    finder.delete_cached_regex_entities(["CakeTypeRegex", "Unknown"])
+    assert(len(finder.find_entity_values("a Lemonade with Cola")) == 0)
+    assert(finder.stats()["regex_entities"] == 0)
+
+
+def test_entity_finder_invalid_regex_caches_nothing():
+    finder = EntityFinder()
+    assert(not finder.setup_cached_regex_entities({"Good": "^[Ll].+$", "Bad": "[a\\d{3}$"}))
+    assert(len(finder.regex_entities) == 0)
+    assert(len(finder.find_entity_values("a Lemonade")) == 0)
+
+
+def test_entity_finder_regex_snapshots_reload(tmpdir):
+    finder = EntityFinder(snapshot_dir=str(tmpdir))
+    finder.setup_cached_regex_entities(setup_regex())
+    finder.delete_cached_regex_entities(["CakeTypeRegex"])
+
+    reloaded_finder = EntityFinder(snapshot_dir=str(tmpdir))
+    reloaded_finder.load_snapshots()
+    assert(list(reloaded_finder.regex_entities.keys()) == ["CakeSizeRegex"])
+    found_matches = reloaded_finder.find_entity_values("a Lemonade with Cola")
+    assert(list(found_matches.items()) == [("Lemonade", ["CakeSizeRegex"])])
+
+
+def test_entity_finder_regex_snapshots_keep_disabled(tmpdir):
+    finder = EntityFinder(snapshot_dir=str(tmpdir), regex_time_budget=0.1)
+    finder.setup_cached_regex_entities(setup_regex())
+    finder.regex_matcher.disable(["CakeTypeRegex"])
+    # matching saves the entities disabled since the snapshot
+    finder.find_entity_values("a Lemonade with Cola")
+
+    reloaded_finder = EntityFinder(snapshot_dir=str(tmpdir), regex_time_budget=0.1)
+    reloaded_finder.load_snapshots()
+    assert(reloaded_finder.regex_matcher.disabled_entities == ["CakeTypeRegex"])
+    found_matches = reloaded_finder.find_entity_values("a Lemonade with Cola")
+    assert(list(found_matches.items()) == [("Lemonade", ["CakeSizeRegex"])])
+
+
+def test_entity_bulk_loader():
+    finder = EntityFinder()
+    finder.setup_cached_entity_values({"CakeSize": ["Large"]})
+    loader = EntityBulkLoader(finder)
+    for entity_name, entity_values in setup_data().items():
+        for value in entity_values:
+            loader.add_line(json.dumps({"entity": entity_name, "value": value}).encode())
+    loader.add_line(b"\n")
+    assert(loader.finish() == {"entities": 4, "values": 16})
+    assert(len(finder.dentity_tries["CakeSize"]) == 3)
+
+    expected_finder = EntityFinder()
+    expected_finder.setup_cached_entity_values(setup_data())
+    conversation = "I want a chocolate cake, some red wine and a Rich Tea"
+    found_matches = finder.find_entity_values(conversation)
+    expected_matches = expected_finder.find_entity_values(conversation)
+    assert(list(found_matches.items()) == list(expected_matches.items()))
+
+
+def test_entity_bulk_loader_invalid_lines():
+    for line in [b"not json", b'{"entity": "Drinks"}', b'["Drinks", "Beer"]',
+                 b'{"entity": "Drinks", "value": 12}']:
+        finder = EntityFinder()
+        loader = EntityBulkLoader(finder)
+        loader.add_line(b'{"entity": "Drinks", "value": "Beer"}')
+        try:
+            loader.add_line(line)
+            assert(False)
+        except ValueError as exc:
+            assert(str(exc) == "Invalid entity value on line 2")
+        assert(len(finder.dentity_tries) == 0)
+
+
 def setup_data():
     values = {"CakeSize": ["Large", "Medium", "Tiny"],
               "CakeType": ["Carrot", "Chocolate", "Coffee", "Sponge"],
@@ -0,0 +1,185 @@
+import multiprocessing
+import time
+
+from hu_entity.entity_finder import MarisaEntityTrie
+from hu_entity.entity_namespaces import EntityNamespaces
+
+
+def test_entity_namespaces_separate():
+    namespaces = EntityNamespaces()
+    namespaces.get_finder("bot1", create=True).setup_cached_entity_values(
+        {"cars": ["Fiesta", "Focus"]})
+    namespaces.get_finder("bot2", create=True).setup_cached_entity_values(
+        {"fruits": ["Apple", "Pear"]})
+    found_matches = namespaces.get_finder("bot1").find_entity_values("a Focus and an Apple")
+    assert(list(found_matches.keys()) == ["Focus"])
+    found_matches = namespaces.get_finder("bot2").find_entity_values("a Focus and an Apple")
+    assert(list(found_matches.keys()) == ["Apple"])
+
+
+def test_entity_namespaces_unknown():
+    namespaces = EntityNamespaces()
+    assert(namespaces.get_finder("bot1") is None)
+    assert(len(namespaces.finders) == 0)
+
+
+def test_entity_namespaces_delete_and_reset():
+    namespaces = EntityNamespaces()
+    for namespace in ["bot1", "bot2", "bot3"]:
+        namespaces.get_finder(namespace, create=True).setup_cached_entity_values(
+            {"cars": ["Fiesta"]})
+    namespaces.delete_namespace("bot1")
+    assert(namespaces.get_finder("bot1") is None)
+    assert(namespaces.get_finder("bot2") is not None)
+    namespaces.reset()
+    assert(len(namespaces.finders) == 0)
+
+
+def test_entity_namespaces_stats():
+    namespaces = EntityNamespaces()
+    namespaces.get_finder("bot1", create=True).setup_cached_entity_values(
+        {"cars": ["Fiesta", "Focus"]})
+    stats = namespaces.stats()
+    assert(list(stats.keys()) == ["bot1"])
+    assert(stats["bot1"]["entities"] == 1)
+    assert(stats["bot1"]["values"] == 2)
+    assert(stats["bot1"]["approximate_size"] == 11)
+
+
+def test_entity_namespaces_evict_idle():
+    namespaces = EntityNamespaces(idle_timeout=0.04)
+    namespaces.get_finder("bot1", create=True).setup_cached_entity_values(
+        {"cars": ["Fiesta"]})
+    time.sleep(0.05)
+    namespaces.get_finder("bot2", create=True)
+    assert(list(namespaces.finders.keys()) == ["bot2"])
+
+
+def test_entity_namespaces_evicted_reload_from_snapshot(tmpdir):
+    namespaces = EntityNamespaces(snapshot_dir=str(tmpdir), idle_timeout=0.04)
+    namespaces.get_finder("bot/1", create=True).setup_cached_entity_values(
+        {"cars": ["Fiesta"]})
+    time.sleep(0.05)
+    namespaces.evict_idle()
+    assert(len(namespaces.finders) == 0)
+    found_matches = namespaces.get_finder("bot/1").find_entity_values("a Fiesta")
+    assert(found_matches["Fiesta"] == ["cars"])
+
+    namespaces.reset()
+    assert(namespaces.get_finder("bot/1") is None)
+    assert(tmpdir.listdir() == [])
+
+
+def test_entity_namespaces_names_stay_in_snapshot_dir(tmpdir):
+    store_dir = tmpdir.mkdir("store")
+    outside = tmpdir.join("outside.txt")
+    outside.write("keep")
+    namespaces = EntityNamespaces(snapshot_dir=str(store_dir))
+    for namespace in [".", "..", "../bot1"]:
+        namespaces.get_finder(namespace, create=True).setup_cached_entity_values(
+            {"cars": ["Fiesta"]})
+    assert(sorted(name.basename for name in store_dir.listdir()) ==
+           ["%2E", "%2E.", "%2E.%2Fbot1"])
+    assert(sorted(namespaces.snapshot_namespaces()) == [".", "..", "../bot1"])
+    namespaces.delete_namespace("..")
+    assert(outside.read() == "keep")
+    assert(sorted(namespaces.snapshot_namespaces()) == [".", "../bot1"])
+    for namespace in ["", None]:
+        try:
+            namespaces.delete_namespace(namespace)
+            assert(False)
+        except ValueError:
+            pass
+    assert(sorted(namespaces.snapshot_namespaces()) == [".", "../bot1"])
+
+
+def test_entity_namespaces_regex_only_reload_from_snapshot(tmpdir):
+    namespaces = EntityNamespaces(snapshot_dir=str(tmpdir))
+    finder = namespaces.get_finder("bot1", create=True)
+    finder.setup_cached_regex_entities({"Alarm": "[A]\\d{3}$"})
+
+    reloaded_namespaces = EntityNamespaces(snapshot_dir=str(tmpdir))
+    finder = reloaded_namespaces.get_finder("bot1")
+    assert(finder.find_entity_values("Alarm A212")["A212"] == ["Alarm"])
+
+
+def test_entity_namespaces_shared_store(tmpdir):
+    # as in two server processes
+    process1 = EntityNamespaces(snapshot_dir=str(tmpdir), shared=True)
+    process2 = EntityNamespaces(snapshot_dir=str(tmpdir), shared=True)
+    assert(process2.get_finder("bot1") is None)
+    with process1.writing("bot1") as finder:
+        finder.setup_cached_entity_values({"cars": ["Fiesta", "Focus"]})
+    found_matches = process2.get_finder("bot1").find_entity_values("a Focus and an Apple")
+    assert(list(found_matches.keys()) == ["Focus"])
+    # the tries are mapped from the snapshots rather than copied
+    assert(isinstance(process2.get_finder("bot1").dentity_tries["cars"], MarisaEntityTrie))
+
+    with process2.writing("bot1") as finder:
+        finder.setup_cached_entity_values({"fruits": ["Apple"]})
+    with process1.writing("bot1") as finder:
+        finder.setup_cached_regex_entities({"numbers": r"\d+"})
+    for namespaces in (process1, process2):
+        found_matches = namespaces.get_finder("bot1").find_entity_values("a Focus and an Apple 4")
+        assert(sorted(found_matches.keys()) == ["4", "Apple", "Focus"])
+
+    with process2.writing("bot1", create=False) as finder:
+        finder.delete_cached_entity_values({"cars": []})
+    assert(sorted(process1.get_finder("bot1").dentity_tries.keys()) == ["fruits"])
+    process1.delete_namespace("bot1")
+    assert(process2.get_finder("bot1") is None)
+
+
+def test_entity_namespaces_shared_store_recreated(tmpdir):
+    process1 = EntityNamespaces(snapshot_dir=str(tmpdir), shared=True)
+    process2 = EntityNamespaces(snapshot_dir=str(tmpdir), shared=True)
+    with process1.writing("bot1") as finder:
+        finder.setup_cached_entity_values({"cars": ["Fiesta"]})
+    assert(list(process2.get_finder("bot1").dentity_tries.keys()) == ["cars"])
+    # deleted then created again with one change, as the namespace's first version was
+    process1.delete_namespace("bot1")
+    with process1.writing("bot1") as finder:
+        finder.setup_cached_entity_values({"fruits": ["Apple"]})
+    assert(process1.read_version("bot1") != process2.versions["bot1"])
+    assert(list(process2.get_finder("bot1").dentity_tries.keys()) == ["fruits"])
+    # the store version files are not read as namespaces
+    assert(process1.snapshot_namespaces() == ["bot1"])
+
+
+def test_entity_namespaces_shared_store_current_finder_while_writing(tmpdir):
+    process1 = EntityNamespaces(snapshot_dir=str(tmpdir), shared=True)
+    process2 = EntityNamespaces(snapshot_dir=str(tmpdir), shared=True)
+    with process1.writing("bot1") as finder:
+        finder.setup_cached_entity_values({"cars": ["Fiesta"]})
+    process1.get_finder("bot1")
+    process2.get_finder("bot1")
+    with process1.writing("bot1") as finder:
+        finder.setup_cached_entity_values({"fruits": ["Apple"]})
+        # served without waiting for the lock, until the change is done
+        assert(list(process2.current_finder("bot1").dentity_tries.keys()) == ["cars"])
+        # nor does the process making the change serve its finder before it is done
+        assert(process1.current_finder("bot1") is not finder)
+        assert(list(process1.current_finder("bot1").dentity_tries.keys()) == ["cars"])
+    assert(process2.current_finder("bot1") is None)
+    assert(sorted(process2.get_finder("bot1").dentity_tries.keys()) == ["cars", "fruits"])
+
+
+def populate_shared(snapshot_dir, entity_name):
+    namespaces = EntityNamespaces(snapshot_dir=snapshot_dir, shared=True)
+    for number in range(20):
+        with namespaces.writing("bot1") as finder:
+            finder.setup_cached_entity_values({entity_name: ["value{}".format(number)]})
+
+
+def test_entity_namespaces_shared_store_concurrent_writes(tmpdir):
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=populate_shared, args=(str(tmpdir), name))
+                 for name in ("cars", "fruits", "drinks")]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(30)
+    finder = EntityNamespaces(snapshot_dir=str(tmpdir), shared=True).get_finder("bot1")
+    # no process overwrote the changes of another
+    assert(sorted(finder.dentity_tries.keys()) == ["cars", "drinks", "fruits"])
+    assert(all(len(entity_trie) == 20 for entity_trie in finder.dentity_tries.values()))
@@ -199,3 +199,55 @@ def test_does_not_recognize_stopwords_as_city(spacy_wrapper):
     assert len(entity_list) == 1
 
 
+def test_recognize_batch(spacy_wrapper):
+    texts = ["London", "Nothing", "What weather is it in London tomorrow"]
+    entity_lists = spacy_wrapper.get_entities_batch(texts, batch_size=2)
+    assert len(entity_lists) == 3
+    for text, entity_list in zip(texts, entity_lists):
+        single_list, _ = spacy_wrapper.get_entities(text)
+        assert [(e.entity_value, e.category, e.start_loc, e.end_loc) for e in entity_list] == \
+            [(e.entity_value, e.category, e.start_loc, e.end_loc) for e in single_list]
+    assert len(entity_lists[1]) == 0
+    assert entity_lists[2][1].entity_value == 'tomorrow'
+
+
+def test_recognize_same_as_full_pipeline(spacy_wrapper):
+    texts = ["London", "Who is Sherlock Holmes", "Golden Gate Bridge", "$23.79",
+             "I'd like to fly from London to Paris tomorrow at 9am"]
+    for text in texts:
+        expected = spacy_wrapper.doc_entities(spacy_wrapper.nlp(text))
+        entity_list, _ = spacy_wrapper.get_entities(text)
+        assert [(e.entity_value, e.category, e.start_loc, e.end_loc) for e in entity_list] == \
+            [(e.entity_value, e.category, e.start_loc, e.end_loc) for e in expected]
+
+
+def test_recognize_custom_entity(spacy_wrapper):
+    spacy_wrapper.add_entity("Lemon Drizzle", "custom_entity")
+    entity_list, _ = spacy_wrapper.get_entities("I would like a LEMON drizzle cake in London")
+    assert [(e.entity_value, e.category) for e in entity_list] == \
+        [("LEMON drizzle", "sys.custom"), ("London", "sys.places")]
+
+
+def test_recognize_custom_entity_longer_model_entity_wins(spacy_wrapper):
+    spacy_wrapper.add_entity("Gate", "custom_entity")
+    entity_list, _ = spacy_wrapper.get_entities("Golden Gate Bridge")
+    assert len(entity_list) == 1
+    assert entity_list[0].entity_value == 'Golden Gate Bridge'
+
+
+def test_recognize_many_custom_entities(spacy_wrapper):
+    for number in range(20000):
+        spacy_wrapper.matcher.add("custom_entity", ["gazetteer item {}".format(number)])
+    entity_list, _ = spacy_wrapper.get_entities("order Gazetteer item 12345 and gazetteer item 7")
+    assert [e.entity_value for e in entity_list if e.category == "sys.custom"] == \
+        ["Gazetteer item 12345", "gazetteer item 7"]
+
+
+def test_replace_custom_entities(spacy_wrapper):
+    spacy_wrapper.add_entities({"custom_entity": ["Carrot Cake", "Battenberg"]}, 3)
+    assert spacy_wrapper.custom_entities_version == 3
+    spacy_wrapper.set_custom_entities({"custom_entity": ["Battenberg"]}, 4)
+    entity_list, _ = spacy_wrapper.get_entities("a carrot cake or a battenberg")
+    assert [e.entity_value for e in entity_list if e.category == "sys.custom"] == ["battenberg"]
+    assert spacy_wrapper.custom_entities == {"custom_entity": ["Battenberg"]}
+    assert spacy_wrapper.custom_entities_version == 4
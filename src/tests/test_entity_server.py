@@ -1,4 +1,7 @@
 # flake8: noqa
+import asyncio
+import json
+
 import pytest
 from aiohttp import web
 import hu_entity.server
@@ -22,6 +25,18 @@ async def cli(loop, aiohttp_client, ner_server):
     return await aiohttp_client(web_app)
 
 
+@pytest.fixture()
+async def reload_cli(loop, aiohttp_client):
+    """A client of a server of its own, for tests that reload the models, so that the
+    reload doesn't reach the tests sharing ner_server"""
+    server = hu_entity.server.EntityRecognizerServer(minimal_ers_mode=True)
+    server.initialize()
+    web_app = web.Application()
+    hu_entity.server.initialize_web_app(web_app, server)
+    yield await aiohttp_client(web_app)
+    server.worker_pool.shutdown()
+
+
 async def test_server_root_404(cli):
     resp = await cli.get('/')
     assert resp.status == 404
@@ -82,6 +97,30 @@ async def test_server_ner_two_word_places(cli):
     assert item['value'] == "New York"
 
 
+async def test_server_ner_batch(cli):
+    resp = await cli.post('/ner/batch', json={"q": ["London", "Nothing", "Whats the weather in New York"]})
+    assert resp.status == 200
+    json_resp = await resp.json()
+    assert isinstance(json_resp, list)
+    assert len(json_resp) == 3
+    assert len(json_resp[0]) == 1
+    assert json_resp[0][0]['category'] == "sys.places"
+    assert json_resp[0][0]['value'] == "London"
+    assert len(json_resp[1]) == 0
+    assert json_resp[2][0]['value'] == "New York"
+
+
+async def test_server_ner_batch_invalid(cli):
+    resp = await cli.post('/ner/batch', json={"q": "London"})
+    assert resp.status == 400
+    resp = await cli.post('/ner/batch', json={"q": ["London"], "batch_size": 0})
+    assert resp.status == 400
+    resp = await cli.post('/ner/batch', json={"q": ["London"], "batch_size": True})
+    assert resp.status == 400
+    resp = await cli.post('/ner/batch', json=["London"])
+    assert resp.status == 400
+
+
 async def test_server_tokenize(cli):
     resp = await cli.get('/tokenize?q=hi')
     assert resp.status == 200
@@ -91,6 +130,38 @@ async def test_server_tokenize(cli):
     assert json_resp[0] == "hi"
 
 
+async def test_server_tokenize_batch(cli):
+    resp = await cli.post('/tokenize/batch', json={"q": ["hi", "set alarm 12345", "12345"], "filter_ents": True, "batch_size": 2})
+    assert resp.status == 200
+    assert resp.content_type == "application/x-ndjson"
+    lines = (await resp.text()).splitlines()
+    assert len(lines) == 3
+    assert json.loads(lines[0]) == ["hi"]
+    assert json.loads(lines[1]) == ["set", "alarm"]
+    assert json.loads(lines[2]) == ["num"]
+
+
+async def test_server_tokenize_batch_invalid_sw_size(cli):
+    resp = await cli.post('/tokenize/batch', json={"q": ["hi"], "sw_size": "huge"})
+    assert resp.status == 400
+    resp = await cli.post('/tokenize/batch', json=["hi"])
+    assert resp.status == 400
+    resp = await cli.post('/tokenize/batch', json={"q": ["hi"], "batch_size": True})
+    assert resp.status == 400
+
+
+async def test_server_cache_stats(cli):
+    resp = await cli.get('/cache_stats')
+    stats_before = (await resp.json())['result_cache']
+    await cli.get('/ner?q=Repeated London')
+    await cli.get('/ner?q=Repeated London')
+    resp = await cli.get('/cache_stats')
+    assert resp.status == 200
+    stats = (await resp.json())['result_cache']
+    assert stats['misses'] == stats_before['misses'] + 1
+    assert stats['hits'] == stats_before['hits'] + 1
+
+
 async def test_server_find_entities_requires_body(cli):
     resp = await cli.post('/findentities')
     assert resp.status == 400
@@ -106,6 +177,19 @@ async def test_server_find_entities(cli):
     assert next(iter(values['Apple'])) == "fruits"
     assert len(values) == 2
 
+async def test_server_find_entities_cached_finder(cli):
+    resp = await cli.get('/cache_stats')
+    stats_before = (await resp.json())['finder_cache']
+    for conversation in ["a Golf is a car", "a Fiesta is a car"]:
+        resp = await cli.post('/findentities', json={"conversation": conversation, "entities": {"cars": ["Fiesta", "Focus", "Golf", "Polo"]}})
+        assert resp.status == 200
+        json_resp = await resp.json()
+        assert len(json_resp['entities']) == 1
+    resp = await cli.get('/cache_stats')
+    stats = (await resp.json())['finder_cache']
+    assert stats['misses'] == stats_before['misses'] + 1
+    assert stats['hits'] == stats_before['hits'] + 1
+
 async def test_server_find_regex_entities(cli):
     resp = await cli.post('/findentities', data='{"conversation" : "Alarm number A213", "entities" : { "alarms" : [ "a210", "a211", "a212" ] }, "regex_entities" : { "ralarms" : "[A]\\\\d{3}$" } }')
     assert resp.status == 200
@@ -193,3 +277,236 @@ async def test_server_delete_entities(cli):
     values = json_resp['entities']
     assert len(values) == 1
     assert next(iter(values['Apple'])) == "fruits"
+
+async def test_server_namespaced_entities(cli):
+    resp = await cli.post('/v2/populate_entities', json={"namespace": "bot1", "entities": {"cars": ["Fiesta", "Focus", "Golf"]}})
+    assert resp.status == 200
+    resp = await cli.post('/v2/populate_entities', json={"namespace": "bot2", "entities": {"fruits": ["Apple", "Banana", "Pear"]}})
+    assert resp.status == 200
+
+    resp = await cli.post('/v2/entity_check', json={"namespace": "bot1", "conversation": "a Focus is a type of car, an Apple is a fruit"})
+    values = (await resp.json())['entities']
+    assert len(values) == 1
+    assert next(iter(values['Focus'])) == "cars"
+
+    resp = await cli.get('/v2/namespaces')
+    stats = await resp.json()
+    assert stats['bot1']['entities'] == 1
+    assert stats['bot2']['values'] == 3
+
+    resp = await cli.post('/v2/reset', json={"namespace": "bot2"})
+    assert resp.status == 200
+    resp = await cli.post('/v2/entity_check', json={"namespace": "bot2", "conversation": "an Apple is a fruit"})
+    values = (await resp.json())['entities']
+    assert len(values) == 0
+    resp = await cli.post('/v2/entity_check', json={"namespace": "bot1", "conversation": "a Golf"})
+    values = (await resp.json())['entities']
+    assert len(values) == 1
+
+async def test_server_invalid_namespace(cli):
+    for namespace in ["", ".", "..", 5, ["bot1"]]:
+        resp = await cli.post('/v2/populate_entities', json={"namespace": namespace, "entities": {"cars": ["Fiesta"]}})
+        assert resp.status == 400
+        resp = await cli.post('/v2/entity_check', json={"namespace": namespace, "conversation": "a Fiesta"})
+        assert resp.status == 400
+        resp = await cli.post('/v2/reset', json={"namespace": namespace})
+        assert resp.status == 400
+    resp = await cli.post('/v2/populate_entities/stream?namespace=..', data=b'{"entity": "cars", "value": "Fiesta"}\n')
+    assert resp.status == 400
+
+async def test_server_find_cached_regex_entities(cli):
+    resp = await cli.post('/v2/populate_entities', data='{"namespace" : "alarms_bot", "entities" : { "alarms" : [ "a210", "a211", "a212" ] }, "regex_entities" : { "ralarms" : "[A]\\\\d{3}$" } }')
+    assert resp.status == 200
+
+    resp = await cli.post('/v2/entity_check', data='{"namespace" : "alarms_bot", "conversation" : "Alarm A212 or A213"}')
+    json_resp = await resp.json()
+    values = json_resp['entities']
+    assert values['A212'] == ["alarms"]
+    assert values['A213'] == ["ralarms"]
+    assert len(values) == 2
+
+    resp = await cli.post('/v2/delete_entities', data='{"namespace" : "alarms_bot", "regex_entities" : { "ralarms" : "" } }')
+    assert resp.status == 200
+    resp = await cli.post('/v2/entity_check', data='{"namespace" : "alarms_bot", "conversation" : "Alarm A212 or A213"}')
+    values = (await resp.json())['entities']
+    assert len(values) == 1
+
+async def test_server_populate_bad_regex(cli):
+    resp = await cli.post('/v2/populate_entities', data='{"namespace" : "bad_bot", "entities" : { "alarms" : [ "a210" ] }, "regex_entities" : { "ralarms" : "[a\\\\d{3}$" } }')
+    assert resp.status == 400
+    assert resp.reason == "Invalid regex found"
+    resp = await cli.get('/v2/namespaces')
+    assert "bad_bot" not in (await resp.json())
+    resp = await cli.post('/v2/entity_check', data='{"namespace" : "bad_bot", "conversation" : "Alarm a210"}')
+    values = (await resp.json())['entities']
+    assert len(values) == 0
+
+async def test_server_populate_entities_stream(cli):
+    lines = ['{"entity": "cars", "value": "Fiesta"}', '{"entity": "cars", "value": "Focus"}',
+             '{"entity": "fruits", "value": "Apple"}', '']
+    resp = await cli.post('/v2/populate_entities/stream?namespace=stream_bot', data="\n".join(lines))
+    assert resp.status == 200
+    assert (await resp.json()) == {"entities": 2, "values": 3}
+
+    resp = await cli.post('/v2/entity_check', json={"namespace": "stream_bot", "conversation": "a Focus is a type of car, an Apple is a fruit"})
+    values = (await resp.json())['entities']
+    assert next(iter(values['Focus'])) == "cars"
+    assert next(iter(values['Apple'])) == "fruits"
+    assert len(values) == 2
+
+async def test_server_populate_entities_stream_invalid(cli):
+    resp = await cli.post('/v2/populate_entities/stream?namespace=rejected_stream_bot', data='{"entity": "cars", "value": "Focus"}\n{"entity": "cars"}\n')
+    assert resp.status == 400
+    assert resp.reason == "Invalid entity value on line 2"
+    # nothing is left of the namespace
+    resp = await cli.get('/v2/namespaces')
+    assert "rejected_stream_bot" not in (await resp.json())
+
+async def test_server_profile_handler(cli):
+    resp = await cli.post('/admin/profile', json={"mode": "cprofile", "handlers": ["entity_check"], "duration": 60})
+    assert resp.status == 200
+    assert (await resp.json())['active']
+    resp = await cli.post('/v2/populate_entities', json={"entities": {"cars": ["Fiesta", "Focus"]}})
+    resp = await cli.post('/v2/entity_check', json={"conversation": "a Focus is a type of car"})
+    assert resp.status == 200
+
+    resp = await cli.delete('/admin/profile')
+    status = await resp.json()
+    assert not status['active']
+    assert status['requests'] == 1
+    assert "find_entity_values" in status['report']
+
+async def test_server_profile_invalid_mode(cli):
+    resp = await cli.post('/admin/profile', json={"mode": "perf"})
+    assert resp.status == 400
+    for duration in ["nan", "inf", -1, 0]:
+        resp = await cli.post('/admin/profile', json={"mode": "cprofile", "duration": duration})
+        assert resp.status == 400
+    for handlers in ["entity_check", [5], {"entity_check": 1}]:
+        resp = await cli.post('/admin/profile', json={"mode": "cprofile", "handlers": handlers})
+        assert resp.status == 400
+
+async def test_server_metrics(cli):
+    resp = await cli.post('/v2/populate_entities', json={"namespace": "metrics_bot", "entities": {"cars": ["Fiesta", "Focus"]}})
+    resp = await cli.post('/v2/entity_check', json={"namespace": "metrics_bot", "conversation": "a Focus"})
+    assert resp.status == 200
+
+    resp = await cli.get('/metrics')
+    assert resp.status == 200
+    text = await resp.text()
+    assert 'ers_requests_total{route="/v2/entity_check",status="200"}' in text
+    assert 'ers_request_duration_seconds_count{route="/v2/entity_check"}' in text
+    assert 'ers_stage_duration_seconds_count{stage="match_value_entities"}' in text
+    assert 'ers_stage_duration_seconds_count{stage="parse_json"}' in text
+    assert 'ers_namespace_entity_values{namespace="metrics_bot"} 2' in text
+
+async def test_server_metrics_namespaces_bounded(cli, ner_server):
+    for number, values in enumerate([["Fiesta"], ["Fiesta", "Focus", "Golf"], ["Fiesta", "Focus"]]):
+        resp = await cli.post('/v2/populate_entities', json={"namespace": "gauge_bot{}".format(number), "entities": {"cars": values}})
+        assert resp.status == 200
+    ner_server.metrics_namespaces = 1
+    try:
+        resp = await cli.get('/metrics')
+        text = await resp.text()
+    finally:
+        ner_server.metrics_namespaces = 20
+    lines = [line for line in text.splitlines() if line.startswith('ers_namespace_entity_values{')]
+    assert lines[0] == 'ers_namespace_entity_values{namespace="gauge_bot1"} 3'
+    assert len(lines) == 2
+    assert lines[1].startswith('ers_namespace_entity_values{namespace=""} ')
+
+async def test_server_prefork_refuses_process_local_changes(cli, ner_server):
+    ner_server.server_processes = 2
+    try:
+        resp = await cli.post('/reload', json={"lang": "en", "minimal_ers_mode": True})
+        assert resp.status == 409
+        resp = await cli.post('/custom_entities', json={"entities": {"custom_entity": ["Acme Widgets"]}})
+        assert resp.status == 409
+        resp = await cli.post('/custom_entities/delete', json={"entities": {"custom_entity": []}})
+        assert resp.status == 409
+        resp = await cli.get('/custom_entities')
+        assert resp.status == 200
+    finally:
+        ner_server.server_processes = 1
+
+async def test_server_ner_language(cli):
+    resp = await cli.get('/ner?q=London&lang=en')
+    assert resp.status == 200
+    json_resp = await resp.json()
+    assert json_resp[0]['value'] == "London"
+
+    resp = await cli.get('/ner?q=Madrid&lang=es')
+    assert resp.status == 200
+    json_resp = await resp.json()
+    assert json_resp[0]['value'] == "Madrid"
+    assert json_resp[0]['category'] == "sys.places"
+
+async def test_server_unavailable_language(cli):
+    resp = await cli.get('/ner?q=London&lang=xx')
+    assert resp.status == 400
+    assert resp.reason == "Language xx is not available"
+    resp = await cli.post('/tokenize/batch', json={"q": ["London"], "lang": "xx"})
+    assert resp.status == 400
+
+async def test_server_reload(reload_cli):
+    cli = reload_cli
+    resp = await cli.post('/reload', json={"lang": "es", "minimal_ers_mode": True})
+    assert resp.status == 202
+    json_resp = await resp.json()
+    assert json_resp['state'] == "loading"
+    assert json_resp['lang'] == "es"
+    # requests are still served by the old model while the new one loads
+    resp = await cli.get('/ner?q=London')
+    assert resp.status == 200
+
+    for _ in range(600):
+        resp = await cli.get('/reload')
+        json_resp = await resp.json()
+        if json_resp['state'] != "loading":
+            break
+        await asyncio.sleep(0.1)
+    assert json_resp['state'] == "done"
+    assert "es" in json_resp['loaded_languages']
+
+async def test_server_reload_bad_request(reload_cli):
+    cli = reload_cli
+    resp = await cli.post('/reload', json={"lang": "es"})
+    assert resp.status == 400
+    resp = await cli.post('/reload', json={"lang": "xx", "minimal_ers_mode": True})
+    assert resp.status == 400
+    resp = await cli.get('/reload')
+    json_resp = await resp.json()
+    assert json_resp['state'] == "idle"
+
+async def test_server_custom_entities(cli):
+    resp = await cli.post('/custom_entities',
+                          json={"entities": {"custom_entity": ["Lemon Drizzle", "Carrot Cake"]}})
+    assert resp.status == 200
+    json_resp = await resp.json()
+    version = json_resp['version']
+    assert json_resp['entities'] == {"custom_entity": 2}
+    resp = await cli.get('/ner?q=one lemon drizzle please')
+    json_resp = await resp.json()
+    assert [(item['category'], item['value']) for item in json_resp] == [("sys.custom", "lemon drizzle")]
+
+    resp = await cli.post('/custom_entities/delete', json={"entities": {"custom_entity": []}})
+    assert resp.status == 200
+    json_resp = await resp.json()
+    assert json_resp['version'] == version + 1
+    assert json_resp['entities'] == {}
+    # cached results are not served once the custom entities changed
+    resp = await cli.get('/ner?q=one lemon drizzle please')
+    json_resp = await resp.json()
+    assert "sys.custom" not in [item['category'] for item in json_resp]
+    resp = await cli.get('/custom_entities')
+    json_resp = await resp.json()
+    assert json_resp == {"version": version + 1, "entities": {}}
+
+
+async def test_server_custom_entities_bad_request(cli):
+    resp = await cli.post('/custom_entities', json={"entities": {"NOT_A_KEY": ["Lemon Drizzle"]}})
+    assert resp.status == 400
+    resp = await cli.post('/custom_entities', json={"entities": {"custom_entity": "Lemon Drizzle"}})
+    assert resp.status == 400
+    resp = await cli.post('/custom_entities', json={"phrases": ["Lemon Drizzle"]})
+    assert resp.status == 400
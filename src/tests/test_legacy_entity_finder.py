@@ -146,6 +146,13 @@ def test_entity_finder_list_type_priority():
     assert("CakeSize" in found_matches["Large"])
 
 
+def test_entity_finder_approximate_size():
+    finder = LegacyEntityFinder()
+    finder.setup_entity_values({"CakeSize": ["Large", "Tiny"]})
+    finder.setup_regex_entities({"CakeSizeRegex": "^[Ll].+$"})
+    assert(finder.approximate_size == 17)
+
+
 def test_entity_finder_split_message():
     finder = LegacyEntityFinder()
     words = finder.split_message("This is short")
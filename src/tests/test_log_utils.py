@@ -0,0 +1,49 @@
+import asyncio
+import logging
+
+from hu_entity.log_utils import Truncated, SampleFilter, log_sample_middleware
+
+
+def test_truncated_short_values_unchanged():
+    assert(str(Truncated("London")) == "London")
+    assert(str(Truncated(["a", "b"])) == "['a', 'b']")
+
+
+def test_truncated_long_values():
+    assert(str(Truncated("x" * 300, limit=10)) == "xxxxxxxxxx... (300 characters)")
+    entities = {"cars": ["car {}".format(n) for n in range(100000)]}
+    text = str(Truncated(entities))
+    assert(text.startswith("{'cars': ['car 0', 'car 1', "))
+    assert(len(text) < 250)
+
+
+def test_sample_filter():
+    info_record = logging.LogRecord("hu_entity", logging.INFO, "", 0, "request", None, None)
+    warning_record = logging.LogRecord("hu_entity", logging.WARNING, "", 0, "full", None, None)
+    assert(SampleFilter(1.0).filter(info_record))
+    assert(not SampleFilter(0.0).filter(info_record))
+    assert(SampleFilter(0.0).filter(warning_record))
+    sample_filter = SampleFilter(0.5)
+    kept = sum(sample_filter.filter(info_record) for _ in range(1000))
+    assert(300 < kept < 700)
+
+
+def test_sample_filter_per_request():
+    info_record = logging.LogRecord("hu_entity", logging.INFO, "", 0, "request", None, None)
+    sample_filter = SampleFilter(0.5)
+
+    async def handler(request):
+        return [sample_filter.filter(info_record) for _ in range(20)]
+
+    async def requests():
+        return await asyncio.gather(*[log_sample_middleware(None, handler)
+                                      for _ in range(100)])
+
+    loop = asyncio.new_event_loop()
+    try:
+        kept = loop.run_until_complete(requests())
+    finally:
+        loop.close()
+    # each request keeps all its records or none
+    assert(all(len(set(request_kept)) == 1 for request_kept in kept))
+    assert(10 < sum(request_kept[0] for request_kept in kept) < 90)
@@ -0,0 +1,57 @@
+import threading
+
+from hu_entity.metrics import Counter, Histogram, Gauge, render
+
+
+def test_counter_render():
+    counter = Counter("test_requests_total", "Requests", ("route", "status"))
+    counter.inc("/ner", 200)
+    counter.inc("/ner", 200)
+    counter.inc("/ner", 400)
+    assert(counter.render() == [
+        "# HELP test_requests_total Requests",
+        "# TYPE test_requests_total counter",
+        "test_requests_total{route=\"/ner\",status=\"200\"} 2",
+        "test_requests_total{route=\"/ner\",status=\"400\"} 1"])
+
+
+def test_histogram_render():
+    histogram = Histogram("test_seconds", "Latency", ("stage",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, "nlp")
+    histogram.observe(0.5, "nlp")
+    histogram.observe(5.0, "nlp")
+    assert(histogram.render()[2:] == [
+        "test_seconds_bucket{stage=\"nlp\",le=\"0.1\"} 1",
+        "test_seconds_bucket{stage=\"nlp\",le=\"1.0\"} 2",
+        "test_seconds_bucket{stage=\"nlp\",le=\"+Inf\"} 3",
+        "test_seconds_sum{stage=\"nlp\"} 5.55",
+        "test_seconds_count{stage=\"nlp\"} 3"])
+
+
+def test_histogram_timer():
+    histogram = Histogram("test_seconds", "Latency", ("stage",))
+    with histogram.time("matcher"):
+        pass
+    assert(histogram.totals()[("matcher",)][0] == 1)
+
+
+def test_metrics_summed_over_threads():
+    counter = Counter("test_total", "Calls")
+
+    def count():
+        for _ in range(1000):
+            counter.inc()
+
+    threads = [threading.Thread(target=count) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert(len(counter.shards) == 4)
+    assert(counter.render()[2] == "test_total 4000")
+
+
+def test_gauge_render():
+    gauge = Gauge("test_entities", "Entities", ("namespace",), [(("bot \"1\"",), 3)])
+    text = render([gauge])
+    assert(text.endswith("test_entities{namespace=\"bot \\\"1\\\"\"} 3\n"))
@@ -0,0 +1,214 @@
+import os
+import threading
+
+import pytest
+
+import hu_entity.model_registry
+from hu_entity.model_registry import ModelRegistry, load_custom_entities
+from hu_entity.result_cache import LruCache
+
+
+class FakeWrapper:
+    """Stands in for SpacyWrapper, recording the models loaded"""
+    loaded = []
+
+    def __init__(self, minimal_ers_mode=False, language='en', result_cache=None):
+        self.minimal_ers_mode = minimal_ers_mode
+        self.language = language
+        self.model_version = 0
+        self.custom_entities = {}
+        self.custom_entities_version = 0
+        self.matcher_entities = {}
+        # the number of times the matcher was built, or added to
+        self.matcher_builds = 0
+
+    def initialize(self):
+        FakeWrapper.loaded.append(self.language)
+        self.set_custom_entities(self.custom_entities)
+        self.model_version += 1
+
+    def add_entities(self, entities, version=None):
+        for key, phrases in entities.items():
+            self.matcher_entities.setdefault(key, []).extend(phrases)
+        self.custom_entities = {key: list(phrases)
+                                for key, phrases in self.matcher_entities.items()}
+        self.custom_entities_version = version
+        self.matcher_builds += 1
+
+    def set_custom_entities(self, entities, version=None):
+        self.matcher_entities = {key: list(phrases) for key, phrases in entities.items()}
+        self.custom_entities = {key: list(phrases) for key, phrases in entities.items()}
+        if version is not None:
+            self.custom_entities_version = version
+        self.matcher_builds += 1
+
+
+@pytest.fixture()
+def fake_wrapper(monkeypatch):
+    FakeWrapper.loaded = []
+    monkeypatch.setattr(hu_entity.model_registry, "SpacyWrapper", FakeWrapper)
+    # every model appears to take 100 bytes
+    sizes = iter(range(0, 100000, 100))
+    monkeypatch.setattr(hu_entity.model_registry, "resident_bytes", lambda: next(sizes))
+
+
+def test_model_registry_lazy_load(fake_wrapper):
+    models = ModelRegistry(default_language='en')
+    assert(models.loaded_languages() == [])
+    assert(models.get().language == 'en')
+    assert(models.get('es').language == 'es')
+    assert(models.get('es') is models.get('es'))
+    assert(FakeWrapper.loaded == ['en', 'es'])
+    assert(models.sizes == {'en': 100, 'es': 100})
+
+
+def test_model_registry_unloads_least_recently_used(fake_wrapper):
+    models = ModelRegistry(default_language='en', memory_budget=200)
+    models.get('en')
+    models.get('es')
+    models.get('en')
+    models.get('fr')
+    assert(models.loaded_languages() == ['en', 'fr'])
+    models.get('es')
+    assert(models.loaded_languages() == ['fr', 'es'])
+    assert(FakeWrapper.loaded == ['en', 'es', 'fr', 'es'])
+
+
+def test_model_registry_loads_once_across_threads(fake_wrapper):
+    models = ModelRegistry()
+    threads = [threading.Thread(target=models.get, args=('it',)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert(FakeWrapper.loaded == ['it'])
+
+
+def test_model_registry_reload(fake_wrapper):
+    models = ModelRegistry(default_language='en', preload_languages=['es', 'en'])
+    assert(models.languages_to_preload() == ['en', 'es'])
+    models.get()
+    models.get('it')
+    models.reload(True, 'es')
+    assert(models.loaded_languages() == ['es', 'en', 'it'])
+    assert(models.languages_to_preload() == ['es', 'en'])
+    wrapper = models.get()
+    assert(wrapper.language == 'es' and wrapper.minimal_ers_mode)
+    assert(models.get('it').minimal_ers_mode)
+    assert(models.result_key(None, 'ner', 'q') == ('es', True, 1, 1, 0, 'ner', 'q'))
+    assert(models.result_key('fr', 'ner', 'q') == ('fr', True, 1, 0, 0, 'ner', 'q'))
+
+
+def test_model_registry_swap_invalidates_results(fake_wrapper):
+    # as in process mode, where the models are held by the workers, not here
+    result_cache = LruCache(10)
+    models = ModelRegistry(default_language='en', result_cache=result_cache)
+    key = models.result_key(None, 'ner', 'q')
+    result_cache.put(key, [])
+    models.swap(False, 'en')
+    assert(len(result_cache) == 0)
+    assert(models.result_key(None, 'ner', 'q') != key)
+
+
+def test_model_registry_reload_swaps_at_once(fake_wrapper):
+    models = ModelRegistry(default_language='en')
+    old_wrapper = models.get()
+    wrappers, sizes = models.build(True, 'en')
+    # the old model serves calls until the swap
+    assert(models.get() is old_wrapper)
+    models.swap(True, 'en', wrappers, sizes)
+    assert(models.get() is wrappers['en'])
+    assert(models.get().minimal_ers_mode)
+    assert(FakeWrapper.loaded == ['en', 'en'])
+
+
+def test_model_registry_replays_custom_entities(fake_wrapper):
+    models = ModelRegistry(default_language='en')
+    models.get()
+    models.add_entity("Lemon drizzle", "CakeType")
+    assert(models.get().matcher_entities == {"CakeType": ["Lemon drizzle"]})
+    # added while the new models load
+    wrappers, sizes = models.build(False, 'en')
+    models.add_entity("Carrot cake", "CakeType")
+    models.swap(False, 'en', wrappers, sizes)
+    assert(models.get().matcher_entities == {"CakeType": ["Lemon drizzle", "Carrot cake"]})
+    assert(models.get('es').matcher_entities == {"CakeType": ["Lemon drizzle", "Carrot cake"]})
+    assert(models.config()[3] == 2)
+    assert(models.get().custom_entities_version == 2)
+
+
+def test_model_registry_registers_entities_in_bulk(fake_wrapper):
+    result_cache = LruCache(10)
+    models = ModelRegistry(default_language='en', result_cache=result_cache)
+    wrapper = models.get()
+    result_cache.put(models.result_key(None, 'ner', 'q'), [])
+    version = models.register_entities({"CakeType": ["Lemon drizzle", "Carrot cake",
+                                                     "Lemon drizzle"],
+                                        "Shop": ["Cake Corner"]})
+    assert(version == 1)
+    # one matcher update for all the phrases
+    assert(wrapper.matcher_builds == 2)
+    assert(wrapper.matcher_entities == {"CakeType": ["Lemon drizzle", "Carrot cake"],
+                                        "Shop": ["Cake Corner"]})
+    assert(len(result_cache) == 0)
+    assert(models.result_key(None, 'ner', 'q') == ('en', False, 0, 1, 1, 'ner', 'q'))
+    # phrases already known are not added again
+    models.register_entities({"CakeType": ["Carrot cake", "Battenberg"]})
+    assert(wrapper.matcher_entities["CakeType"] == ["Lemon drizzle", "Carrot cake",
+                                                    "Battenberg"])
+    assert(models.custom_entities_stats() == {'version': 2,
+                                              'entities': {"CakeType": 3, "Shop": 1}})
+
+
+def test_model_registry_unregisters_entities(fake_wrapper):
+    models = ModelRegistry(default_language='en')
+    wrapper = models.get()
+    models.register_entities({"CakeType": ["Lemon drizzle", "Carrot cake"],
+                              "Shop": ["Cake Corner"]})
+    version = models.unregister_entities({"CakeType": ["Carrot cake"], "Shop": [],
+                                          "Unknown": ["Anything"]})
+    assert(version == 2)
+    assert(wrapper.matcher_entities == {"CakeType": ["Lemon drizzle"]})
+    assert(wrapper.custom_entities_version == 2)
+    assert(models.custom_entities_stats() == {'version': 2, 'entities': {"CakeType": 1}})
+    # models loaded later get the registry as it is now
+    assert(models.get('es').matcher_entities == {"CakeType": ["Lemon drizzle"]})
+
+
+def test_model_registry_keeps_custom_entities_in_flight(fake_wrapper, tmpdir):
+    models = ModelRegistry(default_language='en', custom_entities_dir=str(tmpdir))
+    models.register_entities({"CakeType": ["Cake 0"]})
+    # as calls sent to process workers
+    first_config = models.hold_config()
+    second_config = models.hold_config()
+    models.register_entities({"CakeType": ["Cake 1"]})
+    models.register_entities({"CakeType": ["Cake 2"]})
+    assert(load_custom_entities(first_config[4]) == {"CakeType": ["Cake 0"]})
+    assert(len(os.listdir(str(tmpdir))) == 2)
+    models.release_config(first_config)
+    assert(os.path.exists(second_config[4]))
+    models.release_config(second_config)
+    assert(os.listdir(str(tmpdir)) == [os.path.basename(models.config()[4])])
+    # the current version is kept after its calls are done
+    models.release_config(models.hold_config())
+    assert(load_custom_entities(models.config()[4]) == {"CakeType": ["Cake 0", "Cake 1",
+                                                                     "Cake 2"]})
+
+
+def test_model_registry_writes_custom_entities(fake_wrapper, tmpdir):
+    models = ModelRegistry(default_language='en', custom_entities_dir=str(tmpdir))
+    assert(load_custom_entities(models.config()[4]) == {})
+    for number in range(4):
+        models.register_entities({"CakeType": ["Cake {}".format(number)]})
+    version, path = models.config()[3:]
+    assert(version == 4)
+    assert(load_custom_entities(path) == {"CakeType": ["Cake 0", "Cake 1", "Cake 2",
+                                                       "Cake 3"]})
+    # only the current version is kept, named after this process
+    assert(os.listdir(str(tmpdir)) == ["custom_entities-{}-4.json".format(os.getpid())])
+    # a process pool worker following the files
+    worker_models = ModelRegistry(default_language='en')
+    worker_models.set_custom_entities(load_custom_entities(path), version)
+    assert(worker_models.get().matcher_entities == {"CakeType": ["Cake 0", "Cake 1",
+                                                                 "Cake 2", "Cake 3"]})
+    assert(worker_models.custom_entities_version == 4)
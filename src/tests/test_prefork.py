@@ -0,0 +1,69 @@
+# flake8: noqa
+import gc
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+from hu_entity.prefork import PreforkServer, listen, freeze_heap, NO_FREEZE_FULL_COLLECTION_THRESHOLD
+
+
+def wait_for_lines(path, count, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if os.path.exists(path):
+            with open(path) as file_handle:
+                lines = file_handle.read().split()
+            if len(lines) >= count:
+                return lines
+        time.sleep(0.05)
+    return []
+
+
+def serve_and_record(path, processes):
+    def run_worker():
+        with open(path, "a") as file_handle:
+            file_handle.write("{}\n".format(os.getpid()))
+        while True:
+            time.sleep(1)
+    PreforkServer(processes, run_worker).serve()
+
+
+def test_prefork_starts_and_stops_workers(tmpdir):
+    path = str(tmpdir.join("workers"))
+    process = multiprocessing.get_context("fork").Process(target=serve_and_record,
+                                                          args=(path, 3))
+    process.start()
+    workers = wait_for_lines(path, 3)
+    assert(len(set(workers)) == 3)
+
+    # a dead worker is replaced
+    os.kill(int(workers[0]), signal.SIGKILL)
+    assert(len(wait_for_lines(path, 4)) == 4)
+
+    os.kill(process.pid, signal.SIGTERM)
+    process.join(10)
+    assert(process.exitcode == 0)
+
+
+def test_prefork_listen():
+    sock = listen(0, host="127.0.0.1")
+    port = sock.getsockname()[1]
+    client = socket.create_connection(("127.0.0.1", port))
+    connection, _ = sock.accept()
+    connection.close()
+    client.close()
+    sock.close()
+
+
+def test_prefork_freeze_heap_without_gc_freeze(monkeypatch):
+    # as on Python 3.6
+    if hasattr(gc, "freeze"):
+        monkeypatch.delattr(gc, "freeze")
+    threshold = gc.get_threshold()
+    try:
+        freeze_heap()
+        assert(gc.get_threshold() == threshold[:2] + (NO_FREEZE_FULL_COLLECTION_THRESHOLD,))
+    finally:
+        gc.set_threshold(*threshold)
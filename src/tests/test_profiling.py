@@ -0,0 +1,45 @@
+# flake8: noqa
+import time
+
+from hu_entity.profiling import RequestProfiler, ProfileMode
+
+
+def build_words(count):
+    return ["word {}".format(n) for n in range(count)]
+
+
+async def handle_words(request):
+    return build_words(1000)
+
+
+async def test_profiler_cprofile_report(loop):
+    profiler = RequestProfiler()
+    profiler.start(ProfileMode.CPROFILE, ["handle_words"], 60)
+    assert profiler.selects("handle_words")
+    assert not profiler.selects("entity_check")
+    result = await profiler.profile_request(None, handle_words)
+    assert len(result) == 1000
+    profiler.stop()
+    status = profiler.status()
+    assert not status['active']
+    assert status['requests'] == 1
+    assert "build_words" in status['report']
+
+
+async def test_profiler_tracemalloc_report(loop):
+    profiler = RequestProfiler()
+    profiler.start(ProfileMode.TRACEMALLOC, None, 60)
+    assert profiler.selects("entity_check")
+    words = await profiler.profile_request(None, handle_words)
+    profiler.stop()
+    assert "test_profiling.py" in profiler.status()['report']
+
+
+def test_profiler_window_expires():
+    profiler = RequestProfiler()
+    profiler.start(ProfileMode.CPROFILE, None, 0.01)
+    assert profiler.status()['active']
+    time.sleep(0.02)
+    status = profiler.status()
+    assert not status['active']
+    assert status['report'] == "No requests profiled\n"
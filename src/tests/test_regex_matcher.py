@@ -0,0 +1,132 @@
+import re
+
+from hu_entity.regex_matcher import MultiRegexMatcher
+
+
+def setup_matcher():
+    regex = {"CakeSizeRegex": re.compile("^[Ll].+$"),
+             "CakeTypeRegex": re.compile("^[Cc].+$"),
+             "AlarmRegex": re.compile("[A]\\d{3}$"),
+             "AnyLRegex": re.compile("l.*")}
+    return MultiRegexMatcher(regex)
+
+
+def test_regex_matcher_single_match():
+    matcher = setup_matcher()
+    assert(matcher.fullmatches("cake") == ["CakeTypeRegex"])
+    assert(matcher.fullmatches("A212") == ["AlarmRegex"])
+
+
+def test_regex_matcher_no_match():
+    matcher = setup_matcher()
+    assert(matcher.fullmatches("biscuit") == [])
+
+
+def test_regex_matcher_all_matches_in_entity_order():
+    matcher = setup_matcher()
+    assert(matcher.fullmatches("large") == ["CakeSizeRegex", "AnyLRegex"])
+
+
+def test_regex_matcher_groups_and_flags_matched_separately():
+    regex = {"Repeated": re.compile("(x)\\1"),
+             "Insensitive": re.compile("(?i)la.*"),
+             "Named": re.compile("(?P<size>l)arge"),
+             "Plain": re.compile("l.*"),
+             "AlsoPlain": re.compile("x+")}
+    matcher = MultiRegexMatcher(regex)
+    assert(matcher.combined_indexes == [3, 4])
+    assert(matcher.fullmatches("xx") == ["Repeated", "AlsoPlain"])
+    assert(matcher.fullmatches("LARGE") == ["Insensitive"])
+    assert(matcher.fullmatches("large") == ["Insensitive", "Named", "Plain"])
+
+
+def test_regex_matcher_empty():
+    matcher = MultiRegexMatcher({})
+    assert(matcher.fullmatches("large") == [])
+
+
+def test_regex_matcher_update_and_remove():
+    matcher = setup_matcher()
+    matcher.update({"AlarmRegex": re.compile("[B]\\d{3}$"), "Biscuit": re.compile("b.*")})
+    assert(matcher.fullmatches("A212") == [])
+    assert(matcher.fullmatches("B212") == ["AlarmRegex"])
+    assert(matcher.fullmatches("biscuit") == ["Biscuit"])
+    matcher.remove(["Biscuit", "CakeSizeRegex", "Unknown"])
+    assert(matcher.fullmatches("biscuit") == [])
+    assert(matcher.fullmatches("large") == ["AnyLRegex"])
+    assert(len(matcher) == 3)
+
+
+class FakeClock:
+    """Stands in for time.perf_counter, only moving when told to"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class SlowPattern:
+    """A compiled pattern whose every fullmatch takes a second of clock time"""
+
+    def __init__(self, compiled, clock):
+        self.compiled = compiled
+        self.clock = clock
+        self.pattern = compiled.pattern
+        self.groups = compiled.groups
+        self.flags = compiled.flags
+        self.calls = 0
+
+    def fullmatch(self, word):
+        self.calls += 1
+        self.clock.now += 1.0
+        return self.compiled.fullmatch(word)
+
+
+def test_regex_matcher_time_budget_disables_slow_patterns():
+    clock = FakeClock()
+    slow = SlowPattern(re.compile("(x)+y"), clock)
+    matcher = MultiRegexMatcher({"Backtracking": slow, "Plain": re.compile("a+")},
+                                time_budget=0.1)
+    matcher.clock = clock
+    assert(matcher.fullmatches("aa") == ["Plain"])
+    # timed as it matched, not run again
+    assert(slow.calls == 1)
+    assert(matcher.disabled_entities == ["Backtracking"])
+    assert(matcher.fullmatches("xy") == [])
+    assert(matcher.fullmatches("aa") == ["Plain"])
+
+    # Supplying the entity again enables it again
+    matcher.update({"Backtracking": re.compile("x+y")})
+    assert(matcher.disabled_entities == [])
+    assert(matcher.fullmatches("xy") == ["Backtracking"])
+
+
+def test_regex_matcher_time_budget_finds_slow_pattern_in_alternation():
+    clock = FakeClock()
+    slow = SlowPattern(re.compile("(?:a|a)*b"), clock)
+    matcher = MultiRegexMatcher({"Backtracking": slow, "Plain": re.compile("a+"),
+                                 "Other": re.compile("c+")}, time_budget=0.1)
+    matcher.clock = clock
+    assert(matcher.combined_indexes == [0, 1, 2])
+    matcher.combined = SlowPattern(matcher.combined, clock)
+    assert(matcher.fullmatches("aa") == ["Plain"])
+    # the word is not matched again, the patterns are matched one by one from now on
+    assert(slow.calls == 0)
+    assert(matcher.disabled_entities == [])
+    assert(matcher.combined is None)
+    assert(matcher.fullmatches("aa") == ["Plain"])
+    assert(slow.calls == 1)
+    assert(matcher.disabled_entities == ["Backtracking"])
+    # the others are joined again
+    assert(matcher.combined_indexes == [0, 1])
+    assert(matcher.fullmatches("cc") == ["Other"])
+
+
+def test_regex_matcher_disable():
+    matcher = setup_matcher()
+    matcher.disable(["AlarmRegex", "Unknown"])
+    assert(matcher.disabled_entities == ["AlarmRegex"])
+    assert(matcher.fullmatches("A212") == [])
+    assert(len(matcher) == 3)
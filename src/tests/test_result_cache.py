@@ -0,0 +1,85 @@
+import sys
+import threading
+import time
+
+from hu_entity.result_cache import LruCache
+
+
+def test_result_cache_hit_and_miss():
+    cache = LruCache(max_size=2)
+    assert(cache.get("hi") is None)
+    cache.put("hi", ["hi"])
+    assert(cache.get("hi") == ["hi"])
+    stats = cache.stats()
+    assert(stats["hits"] == 1)
+    assert(stats["misses"] == 1)
+    assert(stats["size"] == 1)
+
+
+def test_result_cache_evicts_least_recently_used():
+    cache = LruCache(max_size=2)
+    cache.put("yes", 1)
+    cache.put("no", 2)
+    cache.get("yes")
+    cache.put("hello", 3)
+    assert(cache.get("no") is None)
+    assert(cache.get("yes") == 1)
+    assert(cache.get("hello") == 3)
+    assert(cache.stats()["evictions"] == 1)
+
+
+def test_result_cache_ttl():
+    cache = LruCache(max_size=2, ttl=0.01)
+    cache.put("yes", 1)
+    time.sleep(0.02)
+    assert(cache.get("yes") is None)
+    assert(len(cache) == 0)
+    assert(cache.stats()["expirations"] == 1)
+
+
+def test_result_cache_disabled():
+    cache = LruCache(max_size=0)
+    cache.put("yes", 1)
+    assert(cache.get("yes") is None)
+
+
+def test_result_cache_clear():
+    cache = LruCache()
+    cache.put("yes", 1)
+    cache.clear()
+    assert(cache.get("yes") is None)
+
+
+def test_result_cache_weighted():
+    cache = LruCache(max_size=10, weigh=len)
+    cache.put("a", "12345")
+    cache.put("b", "1234")
+    cache.put("c", "123")
+    assert(cache.get("a") is None)
+    assert(cache.stats()["weight"] == 7)
+    cache.put("d", "12345678901")
+    assert(cache.get("d") is None)
+    assert(cache.stats()["evictions"] == 1)
+
+
+def test_result_cache_clear_from_another_thread():
+    cache = LruCache(max_size=50, weigh=len)
+    stop = threading.Event()
+
+    def clear():
+        while not stop.is_set():
+            cache.clear()
+
+    # switch threads as often as possible, so that clears land inside puts
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    clearer = threading.Thread(target=clear)
+    clearer.start()
+    try:
+        for number in range(20000):
+            cache.put(number, "x" * (number % 7 + 1))
+    finally:
+        stop.set()
+        clearer.join()
+        sys.setswitchinterval(switch_interval)
+    assert(cache.weight == sum(len(value) for value, _, _ in cache.entries.values()))
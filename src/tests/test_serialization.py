@@ -0,0 +1,48 @@
+import json
+from collections import defaultdict
+
+import pytest
+
+from hu_entity.named_entity import NamedEntity, dumps_custom
+from hu_entity.serialization import (available_backends, get_dumps, digest,
+                                     entities_to_dicts, entity_batch_to_dicts, matches_to_dict)
+
+
+def test_entities_to_dicts_matches_custom_encoder():
+    entities = [NamedEntity("London", "GPE", 0, 6), NamedEntity("tomorrow", "DATE", 7, 15)]
+    assert(entities_to_dicts(entities) == json.loads(dumps_custom(entities)))
+    assert(entity_batch_to_dicts([entities, []]) ==
+           [json.loads(dumps_custom(entities)), []])
+
+
+@pytest.mark.parametrize("backend", available_backends())
+def test_backends_agree(backend):
+    matches = defaultdict(list)
+    matches["new york"].append("city")
+    matches["café"].extend(["drink", "place"])
+    data = {'conversation': "a café in new york / 50%", 'entities': matches_to_dict(matches),
+            'sizes': {1: 2.5}, 'nothing': None, 'tokens': ("a", "b")}
+    expected = {'conversation': "a café in new york / 50%",
+                'entities': {"new york": ["city"], "café": ["drink", "place"]},
+                'sizes': {"1": 2.5}, 'nothing': None, 'tokens': ["a", "b"]}
+    body = get_dumps(backend)(data)
+    assert(isinstance(body, bytes))
+    assert(json.loads(body.decode('utf-8')) == expected)
+
+
+def test_default_backend_is_fastest_installed():
+    assert(available_backends()[-1] == 'json')
+    assert(get_dumps() is get_dumps(available_backends()[0]))
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        get_dumps("simplejson")
+
+
+def test_digest_ignores_key_order():
+    payload = [{"CakeType": ["Carrot", "Sponge"], "Drinks": ["Beer"]}, None]
+    reordered = [{"Drinks": ["Beer"], "CakeType": ["Carrot", "Sponge"]}, None]
+    assert(digest(payload) == digest(reordered))
+    assert(digest(payload) != digest([{"CakeType": ["Sponge", "Carrot"], "Drinks": ["Beer"]},
+                                      None]))
@@ -0,0 +1,31 @@
+# flake8: noqa
+import pytest
+
+import hu_entity.stopwords
+from hu_entity.stopwords import load_stopwords, write_stopwords
+
+
+@pytest.fixture()
+def stopwords_dir(tmpdir, monkeypatch):
+    monkeypatch.setattr(hu_entity.stopwords, "STOPWORDS_DIR", str(tmpdir))
+    load_stopwords.cache_clear()
+    yield tmpdir
+    load_stopwords.cache_clear()
+
+
+def test_stopwords_round_trip(stopwords_dir):
+    write_stopwords("spanish", ["de", "la", "que", "el", "de", "¿qué"])
+    assert(stopwords_dir.join("spanish.txt").read_text("utf8") == "de\nel\nla\nque\n¿qué\n")
+    assert(load_stopwords("spanish") == {"de", "el", "la", "que", "¿qué"})
+
+
+def test_stopwords_loaded_once(stopwords_dir):
+    write_stopwords("english", ["the", "a"])
+    stopwords = load_stopwords("english")
+    write_stopwords("english", ["an"])
+    assert(load_stopwords("english") is stopwords)
+
+
+def test_stopwords_missing(stopwords_dir):
+    with pytest.raises(FileNotFoundError):
+        load_stopwords("klingon")
@@ -36,6 +36,21 @@ def test_tokenize_anonymise_person_if_otherwise_empty(spacy_wrapper):
     assert result[0] == "person"
 
 
+def test_tokenize_matches_custom_entities_only_to_filter_them(spacy_wrapper):
+    matcher = spacy_wrapper.matcher
+    matched_docs = []
+    spacy_wrapper.matcher = matched_docs.append
+    try:
+        spacy_wrapper.tokenize("Fred Bloggs rules OK", False, hu_entity.spacy_wrapper.StopWordSize.SMALL)
+        list(spacy_wrapper.tokenize_batch(["Fred Bloggs rules OK"], False,
+                                          hu_entity.spacy_wrapper.StopWordSize.SMALL))
+        assert len(matched_docs) == 0
+        spacy_wrapper.tokenize("Fred Bloggs rules OK", True, hu_entity.spacy_wrapper.StopWordSize.SMALL)
+        assert len(matched_docs) == 1
+    finally:
+        spacy_wrapper.matcher = matcher
+
+
 def test_tokenize_remove_number(spacy_wrapper):
     result = spacy_wrapper.tokenize(
         "set alarm 12345", True, hu_entity.spacy_wrapper.StopWordSize.SMALL)
@@ -63,3 +78,35 @@ def test_anonymise_floating_point_2_not_replaced(spacy_wrapper):
         "1,234.50", True, hu_entity.spacy_wrapper.StopWordSize.SMALL)
     assert len(result) == 1
     assert result[0] == "1,234.50"
+
+
+def test_tokenize_batch(spacy_wrapper):
+    samples = ["hi", "Fred Bloggs rules OK", "set alarm 12345", "12345"]
+    results = list(spacy_wrapper.tokenize_batch(
+        samples, True, hu_entity.spacy_wrapper.StopWordSize.SMALL, batch_size=3))
+    assert len(results) == 4
+    for sample, result in zip(samples, results):
+        assert result == spacy_wrapper.tokenize(
+            sample, True, hu_entity.spacy_wrapper.StopWordSize.SMALL)
+    assert results[1] == ["rule", "ok"]
+
+
+def test_result_key_changes_with_custom_entity(spacy_wrapper):
+    key = spacy_wrapper.result_key('tokenize', "hi", True, hu_entity.spacy_wrapper.StopWordSize.SMALL)
+    spacy_wrapper.add_entity("Acme Widgets", "custom_entity")
+    assert spacy_wrapper.result_key('tokenize', "hi", True,
+                                    hu_entity.spacy_wrapper.StopWordSize.SMALL) != key
+
+
+def test_tokenize_same_as_full_pipeline(spacy_wrapper):
+    samples = ["Fred Bloggs rules OK", "set alarm 12345", "Who is Sherlock Holmes?",
+               "I'd like to fly from London to Paris tomorrow at 9am"]
+    for filter_ents in (True, False):
+        for sw_size in hu_entity.spacy_wrapper.StopWordSize:
+            for sample in samples:
+                doc = spacy_wrapper.nlp(sample)
+                spacy_wrapper.matcher(doc)
+                expected = spacy_wrapper.doc_tokens(doc, filter_ents, sw_size)
+                assert spacy_wrapper.tokenize(sample, filter_ents, sw_size) == expected
+                assert list(spacy_wrapper.tokenize_batch(
+                    [sample], filter_ents, sw_size)) == [expected]
@@ -0,0 +1,116 @@
+# flake8: noqa
+import asyncio
+import threading
+
+import pytest
+
+from hu_entity.worker_pool import SpacyWorkerPool, WorkerPoolFull, WorkerPoolTimeout
+
+
+class BlockingWrapper:
+    """Stands in for SpacyWrapper, each call waits until released"""
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def languages_to_preload(self):
+        return []
+
+    def get(self, language):
+        """The pool asks its models for the wrapper of a language"""
+        self.language = language
+        return self
+
+    def build(self, minimal_ers_mode, default_language):
+        """The pool asks its models to load new models on a reload"""
+        self.release.wait(5)
+        return {default_language: self}, {}
+
+    def swap(self, minimal_ers_mode, default_language, wrappers=None, sizes=None):
+        self.swapped = (minimal_ers_mode, default_language)
+
+    def echo(self, value):
+        self.release.wait(5)
+        return value
+
+
+def echo(wrapper, value):
+    return wrapper.echo(value)
+
+
+@pytest.fixture()
+def wrapper():
+    wrapper = BlockingWrapper()
+    yield wrapper
+    wrapper.release.set()
+
+
+async def test_worker_pool_returns_result(loop, wrapper):
+    pool = SpacyWorkerPool(wrapper, workers=1)
+    pool.initialize()
+    wrapper.release.set()
+    result = await pool.run(echo, "London")
+    assert result == "London"
+    pool.shutdown()
+
+
+async def test_worker_pool_does_not_block_loop(loop, wrapper):
+    pool = SpacyWorkerPool(wrapper, workers=1)
+    pool.initialize()
+    task = asyncio.ensure_future(pool.run(echo, "London"))
+    # the event loop keeps running while the call is blocked
+    await asyncio.sleep(0.05)
+    assert not task.done()
+    wrapper.release.set()
+    assert await task == "London"
+    pool.shutdown()
+
+
+async def test_worker_pool_full(loop, wrapper):
+    pool = SpacyWorkerPool(wrapper, workers=1, max_pending=2)
+    pool.initialize()
+    tasks = [asyncio.ensure_future(pool.run(echo, n)) for n in range(2)]
+    await asyncio.sleep(0)
+    with pytest.raises(WorkerPoolFull):
+        await pool.run(echo, 3)
+    wrapper.release.set()
+    assert await asyncio.gather(*tasks) == [0, 1]
+    await asyncio.sleep(0.01)
+    assert pool.pending == 0
+    pool.shutdown()
+
+
+async def test_worker_pool_timeout(loop, wrapper):
+    pool = SpacyWorkerPool(wrapper, workers=1, request_timeout=0.05)
+    pool.initialize()
+    with pytest.raises(WorkerPoolTimeout):
+        await pool.run(echo, "London")
+    # the call is still running, so it still holds its slot
+    assert pool.pending == 1
+    wrapper.release.set()
+    await asyncio.sleep(0.05)
+    assert pool.pending == 0
+    pool.shutdown()
+
+
+async def test_worker_pool_language(loop, wrapper):
+    pool = SpacyWorkerPool(wrapper, workers=1)
+    pool.initialize()
+    wrapper.release.set()
+    assert await pool.run(echo, "Madrid", language="es") == "Madrid"
+    assert wrapper.language == "es"
+    pool.shutdown()
+
+
+async def test_worker_pool_reload_in_background(loop, wrapper):
+    pool = SpacyWorkerPool(wrapper, workers=1)
+    pool.initialize()
+    task = asyncio.ensure_future(pool.reload(True, "es"))
+    await asyncio.sleep(0.05)
+    # the models are still loading, and the old ones are kept until then
+    assert not task.done()
+    assert not hasattr(wrapper, "swapped")
+    wrapper.release.set()
+    await task
+    assert wrapper.swapped == (True, "es")
+    pool.shutdown()